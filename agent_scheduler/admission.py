@@ -0,0 +1,111 @@
+import math
+import time
+import threading
+from typing import Dict, Optional, Tuple
+
+from modules import shared
+
+from .db import task_manager
+from .cost import cost_model
+from .metrics import metrics
+from .helpers import log
+
+
+class AdmissionController:
+    """Refuse new tasks while the queue is over its configured limits.
+
+    Limits are the max pending tasks, globally and per tenant, and the max
+    size of the pending payloads (params and script params). Pending usage is
+    read from the database at most every `refresh_interval` seconds, tasks
+    admitted in between are counted locally. A rejected caller is told how
+    long to wait, from the estimated time to drain the excess tasks.
+    """
+
+    def __init__(self, refresh_interval: float = 2, max_retry_after: float = 300):
+        self.refresh_interval = refresh_interval
+        self.max_retry_after = max_retry_after
+
+        self.__lock = threading.Lock()
+        self.__usage: Dict[str, Tuple[int, int]] = {}
+        self.__refreshed_at = 0.0
+
+    @property
+    def max_pending_tasks(self) -> int:
+        return int(getattr(shared.opts, "queue_max_pending_tasks", 0))
+
+    @property
+    def max_pending_tasks_per_tenant(self) -> int:
+        return int(getattr(shared.opts, "queue_max_pending_tasks_per_tenant", 0))
+
+    @property
+    def max_pending_bytes(self) -> int:
+        return int(getattr(shared.opts, "queue_max_pending_payload_mb", 0) * 1024 * 1024)
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_pending_tasks > 0 or self.max_pending_tasks_per_tenant > 0 or self.max_pending_bytes > 0
+
+    def admit(self, tenant: str, payload_bytes: int = 0, work: float = None) -> Optional[float]:
+        """Reserve room for a new task of `tenant`.
+
+        Returns None if the task is admitted, otherwise the seconds to wait
+        before trying again. `work` is the task work, used to estimate it.
+        """
+
+        if not self.enabled:
+            return None
+
+        with self.__lock:
+            self.__refresh()
+
+            count = sum(c for c, _ in self.__usage.values())
+            size = sum(s for _, s in self.__usage.values())
+            tenant_count, tenant_size = self.__usage.get(tenant, (0, 0))
+
+            excess_tasks = 0
+            reason = None
+            if self.max_pending_tasks > 0 and count >= self.max_pending_tasks:
+                excess_tasks, reason = count - self.max_pending_tasks + 1, "tasks"
+            elif self.max_pending_tasks_per_tenant > 0 and tenant_count >= self.max_pending_tasks_per_tenant:
+                # tenants are served in turns, so the other tenants drain too
+                tenants = max(1, len([c for c, _ in self.__usage.values() if c > 0]))
+                excess_tasks, reason = (tenant_count - self.max_pending_tasks_per_tenant + 1) * tenants, "tenant"
+            elif self.max_pending_bytes > 0 and size + payload_bytes > self.max_pending_bytes:
+                bytes_per_task = size / count if count > 0 else payload_bytes
+                excess_tasks = math.ceil((size + payload_bytes - self.max_pending_bytes) / max(1, bytes_per_task))
+                reason = "payload"
+
+            if reason is None:
+                self.__usage[tenant] = (tenant_count + 1, tenant_size + payload_bytes)
+                metrics.incr("admission.admitted")
+                return None
+
+        metrics.incr("admission.rejected")
+        metrics.incr(f"admission.rejected.{reason}")
+
+        seconds_per_task = cost_model.overhead + cost_model.seconds_per_work * (work if work is not None else 10)
+        retry_after = min(self.max_retry_after, max(1.0, excess_tasks * seconds_per_task))
+        log.debug(f"[AgentScheduler] Rejected task of {tenant}, pending {reason} over the limit")
+
+        return retry_after
+
+    def release(self, tenant: str, payload_bytes: int = 0):
+        """Give back the room reserved by `admit` for a task that was not registered"""
+
+        with self.__lock:
+            tenant_count, tenant_size = self.__usage.get(tenant, (0, 0))
+            if tenant_count > 0:
+                self.__usage[tenant] = (tenant_count - 1, max(0, tenant_size - payload_bytes))
+
+    def __refresh(self):
+        if time.monotonic() - self.__refreshed_at < self.refresh_interval:
+            return
+
+        self.__refreshed_at = time.monotonic()
+        try:
+            self.__usage = task_manager.get_pending_usage()
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to refresh the pending usage: {e}")
+
+
+admission_controller = AdmissionController()
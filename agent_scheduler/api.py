@@ -1,8 +1,7 @@
 import io
 import os
 import json
-import requests
-import threading
+import math
 from uuid import uuid4
 from zipfile import ZipFile
 from pathlib import Path
@@ -11,8 +10,7 @@ from typing import Optional, Dict, List
 from datetime import datetime, timezone
 from collections import defaultdict
 from gradio.routes import App
-from PIL import Image
-from fastapi import Depends
+from fastapi import Depends, Request
 from fastapi.responses import StreamingResponse
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
 from fastapi.exceptions import HTTPException
@@ -20,7 +18,7 @@ from pydantic import BaseModel
 
 from modules import shared, progress, sd_models, sd_samplers
 
-from .db import Task, TaskStatus, task_manager
+from .db import Task, TaskStatus, task_manager, tenant_max_length
 from .models import (
     Txt2ImgApiTaskArgs,
     Img2ImgApiTaskArgs,
@@ -31,29 +29,15 @@ from .models import (
     UpdateTaskArgs,
 )
 from .task_runner import TaskRunner
-from .helpers import log, request_with_retry
-from .task_helpers import encode_image_to_base64, img2img_image_args_by_mode
-
-
-def api_callback(callback_url: str, task_id: str, status: TaskStatus, images: list):
-    files = []
-    for img in images:
-        img_path = Path(img)
-        ext = img_path.suffix.lower()
-        content_type = f"image/{ext[1:]}"
-        files.append(
-            (
-                "files",
-                (img_path.name, open(os.path.abspath(img), "rb"), content_type),
-            )
-        )
-
-    return requests.post(
-        callback_url,
-        timeout=5,
-        data={"task_id": task_id, "status": status.value},
-        files=files,
-    )
+from .metrics import metrics
+from .scheduling import fair_queue
+from .eta import eta_predictor
+from .admission import admission_controller
+from .cost import get_task_work
+from .outbox import callback_dispatcher
+from .timing import aggregate_timings
+from .helpers import log, get_expires_at
+from .task_helpers import encode_image_file_to_base64, img2img_image_args_by_mode
 
 
 def on_task_finished(
@@ -67,24 +51,26 @@ def on_task_finished(
     if not task.api_task_callback:
         return
 
-    upload = lambda: api_callback(
+    callback_dispatcher.enqueue(
+        task_id,
         task.api_task_callback,
-        task_id=task_id,
-        status=status,
-        images=result["images"],
+        status=status.value,
+        images=result["images"] if result else [],
     )
 
-    request_with_retry(upload)
-
 
 def regsiter_apis(app: App, task_runner: TaskRunner):
     api_credentials = {}
     deps = None
 
-    def auth(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+    def is_authorized(credentials: HTTPBasicCredentials) -> bool:
         if credentials.username in api_credentials:
-            if compare_digest(credentials.password, api_credentials[credentials.username]):
-                return True
+            return compare_digest(credentials.password, api_credentials[credentials.username])
+        return False
+
+    def auth(credentials: HTTPBasicCredentials = Depends(HTTPBasic())):
+        if is_authorized(credentials):
+            return True
 
         raise HTTPException(
             status_code=401, detail="Incorrect username or password", headers={"WWW-Authenticate": "Basic"}
@@ -99,6 +85,26 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
 
         deps = [Depends(auth)]
 
+    def get_tenant(credentials: Optional[HTTPBasicCredentials] = Depends(HTTPBasic(auto_error=False))):
+        # unverified usernames could be made up on each request to get a fresh share of the queue
+        if credentials and is_authorized(credentials):
+            return f"api:{credentials.username}"[:tenant_max_length]
+        return "api"
+
+    def admit_task(request: Request, tenant: str, args: Dict, is_img2img: bool) -> int:
+        """Reserve room for a new task, returns the payload size to release if it is not registered"""
+
+        payload_bytes = int(request.headers.get("content-length", 0) or 0)
+        retry_after = admission_controller.admit(tenant, payload_bytes, get_task_work({"args": args}, is_img2img))
+        if retry_after is not None:
+            raise HTTPException(
+                status_code=429,
+                detail="Queue is full, try again later",
+                headers={"Retry-After": str(int(math.ceil(retry_after)))},
+            )
+
+        return payload_bytes
+
     log.info("[AgentScheduler] Registering APIs")
 
     @app.get("/agent-scheduler/v1/samplers", response_model=List[str])
@@ -110,46 +116,70 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
         return [x.title for x in sd_models.checkpoints_list.values()]
 
     @app.post("/agent-scheduler/v1/queue/txt2img", response_model=QueueTaskResponse, dependencies=deps)
-    def queue_txt2img(body: Txt2ImgApiTaskArgs):
-        task_id = str(uuid4())
+    def queue_txt2img(body: Txt2ImgApiTaskArgs, request: Request, tenant: str = Depends(get_tenant)):
         args = body.dict()
-        checkpoint = args.pop("checkpoint", None)
-        vae = args.pop("vae", None)
-        callback_url = args.pop("callback_url", None)
-        task = task_runner.register_api_task(
-            task_id,
-            api_task_id=None,
-            is_img2img=False,
-            args=args,
-            checkpoint=checkpoint,
-            vae=vae,
-        )
+        payload_bytes = admit_task(request, tenant, args, is_img2img=False)
+
+        try:
+            task_id = str(uuid4())
+            checkpoint = args.pop("checkpoint", None)
+            vae = args.pop("vae", None)
+            callback_url = args.pop("callback_url", None)
+            expires_at = get_expires_at(args.pop("expires_at", None), args.pop("ttl_seconds", None))
+            urgent = args.pop("urgent", False)
+            task = task_runner.register_api_task(
+                task_id,
+                api_task_id=None,
+                is_img2img=False,
+                args=args,
+                checkpoint=checkpoint,
+                vae=vae,
+                tenant=tenant,
+                expires_at=expires_at,
+            )
+        except Exception:
+            admission_controller.release(tenant, payload_bytes)
+            raise
         if callback_url:
             task.api_task_callback = callback_url
             task_manager.update_task(task)
+        if urgent:
+            task_runner.run_urgent(task_id)
 
         task_runner.execute_pending_tasks_threading()
 
         return QueueTaskResponse(task_id=task_id)
 
     @app.post("/agent-scheduler/v1/queue/img2img", response_model=QueueTaskResponse, dependencies=deps)
-    def queue_img2img(body: Img2ImgApiTaskArgs):
-        task_id = str(uuid4())
+    def queue_img2img(body: Img2ImgApiTaskArgs, request: Request, tenant: str = Depends(get_tenant)):
         args = body.dict()
-        checkpoint = args.pop("checkpoint", None)
-        vae = args.pop("vae", None)
-        callback_url = args.pop("callback_url", None)
-        task = task_runner.register_api_task(
-            task_id,
-            api_task_id=None,
-            is_img2img=True,
-            args=args,
-            checkpoint=checkpoint,
-            vae=vae,
-        )
+        payload_bytes = admit_task(request, tenant, args, is_img2img=True)
+
+        try:
+            task_id = str(uuid4())
+            checkpoint = args.pop("checkpoint", None)
+            vae = args.pop("vae", None)
+            callback_url = args.pop("callback_url", None)
+            expires_at = get_expires_at(args.pop("expires_at", None), args.pop("ttl_seconds", None))
+            urgent = args.pop("urgent", False)
+            task = task_runner.register_api_task(
+                task_id,
+                api_task_id=None,
+                is_img2img=True,
+                args=args,
+                checkpoint=checkpoint,
+                vae=vae,
+                tenant=tenant,
+                expires_at=expires_at,
+            )
+        except Exception:
+            admission_controller.release(tenant, payload_bytes)
+            raise
         if callback_url:
             task.api_task_callback = callback_url
             task_manager.update_task(task)
+        if urgent:
+            task_runner.run_urgent(task_id)
 
         task_runner.execute_pending_tasks_threading()
 
@@ -171,8 +201,11 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
     @app.get("/agent-scheduler/v1/queue", response_model=QueueStatusResponse, dependencies=deps)
     def queue_status_api(limit: int = 20, offset: int = 0):
         current_task_id = progress.current_task
-        total_pending_tasks = task_manager.count_tasks(status="pending")
-        pending_tasks = task_manager.get_tasks(status=TaskStatus.PENDING, limit=limit, offset=offset)
+        # running tasks stay listed in the queue until they finish
+        queued_status = [TaskStatus.RUNNING, TaskStatus.PENDING]
+        total_pending_tasks = task_manager.count_tasks(status=queued_status)
+        pending_tasks = task_manager.get_tasks(status=queued_status, limit=limit, offset=offset)
+        schedule = {} if TaskRunner.instance.paused else eta_predictor.schedule()
         position = offset
         parsed_tasks = []
         for task in pending_tasks:
@@ -183,6 +216,7 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
                 task_data["status"] = "running"
 
             task_data["position"] = position
+            task_data["estimated_start_at"], task_data["estimated_finish_at"] = schedule.get(task.id, (None, None))
             parsed_tasks.append(TaskModel(**task_data))
             position += 1
 
@@ -193,6 +227,20 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
             paused=TaskRunner.instance.paused,
         )
 
+    @app.get("/agent-scheduler/v1/metrics", dependencies=deps)
+    def get_metrics():
+        return {"success": True, "data": metrics.snapshot()}
+
+    @app.get("/agent-scheduler/v1/tenants", dependencies=deps)
+    def get_tenants():
+        depths = task_manager.count_tasks_by_tenant(status=TaskStatus.PENDING)
+        return {"success": True, "data": fair_queue.snapshot(depths)}
+
+    @app.get("/agent-scheduler/v1/stats/timings", dependencies=deps)
+    def get_timing_stats(limit: int = 500):
+        timings = task_manager.get_task_timings(limit=limit)
+        return {"success": True, "data": aggregate_timings(timings)}
+
     @app.get("/agent-scheduler/v1/export")
     def export_queue(limit: int = 1000, offset: int = 0):
         pending_tasks = task_manager.get_tasks(status=TaskStatus.PENDING, limit=limit, offset=offset)
@@ -269,6 +317,8 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
             task_data["status"] = "running"
         if task_data["status"] == TaskStatus.PENDING:
             task_data["position"] = task_manager.get_task_position(id)
+        if task_data["status"] in (TaskStatus.PENDING, TaskStatus.RUNNING) and not TaskRunner.instance.paused:
+            task_data["estimated_start_at"], task_data["estimated_finish_at"] = eta_predictor.get(id) or (None, None)
 
         return {"success": True, "data": TaskModel(**task_data)}
 
@@ -279,7 +329,16 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
             return {"success": False, "message": "Task not found"}
 
         position = None if task.status != TaskStatus.PENDING else task_manager.get_task_position(id)
-        return {"success": True, "data": {"status": task.status, "position": position}}
+        eta = eta_predictor.get(id) if task.status == TaskStatus.PENDING and not TaskRunner.instance.paused else None
+        return {
+            "success": True,
+            "data": {
+                "status": task.status,
+                "position": position,
+                "estimated_start_at": eta[0] if eta else None,
+                "estimated_finish_at": eta[1] if eta else None,
+            },
+        }
 
     @app.put("/agent-scheduler/v1/task/{id}", dependencies=deps)
     def update_task(id: str, body: UpdateTaskArgs):
@@ -310,30 +369,24 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
     @app.post("/agent-scheduler/v1/run/{id}", dependencies=deps, deprecated=True)
     @app.post("/agent-scheduler/v1/task/{id}/run", dependencies=deps)
     def run_task(id: str):
-        if progress.current_task is not None:
-            if progress.current_task == id:
-                return {"success": False, "message": "Task is running"}
-            else:
-                # move task up in queue
-                task_manager.prioritize_task(id, 0)
-                return {
-                    "success": True,
-                    "message": "Task is scheduled to run next",
-                }
-        else:
-            # run task
-            task = task_manager.get_task(id)
-            current_thread = threading.Thread(
-                target=TaskRunner.instance.execute_task,
-                args=(
-                    task,
-                    lambda: None,
-                ),
-            )
-            current_thread.daemon = True
-            current_thread.start()
+        if progress.current_task == id:
+            return {"success": False, "message": "Task is running"}
+
+        task = task_manager.get_task(id)
+        if task is None or task.status != TaskStatus.PENDING:
+            return {"success": False, "message": "Task is not pending"}
+
+        # move task up in queue, the running task may be preempted, and wake the runner loop
+        preempted = TaskRunner.instance.run_urgent(id)
+        if TaskRunner.instance.paused:
+            return {"success": True, "message": "Queue is paused, task will run first when it resumes"}
 
-            return {"success": True, "message": "Task is executing"}
+        TaskRunner.instance.execute_pending_tasks_threading()
+        if preempted:
+            return {"success": True, "message": "Running task is preempted, task will run next"}
+        if progress.current_task is not None:
+            return {"success": True, "message": "Task is scheduled to run next"}
+        return {"success": True, "message": "Task is executing"}
 
     @app.post("/agent-scheduler/v1/requeue/{id}", dependencies=deps, deprecated=True)
     @app.post("/agent-scheduler/v1/task/{id}/requeue", dependencies=deps)
@@ -369,9 +422,11 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
     @app.post("/agent-scheduler/v1/delete/{id}", dependencies=deps, deprecated=True)
     @app.delete("/agent-scheduler/v1/task/{id}", dependencies=deps)
     def delete_task(id: str):
+        interrupted = task_runner.interrupt_task(id)
         if progress.current_task == id:
             shared.state.interrupt()
-            task_runner.interrupted = id
+            interrupted = True
+        if interrupted:
             return {"success": True, "message": "Task interrupted"}
 
         task_manager.delete_task(id)
@@ -472,7 +527,7 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
         else:
             data = [
                 {
-                    "image": encode_image_to_base64(Image.open(image)),
+                    "image": encode_image_file_to_base64(image),
                     "infotext": infotexts[i],
                 }
                 for i, image in enumerate(result["images"])
@@ -511,3 +566,5 @@ def regsiter_apis(app: App, task_runner: TaskRunner):
         return {"success": True, "message": "History cleared."}
 
     task_runner.on_task_finished(on_task_finished)
+    # deliver the callbacks left pending before a restart
+    callback_dispatcher.start()
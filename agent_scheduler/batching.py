@@ -0,0 +1,96 @@
+import json
+import random
+import hashlib
+from copy import deepcopy
+from typing import Any, Dict, List, Optional
+
+from .db import Task
+
+# args that may differ between tasks merged into one batch
+batch_varying_args = ("prompt", "seed")
+
+
+def get_batch_key(task: Task) -> Optional[str]:
+    """Return a key shared by all txt2img API tasks that can run in the same batch,
+    or None if the task can not be batched"""
+
+    if task.type != "txt2img":
+        return None
+
+    params: Dict = json.loads(task.params)
+    # tasks retried after running out of memory, or after a batch that could not be split, are generated alone
+    if params.get("is_ui", True) or params.get("oom_retries", 0) > 0 or params.get("unbatched", False):
+        return None
+
+    args: Dict = params.get("args", {})
+    if (args.get("batch_size", None) or 1) != 1 or (args.get("n_iter", None) or 1) != 1:
+        return None
+
+    if args.get("script_name", None):
+        return None
+
+    shared_args = {k: v for k, v in args.items() if k not in batch_varying_args}
+    key = hashlib.sha1(json.dumps(shared_args, sort_keys=True, default=str).encode())
+    key.update((params.get("checkpoint", None) or "").encode())
+    key.update(task.script_params or b"")
+    key.update(task.image_params or b"")
+
+    return key.hexdigest()
+
+
+def get_fixed_seed(seed: Any) -> int:
+    # same as modules.processing.get_fixed_seed
+    if seed is None or seed == "" or seed == -1:
+        return int(random.randrange(4294967294))
+
+    return int(seed)
+
+
+def get_batch_overrides(tasks: List[Task]) -> Dict:
+    """Build the per-image args of a single batched generation, in task order"""
+
+    prompts = []
+    seeds = []
+    for task in tasks:
+        args: Dict = json.loads(task.params).get("args", {})
+        prompts.append(args.get("prompt", ""))
+        seeds.append(get_fixed_seed(args.get("seed", -1)))
+
+    return {"prompt": prompts, "seed": seeds, "batch_size": len(tasks), "n_iter": 1}
+
+
+def split_batch_geninfo(geninfo: Dict, count: int) -> List[Dict]:
+    """Split the generation info of a batch into one generation info per image"""
+
+    first = geninfo.get("index_of_first_image", 0)
+    infotexts = geninfo.get("infotexts", [])
+
+    results = []
+    for i in range(count):
+        info = deepcopy(geninfo)
+        for k, v in geninfo.items():
+            if k.startswith("all_") and isinstance(v, list) and len(v) == count:
+                info[k] = [v[i]]
+
+        info["prompt"] = info.get("all_prompts", [geninfo.get("prompt")])[0]
+        info["seed"] = info.get("all_seeds", [geninfo.get("seed")])[0]
+        info["infotexts"] = infotexts[first + i : first + i + 1]
+        info["index_of_first_image"] = 0
+        info["batch_size"] = 1
+        results.append(info)
+
+    return results
+
+
+def split_batch_images(images: List[str], count: int) -> Optional[List[List[str]]]:
+    """Split saved image paths (grids excluded) evenly between the batched tasks.
+
+    Returns None if they can not be split evenly, as it is then unknown
+    which image belongs to which task.
+    """
+
+    if len(images) % count != 0:
+        return None
+
+    size = len(images) // count
+    return [images[i * size : (i + 1) * size] for i in range(count)]
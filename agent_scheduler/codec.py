@@ -0,0 +1,308 @@
+import io
+import sys
+import zlib
+import types
+import struct
+import pickle
+from enum import Enum
+from functools import partial
+from typing import Any, List, Optional, Tuple
+
+import msgpack
+import numpy as np
+import torch
+from PIL import Image
+
+# script params written since version 1 start with this, older ones are zlib compressed pickles
+script_params_magic = b"ASP"
+script_params_version = 2
+
+# size of the chunks decompressed at once into preallocated buffers
+decompress_chunk_size = 1 << 20
+
+# encoded image args of UI tasks, stored apart from the params JSON
+image_params_magic = b"AIP"
+image_params_version = 1
+
+ext_ndarray = 1
+ext_tensor = 2
+ext_image = 3
+ext_tuple = 4
+ext_object = 5
+
+# globals a legacy script params pickle may reference
+legacy_pickle_globals = {
+    *(("builtins", name) for name in ("list", "dict", "tuple", "set", "frozenset", "bytearray", "complex", "slice")),
+    ("collections", "OrderedDict"),
+    ("_codecs", "encode"),
+    ("numpy", "ndarray"),
+    ("numpy", "dtype"),
+    ("numpy.core.multiarray", "_reconstruct"),
+    ("numpy.core.multiarray", "scalar"),
+    ("numpy._core.multiarray", "_reconstruct"),
+    ("numpy._core.multiarray", "scalar"),
+    ("torch._utils", "_rebuild_tensor_v2"),
+    ("torch._utils", "_rebuild_tensor_v3"),
+    ("torch", "Size"),
+}
+
+
+def pack_script_args(script_args: List) -> bytes:
+    """Serialize script args to the current script params format.
+
+    Args are packed with msgpack, with extension types for arrays, tensors,
+    images and tuples. The extensions only hold the headers, their pixels
+    follow the args in the same compressed stream, in the order they are
+    packed, and are compressed from the array memory without intermediate
+    copies. Plain objects are stored as their attributes and read back as
+    dicts, other objects raise a TypeError.
+    """
+
+    buffers: List[memoryview] = []
+    args = _pack(script_args, buffers)
+
+    compressor = zlib.compressobj()
+    chunks = [
+        script_params_magic + bytes([script_params_version]),
+        compressor.compress(struct.pack("<I", len(args))),
+        compressor.compress(args),
+    ]
+    chunks.extend(compressor.compress(buffer) for buffer in buffers)
+    chunks.append(compressor.flush())
+    return b"".join(chunks)
+
+
+def unpack_script_args(data: bytes) -> List:
+    """Deserialize script params, in the current format or the older ones.
+
+    Arrays, tensors and images are decompressed straight into their own
+    writable memory, which is shared with the tensors and the images of
+    the modes PIL can map.
+    """
+
+    if not data:
+        return []
+
+    if data[: len(script_params_magic)] != script_params_magic:
+        return LegacyScriptArgsUnpickler(io.BytesIO(zlib.decompress(data))).load()
+
+    version = data[len(script_params_magic)]
+    payload = memoryview(data)[len(script_params_magic) + 1 :]
+    if version == 1:
+        return _unpack(zlib.decompress(payload))
+    if version != script_params_version:
+        raise ValueError(f"Unsupported script params version {version}")
+
+    reader = DecompressReader(payload)
+    (args_size,) = struct.unpack("<I", reader.read(4))
+    return _unpack(reader.read(args_size), reader)
+
+
+def decompress_into(data: bytes, buffer) -> None:
+    """Decompress zlib `data` into the writable `buffer`, which must be its exact size"""
+
+    reader = DecompressReader(data)
+    reader.readinto(buffer)
+    if not reader.at_end():
+        raise ValueError("Compressed data is larger than the buffer")
+
+
+def writable_bytes(array: np.ndarray) -> memoryview:
+    """Flat byte view of a C-contiguous array, also for empty and 0-d arrays"""
+
+    return memoryview(array.reshape(-1).view(np.uint8))
+
+
+class DecompressReader:
+    """Read a zlib stream into preallocated buffers, a bounded chunk at a time"""
+
+    def __init__(self, data: bytes):
+        self.__decompressor = zlib.decompressobj()
+        self.__input = memoryview(data)
+
+    def at_end(self) -> bool:
+        """Whether the whole stream was read, decompresses one more byte to find out"""
+
+        if not self.__decompressor.eof:
+            if len(self.__decompressor.decompress(self.__input, 1)) > 0:
+                return False
+            self.__input = self.__decompressor.unconsumed_tail
+        return self.__decompressor.eof
+
+    def read(self, size: int) -> bytes:
+        buffer = bytearray(size)
+        self.readinto(buffer)
+        return bytes(buffer)
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        position = 0
+        while position < len(view):
+            chunk = self.__decompressor.decompress(self.__input, min(len(view) - position, decompress_chunk_size))
+            self.__input = self.__decompressor.unconsumed_tail
+            if len(chunk) == 0:
+                raise ValueError("Compressed data is truncated")
+
+            view[position : position + len(chunk)] = chunk
+            position += len(chunk)
+
+        return position
+
+
+def pack_image_params(images: List[bytes]) -> bytes:
+    """Serialize the encoded image args of a task, referenced by index from its params"""
+
+    return image_params_magic + bytes([image_params_version]) + msgpack.packb(images, use_bin_type=True)
+
+
+def unpack_image_params(data: bytes) -> List[bytes]:
+    if not data:
+        return []
+
+    if data[: len(image_params_magic)] != image_params_magic:
+        raise ValueError("Invalid image params")
+
+    version = data[len(image_params_magic)]
+    if version != image_params_version:
+        raise ValueError(f"Unsupported image params version {version}")
+
+    return msgpack.unpackb(memoryview(data)[len(image_params_magic) + 1 :], raw=False)
+
+
+def _pack(obj: Any, buffers: List[memoryview]) -> bytes:
+    return msgpack.packb(obj, default=partial(_pack_ext, buffers=buffers), use_bin_type=True, strict_types=True)
+
+
+def _unpack(payload: bytes, reader: Optional[DecompressReader] = None) -> Any:
+    """Unpack args, `reader` reads the extension pixels, which are inline in version 1"""
+
+    ext_hook = partial(_unpack_ext, reader=reader)
+    return msgpack.unpackb(payload, ext_hook=ext_hook, raw=False, strict_map_key=False)
+
+
+def _unpack_buffer(data: bytes) -> Tuple[List, int]:
+    """Split a version 1 extension into its header and the offset of its inline pixels"""
+
+    (header_size,) = struct.unpack_from("<I", data)
+    header = msgpack.unpackb(memoryview(data)[4 : 4 + header_size], raw=False)
+    return (header, 4 + header_size)
+
+
+def _pack_array(array: np.ndarray, buffers: List[memoryview], extra: List = []) -> bytes:
+    if array.dtype.hasobject:
+        raise TypeError("Script arg arrays of objects can not be serialized")
+
+    shape = list(array.shape)
+    buffers.append(writable_bytes(np.ascontiguousarray(array)))
+    return msgpack.packb([array.dtype.str, shape, *extra], use_bin_type=True)
+
+
+def _unpack_array(data: bytes, reader: Optional[DecompressReader]) -> Tuple[np.ndarray, List]:
+    if reader is None:
+        header, offset = _unpack_buffer(data)
+        dtype, shape, *extra = header
+        array = np.frombuffer(data, dtype=np.dtype(dtype), offset=offset)
+        return (array.reshape(shape), extra)
+
+    dtype, shape, *extra = msgpack.unpackb(data, raw=False)
+    array = np.empty(shape, dtype=np.dtype(dtype))
+    reader.readinto(writable_bytes(array))
+    return (array, extra)
+
+
+def _pack_ext(obj: Any, buffers: List[memoryview]):
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, np.ndarray):
+        return msgpack.ExtType(ext_ndarray, _pack_array(obj, buffers))
+    if isinstance(obj, torch.Tensor):
+        return msgpack.ExtType(ext_tensor, _pack_array(obj.detach().cpu().numpy(), buffers, [obj.device.type]))
+    if isinstance(obj, Image.Image):
+        info = {k: v for k, v in obj.info.items() if isinstance(v, (str, int, float))}
+        palette = obj.getpalette() if obj.mode in ("P", "PA") else None
+        data = obj.tobytes()
+        buffers.append(memoryview(data))
+        header = [obj.mode, list(obj.size), info, palette, len(data)]
+        return msgpack.ExtType(ext_image, msgpack.packb(header, use_bin_type=True))
+    if isinstance(obj, tuple):
+        return msgpack.ExtType(ext_tuple, _pack(list(obj), buffers))
+    if isinstance(obj, np.generic):
+        return obj.item()
+
+    # subclasses of native types
+    for native in (bool, int, float, str, bytes, list, dict):
+        if isinstance(obj, native):
+            return native(obj)
+    if isinstance(obj, (bytearray, memoryview)):
+        return bytes(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+
+    # plain objects (eg: dataclasses of extensions) are stored as their class and attributes,
+    # and read back as a dict of their attributes
+    state = getattr(obj, "__dict__", None)
+    if isinstance(state, dict) and not isinstance(obj, (type, types.ModuleType, types.FunctionType, types.MethodType)):
+        cls = type(obj)
+        return msgpack.ExtType(ext_object, _pack([cls.__module__, cls.__qualname__, state], buffers))
+
+    raise TypeError(f"Script arg of type {type(obj).__name__} can not be serialized")
+
+
+def _unpack_ext(code: int, data: bytes, reader: Optional[DecompressReader]):
+    if code == ext_ndarray:
+        array, _ = _unpack_array(data, reader)
+        return array
+    if code == ext_tensor:
+        array, (device,) = _unpack_array(data, reader)
+        return torch.from_numpy(array).to(device=device)
+    if code == ext_image:
+        if reader is None:
+            (mode, size, info, palette), offset = _unpack_buffer(data)
+            image = Image.frombytes(mode, tuple(size), memoryview(data)[offset:])
+        else:
+            mode, size, info, palette, nbytes = msgpack.unpackb(data, raw=False)
+            pixels = bytearray(nbytes)
+            reader.readinto(pixels)
+            # maps the pixels without a copy for most modes, PIL copies them before a write
+            image = Image.frombuffer(mode, tuple(size), pixels, "raw", mode, 0, 1)
+        if palette is not None:
+            image.putpalette(palette)
+        image.info.update(info)
+        return image
+    if code == ext_tuple:
+        return tuple(_unpack(data, reader))
+    if code == ext_object:
+        # only the attributes are restored, the class is never looked up or instantiated
+        _module, _qualname, state = _unpack(data, reader)
+        return state
+
+    raise ValueError(f"Unknown script params extension type {code}")
+
+
+def _load_storage_from_bytes(data: bytes):
+    return torch.load(io.BytesIO(data), weights_only=True)
+
+
+class LegacyScriptArgsUnpickler(pickle.Unpickler):
+    """Unpickler of legacy script params, restricted to the types script args are made of.
+
+    Besides the allowed globals, it only loads enums and PIL image classes
+    from modules that are already imported, so a crafted row can neither
+    call arbitrary functions nor import modules.
+    """
+
+    def find_class(self, module: str, name: str):
+        if (module, name) == ("torch.storage", "_load_from_bytes"):
+            return _load_storage_from_bytes
+        if (module, name) in legacy_pickle_globals:
+            return super().find_class(module, name)
+
+        obj = getattr(sys.modules.get(module, None), name, None)
+        if isinstance(obj, torch.dtype):
+            return obj
+        if isinstance(obj, type) and (
+            issubclass(obj, Enum) or (module.startswith("PIL.") and issubclass(obj, Image.Image))
+        ):
+            return obj
+
+        raise pickle.UnpicklingError(f"Script params can not load {module}.{name}")
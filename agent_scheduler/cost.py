@@ -0,0 +1,94 @@
+import json
+import time
+import threading
+from typing import Dict, List, Tuple
+
+from .db import Task, task_manager
+from .helpers import log
+
+
+def get_task_work(params: Dict, is_img2img: bool = False) -> float:
+    """Estimate the work of a task in megapixel-steps, from its generation args"""
+
+    args: Dict = params.get("args", {})
+    width = int(args.get("width", None) or 512)
+    height = int(args.get("height", None) or 512)
+    steps = int(args.get("steps", None) or 20)
+    count = int(args.get("batch_size", None) or 1) * int(args.get("n_iter", None) or 1)
+
+    if is_img2img:
+        # img2img only runs the denoised part of the schedule
+        steps = max(1, int(steps * float(args.get("denoising_strength", None) or 0.75)))
+
+    work = width * height / 1e6 * steps
+    if args.get("enable_hr", False):
+        scale = float(args.get("hr_scale", None) or 2)
+        hr_width = int(args.get("hr_resize_x", None) or width * scale)
+        hr_height = int(args.get("hr_resize_y", None) or height * scale)
+        hr_steps = int(args.get("hr_second_pass_steps", None) or steps)
+        work += hr_width * hr_height / 1e6 * hr_steps * float(args.get("denoising_strength", None) or 0.7)
+
+    return work * count
+
+
+class CostModel:
+    """Predict the generation time of a task as `overhead + seconds_per_work * work`.
+
+    Both coefficients are fitted by least squares on the generation time of the
+    latest done tasks, refreshed every `refresh_interval` seconds. Until enough
+    history exists, defaults close to a mid-range GPU are used.
+    """
+
+    def __init__(self, history: int = 500, refresh_interval: float = 300, min_samples: int = 10):
+        self.history = history
+        self.refresh_interval = refresh_interval
+        self.min_samples = min_samples
+        self.overhead = 1.0
+        self.seconds_per_work = 0.05
+
+        self.__lock = threading.Lock()
+        self.__refreshed_at = 0.0
+
+    def estimate(self, task: Task) -> float:
+        self.refresh()
+        work = get_task_work(json.loads(task.params), task.type == "img2img")
+        return self.overhead + self.seconds_per_work * work
+
+    def refresh(self, force: bool = False):
+        with self.__lock:
+            if not force and time.monotonic() - self.__refreshed_at < self.refresh_interval:
+                return
+            self.__refreshed_at = time.monotonic()
+
+        try:
+            samples = [
+                (get_task_work(json.loads(params), type == "img2img"), seconds)
+                for type, params, seconds in task_manager.get_task_durations(limit=self.history)
+            ]
+            self.fit(samples)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to refresh the task cost model: {e}")
+
+    def fit(self, samples: List[Tuple[float, float]]):
+        if len(samples) < self.min_samples:
+            return
+
+        n = len(samples)
+        mean_work = sum(w for w, _ in samples) / n
+        mean_seconds = sum(s for _, s in samples) / n
+        var = sum((w - mean_work) ** 2 for w, _ in samples)
+        if var <= 0:
+            return
+
+        slope = sum((w - mean_work) * (s - mean_seconds) for w, s in samples) / var
+        overhead = mean_seconds - slope * mean_work
+        if slope <= 0 or overhead < 0:
+            # degenerate history, fit through the origin instead
+            slope = sum(w * s for w, s in samples) / sum(w * w for w, _ in samples)
+            overhead = 0.0
+
+        self.seconds_per_work, self.overhead = slope, overhead
+        log.debug(f"[AgentScheduler] Task cost model: {overhead:.2f}s + {slope:.4f}s per megapixel-step")
+
+
+cost_model = CostModel()
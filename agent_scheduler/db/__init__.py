@@ -3,13 +3,17 @@ from sqlalchemy import create_engine, inspect, text, String, Text
 
 from .base import Base, metadata, database_url, database_schema
 from .app_state import AppStateKey, AppState, AppStateManager
-from .task import TaskStatus, Task, TaskManager
+from .task import TaskStatus, Task, TaskManager, default_tenant, tenant_max_length
+from .task_buffer import TaskWriteBuffer
+from .callback import CallbackStatus, Callback, CallbackManager
 from .model_usage_view import ModelUsageView
 
 version = "2"
 
 state_manager = AppStateManager()
 task_manager = TaskManager()
+task_buffer = TaskWriteBuffer(task_manager)
+callback_manager = CallbackManager()
 
 
 def init():
@@ -54,6 +58,40 @@ def init():
                 text("ALTER TABLE task ADD COLUMN bookmarked BOOLEAN DEFAULT FALSE")
             )
 
+        # add timings column
+        if not any(col["name"] == "timings" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN timings TEXT"))
+
+        # add tenant column
+        if not any(col["name"] == "tenant" for col in task_columns):
+            conn.execute(text(f"ALTER TABLE task ADD COLUMN tenant VARCHAR(64) DEFAULT '{default_tenant}'"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_task_tenant ON task (tenant)"))
+
+        # add expires_at column
+        if not any(col["name"] == "expires_at" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN expires_at TIMESTAMPTZ"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_task_status_expires_at ON task (status, expires_at)"))
+
+        # add result_key column
+        if not any(col["name"] == "result_key" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN result_key VARCHAR(64)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_task_result_key ON task (result_key)"))
+
+        # add attempts, abandoned and lease_expires_at columns
+        if not any(col["name"] == "attempts" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0"))
+        if not any(col["name"] == "abandoned" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN abandoned INTEGER NOT NULL DEFAULT 0"))
+        if not any(col["name"] == "lease_expires_at" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN lease_expires_at TIMESTAMPTZ"))
+            conn.execute(
+                text("CREATE INDEX IF NOT EXISTS ix_task_status_lease_expires_at ON task (status, lease_expires_at)")
+            )
+
+        # add image_params column
+        if not any(col["name"] == "image_params" for col in task_columns):
+            conn.execute(text("ALTER TABLE task ADD COLUMN image_params BYTEA"))
+
         params_column = next(
             col for col in task_columns if col["name"] == "params")
         if version > "1" and not isinstance(params_column["type"], Text):
@@ -97,6 +135,13 @@ __all__ = [
     "AppState",
     "TaskStatus",
     "Task",
+    "default_tenant",
+    "tenant_max_length",
     "task_manager",
+    "task_buffer",
+    "CallbackStatus",
+    "Callback",
+    "CallbackManager",
+    "callback_manager",
     "state_manager",
 ]
@@ -0,0 +1,176 @@
+import json
+from enum import Enum
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional
+
+from sqlalchemy import Column, String, Text, BigInteger, Integer, Index, func
+from sqlalchemy.orm import Session
+
+from .base import BaseTableManager, Base
+from .task import DateTime
+
+
+class CallbackStatus(str, Enum):
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    FAILED = "failed"
+
+
+class Callback:
+    def __init__(
+        self,
+        task_id: str,
+        url: str,
+        payload: Dict,
+        id: int = None,
+        status: str = CallbackStatus.PENDING,
+        attempts: int = 0,
+        last_error: str = None,
+        next_attempt_at: datetime = None,
+        created_at: datetime = None,
+    ):
+        self.id = id
+        self.task_id = task_id
+        self.url = url
+        self.payload = payload
+        self.status = status
+        self.attempts = attempts
+        self.last_error = last_error
+        self.next_attempt_at = next_attempt_at
+        self.created_at = created_at
+
+    @staticmethod
+    def from_table(table: "CallbackTable"):
+        return Callback(
+            id=table.id,
+            task_id=table.task_id,
+            url=table.url,
+            payload=json.loads(table.payload),
+            status=table.status,
+            attempts=table.attempts,
+            last_error=table.last_error,
+            next_attempt_at=table.next_attempt_at,
+            created_at=table.created_at,
+        )
+
+
+class CallbackTable(Base):
+    """Outbox of task callbacks waiting to be delivered"""
+
+    __tablename__ = "callback_outbox"
+
+    id = Column(BigInteger, primary_key=True, autoincrement=True)
+    task_id = Column(String(64), nullable=False)
+    url = Column(String(255), nullable=False)
+    payload = Column(Text, nullable=False)  # form data and image paths, in JSON format
+    status = Column(String(20), nullable=False, default=CallbackStatus.PENDING)
+    attempts = Column(Integer, nullable=False, default=0)
+    last_error = Column(Text, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=False, server_default=func.now())
+    created_at = Column(DateTime, nullable=False, server_default=func.now())
+    delivered_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (Index("ix_callback_outbox_status_next_attempt_at", "status", "next_attempt_at"),)
+
+    def __repr__(self):
+        return f"Callback(id={self.id!r}, task_id={self.task_id!r}, url={self.url!r}, status={self.status!r})"
+
+
+class CallbackManager(BaseTableManager):
+    def add_callback(self, task_id: str, url: str, payload: Dict) -> int:
+        session = Session(self.engine)
+        try:
+            row = CallbackTable(
+                task_id=task_id,
+                url=url,
+                payload=json.dumps(payload),
+                next_attempt_at=datetime.now(timezone.utc),
+            )
+            session.add(row)
+            session.commit()
+            return row.id
+        except Exception as e:
+            print(f"Exception adding callback to database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def claim_callbacks(self, limit: int, lease: timedelta) -> List[Callback]:
+        """Claim due pending callbacks for `lease`, after which they are due again if not delivered"""
+
+        session = Session(self.engine)
+        try:
+            now = datetime.now(timezone.utc)
+            rows = (
+                session.query(CallbackTable)
+                .filter(CallbackTable.status == CallbackStatus.PENDING)
+                .filter(CallbackTable.next_attempt_at <= now)
+                .order_by(CallbackTable.next_attempt_at.asc())
+                .limit(limit)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            for row in rows:
+                row.next_attempt_at = now + lease
+            session.commit()
+
+            return [Callback.from_table(row) for row in rows]
+        except Exception as e:
+            print(f"Exception claiming callbacks from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def update_callback(
+        self,
+        id: int,
+        status: str,
+        attempts: int = None,
+        next_attempt_at: datetime = None,
+        last_error: Optional[str] = None,
+    ):
+        session = Session(self.engine)
+        try:
+            values = {CallbackTable.status: status, CallbackTable.last_error: last_error}
+            if attempts is not None:
+                values[CallbackTable.attempts] = attempts
+            if next_attempt_at is not None:
+                values[CallbackTable.next_attempt_at] = next_attempt_at
+            if status == CallbackStatus.DELIVERED:
+                values[CallbackTable.delivered_at] = datetime.now(timezone.utc)
+
+            session.query(CallbackTable).filter(CallbackTable.id == id).update(values, synchronize_session=False)
+            session.commit()
+        except Exception as e:
+            print(f"Exception updating callback in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def count_callbacks(self, status: str = CallbackStatus.PENDING) -> int:
+        session = Session(self.engine)
+        try:
+            return session.query(CallbackTable).filter(CallbackTable.status == status).count()
+        except Exception as e:
+            print(f"Exception counting callbacks from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def delete_callbacks(self, before: datetime, status: List[str] = [CallbackStatus.DELIVERED, CallbackStatus.FAILED]):
+        session = Session(self.engine)
+        try:
+            deleted_rows = (
+                session.query(CallbackTable)
+                .filter(CallbackTable.created_at < before)
+                .filter(CallbackTable.status.in_(status))
+                .delete(synchronize_session=False)
+            )
+            session.commit()
+
+            return deleted_rows
+        except Exception as e:
+            print(f"Exception deleting callbacks from database: {e}")
+            raise e
+        finally:
+            session.close()
@@ -1,8 +1,8 @@
 import json
 import base64
 from enum import Enum
-from datetime import datetime, timezone
-from typing import Optional, Union, List, Dict
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Union, List, Dict, Tuple
 
 from sqlalchemy import (
     TypeDecorator,
@@ -11,10 +11,12 @@ from sqlalchemy import (
     String,
     Text,
     BigInteger,
+    Integer,
     Float,
     DateTime as DateTimeImpl,
     LargeBinary,
     Boolean,
+    Index,
     text,
     func,
 )
@@ -40,25 +42,37 @@ class DateTime(TypeDecorator):
         return value.astimezone(timezone.utc)
 
 
+# tenant of tasks submitted without one, and of tasks created before fair queuing
+default_tenant = "default"
+# length of the tenant column
+tenant_max_length = 64
+
+
 class TaskStatus(str, Enum):
     PENDING = "pending"
     RUNNING = "running"
     DONE = "done"
     FAILED = "failed"
     INTERRUPTED = "interrupted"
+    EXPIRED = "expired"
 
 
 class Task(TaskModel):
     script_params: bytes = None
+    image_params: bytes = None
     params: str
 
     def __init__(self, **kwargs):
         priority = kwargs.pop("priority", int(datetime.now(timezone.utc).timestamp() * 1000))
         worker_id = kwargs.pop("worker_id", env_worker_id)
-        super().__init__(priority=priority, worker_id=worker_id, **kwargs)
+        tenant = kwargs.pop("tenant", None) or default_tenant
+        super().__init__(priority=priority, worker_id=worker_id, tenant=tenant, **kwargs)
 
     class Config(TaskModel.__config__):
-        exclude = ["script_params"]
+        exclude = ["script_params", "image_params"]
+
+    def is_expired(self, now: datetime = None) -> bool:
+        return self.expires_at is not None and self.expires_at <= (now or datetime.now(timezone.utc))
 
     @staticmethod
     def from_table(table: "TaskTable"):
@@ -70,6 +84,7 @@ class Task(TaskModel):
             type=table.type,
             params=table.params,
             script_params=table.script_params,
+            image_params=table.image_params,
             priority=table.priority,
             # TODO: check if worker_id should be migrated
             worker_id=table.worker_id,
@@ -81,6 +96,11 @@ class Task(TaskModel):
             updated_at=table.updated_at,
             started_at=table.started_at,
             finished_at=table.finished_at,
+            tenant=table.tenant,
+            expires_at=table.expires_at,
+            result_key=table.result_key,
+            timings=json.loads(table.timings) if table.timings else None,
+            attempts=table.attempts or 0,
         )
 
     def to_table(self):
@@ -92,6 +112,7 @@ class Task(TaskModel):
             type=self.type,
             params=self.params,
             script_params=self.script_params,
+            image_params=self.image_params,
             priority=self.priority,
             worker_id=self.worker_id,
             status=self.status,
@@ -100,6 +121,11 @@ class Task(TaskModel):
             bookmarked=self.bookmarked,
             started_at=self.started_at,
             finished_at=self.finished_at,
+            tenant=self.tenant,
+            expires_at=self.expires_at,
+            result_key=self.result_key,
+            timings=json.dumps(self.timings) if self.timings else None,
+            attempts=self.attempts or 0,
         )
 
     def from_json(json_obj: Dict):
@@ -112,6 +138,7 @@ class Task(TaskModel):
             status=json_obj.get("status", TaskStatus.PENDING),
             params=json.dumps(json_obj.get("params")),
             script_params=base64.b64decode(json_obj.get("script_params")),
+            image_params=base64.b64decode(json_obj["image_params"]) if json_obj.get("image_params") else None,
             priority=json_obj.get("priority", int(datetime.now(timezone.utc).timestamp() * 1000)),
             ack_tag=json_obj.get("ack_tag", None),
             worker_id=json_obj.get("worker_id", None),
@@ -122,7 +149,10 @@ class Task(TaskModel):
             started_at=datetime.fromtimestamp(json_obj.get("started_at", None)),
             finished_at=datetime.fromtimestamp(json_obj.get("finished_at", None)),
             generated_time_seconds=json_obj.get("generated_time_seconds", None),
-            queue_wait_seconds=json_obj.get("queue_wait_seconds", None)
+            queue_wait_seconds=json_obj.get("queue_wait_seconds", None),
+            tenant=json_obj.get("tenant", None),
+            expires_at=datetime.fromtimestamp(json_obj["expires_at"], timezone.utc) if json_obj.get("expires_at") else None,
+            timings=json_obj.get("timings", None),
         )
 
     def to_json(self):
@@ -135,6 +165,7 @@ class Task(TaskModel):
             "status": self.status,
             "params": json.loads(self.params),
             "script_params": base64.b64encode(self.script_params).decode("utf-8"),
+            "image_params": base64.b64encode(self.image_params).decode("utf-8") if self.image_params else None,
             "priority": self.priority,
             "worker_id": self.worker_id,
             "result": self.result,
@@ -146,6 +177,10 @@ class Task(TaskModel):
             "finished_at": int(self.finished_at.timestamp()) if self.finished_at else None,
             "generated_time_seconds": self.generation_time_seconds,
             "queue_wait_seconds": self.queue_wait_seconds,
+            "tenant": self.tenant,
+            "expires_at": int(self.expires_at.timestamp()) if self.expires_at else None,
+            "timings": self.timings,
+            "attempts": self.attempts,
         }
 
 
@@ -159,6 +194,7 @@ class TaskTable(Base):
     type = Column(String(20), nullable=False)  # txt2img or img2txt
     params = Column(Text, nullable=False)  # task args
     script_params = Column(LargeBinary, nullable=False)  # script args
+    image_params = Column(LargeBinary, nullable=True)  # encoded image args, referenced from params
     priority = Column(BigInteger, nullable=False)
     worker_id = Column(String(64), nullable=False)
     status = Column(String(20), nullable=False, default="pending")  # pending, running, done, failed
@@ -180,6 +216,19 @@ class TaskTable(Base):
     finished_at = Column(DateTime, nullable=True)
     generation_time_seconds = Column(Float, Computed("EXTRACT(EPOCH FROM (finished_at - started_at))"))
     queue_wait_seconds = Column(Float, Computed("EXTRACT(EPOCH FROM (started_at - created_at))"))
+    timings = Column(Text, nullable=True)  # seconds spent in each phase, in JSON format
+    tenant = Column(String(tenant_max_length), nullable=True, default=default_tenant, index=True)  # who submitted the task
+    expires_at = Column(DateTime, nullable=True)  # pending tasks are dropped after this time
+    result_key = Column(String(64), nullable=True, index=True)  # hash of the resolved params, see result_cache
+    attempts = Column(Integer, nullable=False, default=0)  # times the task was claimed to run
+    # times the lease of the task expired, only set by the reaper so requeues by the runner don't count
+    abandoned = Column(Integer, nullable=False, default=0)
+    lease_expires_at = Column(DateTime, nullable=True)  # running tasks go back to pending after this time
+
+    __table_args__ = (
+        Index("ix_task_status_expires_at", "status", "expires_at"),
+        Index("ix_task_status_lease_expires_at", "status", "lease_expires_at"),
+    )
 
     def __repr__(self):
         return f"Task(id={self.id!r}, type={self.type!r}, params={self.params!r}, status={self.status!r}, created_at={self.created_at!r})"
@@ -223,6 +272,7 @@ class TaskManager(BaseTableManager):
         status: Union[str, List[str]] = None,
         bookmarked: bool = None,
         api_task_id: str = None,
+        tenant: str = None,
         limit: int = None,
         offset: int = None,
         order: str = "asc",
@@ -244,6 +294,9 @@ class TaskManager(BaseTableManager):
             if api_task_id:
                 query = query.filter(TaskTable.api_task_id == api_task_id)
 
+            if tenant:
+                query = query.filter(TaskTable.tenant == tenant)
+
             if bookmarked == True:
                 query = query.filter(TaskTable.bookmarked == bookmarked)
             else:
@@ -293,6 +346,45 @@ class TaskManager(BaseTableManager):
         finally:
             session.close()
 
+    def count_tasks_by_tenant(self, status: str = TaskStatus.PENDING) -> Dict[str, int]:
+        session = Session(self.engine)
+        try:
+            rows = (
+                session.query(TaskTable.tenant, func.count(TaskTable.id))
+                .filter(TaskTable.status == status)
+                .group_by(TaskTable.tenant)
+                .all()
+            )
+            return {(tenant or default_tenant): count for tenant, count in rows}
+        except Exception as e:
+            print(f"Exception counting tasks by tenant from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_pending_usage(self) -> Dict[str, Tuple[int, int]]:
+        """Get the (pending tasks, pending payload bytes) of each tenant"""
+
+        session = Session(self.engine)
+        try:
+            payload_bytes = (
+                func.octet_length(TaskTable.params)
+                + func.octet_length(TaskTable.script_params)
+                + func.coalesce(func.octet_length(TaskTable.image_params), 0)
+            )
+            rows = (
+                session.query(TaskTable.tenant, func.count(TaskTable.id), func.sum(payload_bytes))
+                .filter(TaskTable.status == TaskStatus.PENDING)
+                .group_by(TaskTable.tenant)
+                .all()
+            )
+            return {(tenant or default_tenant): (count, int(size or 0)) for tenant, count, size in rows}
+        except Exception as e:
+            print(f"Exception getting pending usage from database: {e}")
+            raise e
+        finally:
+            session.close()
+
     def add_task(self, task: Task) -> TaskTable:
         session = Session(self.engine)
         try:
@@ -315,6 +407,29 @@ class TaskManager(BaseTableManager):
             session.close()
             return False
 
+    def add_tasks(self, tasks: List[Task]) -> List[bool]:
+        """Insert multiple tasks in a single transaction.
+
+        Falls back to add_task row by row if the batch insert fails, so conflicting
+        ids keep the same idempotent behaviour as single inserts.
+        """
+
+        if len(tasks) == 0:
+            return []
+
+        session = Session(self.engine)
+        try:
+            session.add_all([task.to_table() for task in tasks])
+            session.commit()
+            return [True] * len(tasks)
+        except Exception as e:
+            session.rollback()
+            print(f"Exception adding tasks to database, retrying one by one: {e}")
+        finally:
+            session.close()
+
+        return [self.add_task(task) for task in tasks]
+
     def update_task(self, task: Task) -> TaskTable:
         session = Session(self.engine)
         try:
@@ -332,6 +447,300 @@ class TaskManager(BaseTableManager):
         finally:
             session.close()
 
+    def set_task_timings(self, id: str, timings: Dict[str, float]):
+        session = Session(self.engine)
+        try:
+            session.query(TaskTable).filter(TaskTable.id == id).update(
+                {TaskTable.timings: json.dumps(timings)}, synchronize_session=False
+            )
+            session.commit()
+        except Exception as e:
+            print(f"Exception updating task timings in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def expire_tasks(self, now: datetime = None) -> int:
+        """Mark all pending tasks past their deadline as expired, returns the number of expired tasks"""
+
+        session = Session(self.engine)
+        try:
+            expired_rows = (
+                session.query(TaskTable)
+                .filter(TaskTable.status == TaskStatus.PENDING)
+                .filter(TaskTable.expires_at <= (now or datetime.now(timezone.utc)))
+                .update({TaskTable.status: TaskStatus.EXPIRED}, synchronize_session=False)
+            )
+            session.commit()
+
+            return expired_rows
+        except Exception as e:
+            print(f"Exception expiring tasks in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def claim_tasks(self, ids: List[str], lease: timedelta, started_at: datetime = None) -> Dict[str, int]:
+        """Mark pending tasks as running for `lease`, returns the attempts of each claimed task.
+
+        Tasks that are no longer pending, eg: claimed by another worker, are skipped.
+        """
+
+        session = Session(self.engine)
+        try:
+            now = datetime.now(timezone.utc)
+            rows = (
+                session.query(TaskTable)
+                .filter(TaskTable.id.in_(ids))
+                .filter(TaskTable.status == TaskStatus.PENDING)
+                .with_for_update(skip_locked=True)
+                .all()
+            )
+            claimed = {}
+            for row in rows:
+                row.status = TaskStatus.RUNNING
+                row.attempts = (row.attempts or 0) + 1
+                row.lease_expires_at = now + lease
+                row.started_at = started_at or now
+                claimed[row.id] = row.attempts
+            session.commit()
+
+            return claimed
+        except Exception as e:
+            print(f"Exception claiming tasks in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def renew_leases(self, ids: List[str], lease: timedelta) -> int:
+        """Extend the lease of running tasks, returns the number of renewed leases"""
+
+        session = Session(self.engine)
+        try:
+            renewed_rows = (
+                session.query(TaskTable)
+                .filter(TaskTable.id.in_(ids))
+                .filter(TaskTable.status == TaskStatus.RUNNING)
+                .update({TaskTable.lease_expires_at: datetime.now(timezone.utc) + lease}, synchronize_session=False)
+            )
+            session.commit()
+
+            return renewed_rows
+        except Exception as e:
+            print(f"Exception renewing task leases in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def reap_expired_leases(self, max_attempts: int, now: datetime = None) -> Tuple[int, int]:
+        """Return running tasks whose lease expired to pending, or fail them once abandoned `max_attempts` times.
+
+        Only expired leases count, tasks requeued by the runner itself (eg: out of memory
+        retries or preemption) are claimed again without using up their attempts.
+        Running tasks without a lease (set running by older versions) are left alone.
+        Returns the number of (requeued, failed) tasks.
+        """
+
+        session = Session(self.engine)
+        try:
+            now = now or datetime.now(timezone.utc)
+            expired = (
+                session.query(TaskTable)
+                .filter(TaskTable.status == TaskStatus.RUNNING)
+                .filter(TaskTable.lease_expires_at.isnot(None))
+                .filter(TaskTable.lease_expires_at <= now)
+            )
+            failed_rows = expired.filter(TaskTable.abandoned + 1 >= max_attempts).update(
+                {
+                    TaskTable.status: TaskStatus.FAILED,
+                    TaskTable.result: f"Task was abandoned by its worker {max_attempts} times",
+                    TaskTable.abandoned: TaskTable.abandoned + 1,
+                    TaskTable.lease_expires_at: None,
+                },
+                synchronize_session=False,
+            )
+            requeued_rows = expired.update(
+                {
+                    TaskTable.status: TaskStatus.PENDING,
+                    TaskTable.abandoned: TaskTable.abandoned + 1,
+                    TaskTable.lease_expires_at: None,
+                },
+                synchronize_session=False,
+            )
+            session.commit()
+
+            return (requeued_rows, failed_rows)
+        except Exception as e:
+            print(f"Exception reaping task leases in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_cached_result(self, result_key: str, since: datetime = None) -> Optional[Task]:
+        """Get the latest done task with the given result key"""
+
+        session = Session(self.engine)
+        try:
+            query = (
+                session.query(TaskTable)
+                .filter(TaskTable.result_key == result_key)
+                .filter(TaskTable.status == TaskStatus.DONE)
+            )
+            if since:
+                query = query.filter(TaskTable.finished_at >= since)
+
+            task = query.order_by(TaskTable.finished_at.desc()).first()
+            return Task.from_table(task) if task else None
+        except Exception as e:
+            print(f"Exception getting cached result from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def clear_result_key(self, result_key: str):
+        session = Session(self.engine)
+        try:
+            session.query(TaskTable).filter(TaskTable.result_key == result_key).update(
+                {TaskTable.result_key: None}, synchronize_session=False
+            )
+            session.commit()
+        except Exception as e:
+            print(f"Exception clearing result key in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def evict_result_keys(self, before: datetime, max_entries: int) -> int:
+        """Clear the result key of tasks finished before `before` or beyond the `max_entries` latest ones"""
+
+        session = Session(self.engine)
+        try:
+            latest = (
+                session.query(TaskTable.id)
+                .filter(TaskTable.result_key.isnot(None))
+                .order_by(TaskTable.finished_at.desc())
+                .limit(max_entries)
+            )
+            evicted_rows = (
+                session.query(TaskTable)
+                .filter(TaskTable.result_key.isnot(None))
+                .filter((TaskTable.finished_at < before) | TaskTable.id.notin_(latest.scalar_subquery()))
+                .update({TaskTable.result_key: None}, synchronize_session=False)
+            )
+            session.commit()
+
+            return evicted_rows
+        except Exception as e:
+            print(f"Exception evicting result keys in database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_task_durations(self, limit: int = 500) -> List[Tuple[str, str, float]]:
+        """Get the (type, params, generation_time_seconds) of the latest done tasks"""
+
+        session = Session(self.engine)
+        try:
+            rows = (
+                session.query(TaskTable.type, TaskTable.params, TaskTable.generation_time_seconds)
+                .filter(TaskTable.status == TaskStatus.DONE)
+                .filter(TaskTable.generation_time_seconds.isnot(None))
+                .order_by(TaskTable.finished_at.desc())
+                .limit(limit)
+                .all()
+            )
+            return [(row.type, row.params, row.generation_time_seconds) for row in rows]
+        except Exception as e:
+            print(f"Exception getting task durations from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_task_samples(self, since: datetime = None, limit: int = 500) -> List[Tuple[Task, float]]:
+        """Get the (task, generation_time_seconds) of the latest done tasks finished after `since`, oldest first.
+
+        Script params are not loaded.
+        """
+
+        session = Session(self.engine)
+        try:
+            query = (
+                session.query(
+                    TaskTable.id,
+                    TaskTable.type,
+                    TaskTable.params,
+                    TaskTable.priority,
+                    TaskTable.finished_at,
+                    TaskTable.generation_time_seconds,
+                    TaskTable.timings,
+                )
+                .filter(TaskTable.status == TaskStatus.DONE)
+                .filter(TaskTable.generation_time_seconds.isnot(None))
+            )
+            if since is not None:
+                query = query.filter(TaskTable.finished_at > since)
+
+            rows = query.order_by(TaskTable.finished_at.desc()).limit(limit).all()
+            return [
+                (
+                    Task(
+                        id=row.id,
+                        type=row.type,
+                        params=row.params,
+                        priority=row.priority,
+                        finished_at=row.finished_at,
+                        timings=json.loads(row.timings) if row.timings else None,
+                    ),
+                    row.generation_time_seconds,
+                )
+                for row in reversed(rows)
+            ]
+        except Exception as e:
+            print(f"Exception getting task samples from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_pending_tasks(self, limit: int = None) -> List[Task]:
+        """Get the pending tasks in queue order, without their script params"""
+
+        session = Session(self.engine)
+        try:
+            query = (
+                session.query(TaskTable.id, TaskTable.type, TaskTable.params, TaskTable.priority)
+                .filter(TaskTable.status == TaskStatus.PENDING)
+                .order_by(TaskTable.bookmarked.asc(), TaskTable.priority.asc())
+            )
+            if limit:
+                query = query.limit(limit)
+
+            return [Task(id=row.id, type=row.type, params=row.params, priority=row.priority) for row in query.all()]
+        except Exception as e:
+            print(f"Exception getting pending tasks from database: {e}")
+            raise e
+        finally:
+            session.close()
+
+    def get_task_timings(self, status: str = TaskStatus.DONE, limit: int = 500) -> List[Dict[str, float]]:
+        """Get the phase timings of the latest finished tasks"""
+
+        session = Session(self.engine)
+        try:
+            rows = (
+                session.query(TaskTable.timings)
+                .filter(TaskTable.status == status)
+                .filter(TaskTable.timings.isnot(None))
+                .order_by(TaskTable.finished_at.desc())
+                .limit(limit)
+                .all()
+            )
+            return [json.loads(row.timings) for row in rows]
+        except Exception as e:
+            print(f"Exception getting task timings from database: {e}")
+            raise e
+        finally:
+            session.close()
+
     def prioritize_task(self, id: str, priority: int) -> TaskTable:
         """0 means move to top, -1 means move to bottom, otherwise set the exact priority"""
 
@@ -380,6 +789,7 @@ class TaskManager(BaseTableManager):
             TaskStatus.DONE,
             TaskStatus.FAILED,
             TaskStatus.INTERRUPTED,
+            TaskStatus.EXPIRED,
         ],
     ):
         session = Session(self.engine)
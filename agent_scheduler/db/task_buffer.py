@@ -0,0 +1,81 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+from typing import List, Tuple
+
+from .task import Task, TaskManager
+
+
+class TaskWriteBuffer:
+    """Group-commit buffer for task registrations.
+
+    Tasks submitted to the buffer are collected by a writer thread and inserted in
+    multi-row transactions, either when `max_batch` rows are waiting or when the
+    oldest row has waited `flush_interval` seconds. Each caller gets a future which
+    resolves once its row is committed.
+    """
+
+    def __init__(self, manager: TaskManager, flush_interval: float = 0.005, max_batch: int = 100):
+        self.manager = manager
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        self.__queue: "queue.Queue[Tuple[Task, Future]]" = queue.Queue()
+        self.__thread: threading.Thread = None
+        self.__lock = threading.Lock()
+
+    def configure(self, flush_interval: float = None, max_batch: int = None):
+        if flush_interval is not None:
+            self.flush_interval = max(0.0, flush_interval)
+        if max_batch is not None:
+            self.max_batch = max(1, int(max_batch))
+
+    def submit(self, task: Task) -> Future:
+        future = Future()
+        self.__ensure_started()
+        self.__queue.put((task, future))
+        return future
+
+    def add_task(self, task: Task, timeout: float = None) -> bool:
+        """Submit a task and wait until it is durably committed"""
+
+        return self.submit(task).result(timeout=timeout)
+
+    def __ensure_started(self):
+        if self.__thread is not None and self.__thread.is_alive():
+            return
+
+        with self.__lock:
+            if self.__thread is None or not self.__thread.is_alive():
+                self.__thread = threading.Thread(target=self.__run, name="agent-scheduler-task-buffer")
+                self.__thread.daemon = True
+                self.__thread.start()
+
+    def __run(self):
+        while True:
+            batch = [self.__queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                try:
+                    if remaining <= 0:
+                        batch.append(self.__queue.get_nowait())
+                    else:
+                        batch.append(self.__queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            self.__flush(batch)
+
+    def __flush(self, batch: List[Tuple[Task, Future]]):
+        try:
+            results = self.manager.add_tasks([task for task, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), res in zip(batch, results):
+            future.set_result(res)
@@ -0,0 +1,222 @@
+import json
+import time
+import heapq
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from modules import shared, progress
+
+from .db import Task, task_manager
+from .cost import get_task_work, cost_model
+from .scheduling import get_task_model, get_loaded_model
+from .metrics import metrics
+from .helpers import log
+
+# estimated (start, finish) time of a task
+Eta = Tuple[datetime, datetime]
+
+
+class EtaPredictor:
+    """Estimate when the pending tasks start and finish.
+
+    The generation time of a task is modeled per checkpoint as
+    `overhead + seconds_per_work * work`, fitted on a sliding window of the
+    latest done tasks of that checkpoint. Each refresh only loads the tasks
+    finished since the previous one, and refits the updated windows with
+    NumPy. Checkpoints without enough history use the global cost model.
+    Switching checkpoint between two tasks adds the mean checkpoint load time.
+
+    Tasks are assumed to run in queue order, on the `slots` of the executor
+    the runner uses, scheduling policies that reorder them make the estimates
+    approximate.
+    """
+
+    def __init__(
+        self,
+        window: int = 200,
+        history: int = 2000,
+        refresh_interval: float = 30,
+        schedule_ttl: float = 5,
+        max_tasks: int = 1000,
+        min_samples: int = 5,
+    ):
+        self.window = window
+        self.history = history
+        self.refresh_interval = refresh_interval
+        self.schedule_ttl = schedule_ttl
+        self.max_tasks = max_tasks
+        self.min_samples = min_samples
+        # concurrent slots of the task executor, set by the runner when it creates it
+        self.slots = 1
+
+        self.__lock = threading.Lock()
+        self.__refreshed_at = 0.0
+        self.__since: Optional[datetime] = None
+        # checkpoint -> (work, seconds) of its latest done tasks
+        self.__samples: Dict[Optional[str], Tuple[np.ndarray, np.ndarray]] = {}
+        # checkpoint -> (overhead, seconds_per_work)
+        self.__coefficients: Dict[Optional[str], Tuple[float, float]] = {}
+        self.__load_seconds = np.empty(0)
+        self.__schedule: Dict[str, Eta] = {}
+        self.__scheduled_at = 0.0
+
+    def refresh(self, force: bool = False):
+        with self.__lock:
+            if not force and time.monotonic() - self.__refreshed_at < self.refresh_interval:
+                return
+            self.__refreshed_at = time.monotonic()
+            since = self.__since
+
+        try:
+            samples = task_manager.get_task_samples(since=since, limit=self.history)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to refresh the ETA predictor: {e}")
+            return
+
+        if len(samples) == 0:
+            return
+
+        grouped: Dict[Optional[str], List[Tuple[float, float]]] = defaultdict(list)
+        load_seconds = []
+        for task, seconds in samples:
+            # checkpoint loads are accounted for separately, as switch costs
+            load = (task.timings or {}).get("model_load", 0.0)
+            if load >= 1:
+                load_seconds.append(load)
+
+            checkpoint, _ = get_task_model(task)
+            work = get_task_work(json.loads(task.params), task.type == "img2img")
+            grouped[checkpoint].append((work, max(0.0, seconds - load)))
+
+        with self.__lock:
+            self.__since = samples[-1][0].finished_at
+            for checkpoint, values in grouped.items():
+                new_work, new_seconds = np.array(values, dtype=np.float64).T
+                work, seconds = self.__samples.get(checkpoint, (np.empty(0), np.empty(0)))
+                work = np.concatenate((work, new_work))[-self.window :]
+                seconds = np.concatenate((seconds, new_seconds))[-self.window :]
+                self.__samples[checkpoint] = (work, seconds)
+
+                coefficients = self.fit(work, seconds)
+                if coefficients is not None:
+                    self.__coefficients[checkpoint] = coefficients
+
+            if len(load_seconds) > 0:
+                self.__load_seconds = np.concatenate((self.__load_seconds, load_seconds))[-self.window :]
+
+            metrics.set("eta.checkpoints", len(self.__coefficients))
+            metrics.set("eta.samples", sum(len(w) for w, _ in self.__samples.values()))
+
+    def fit(self, work: np.ndarray, seconds: np.ndarray) -> Optional[Tuple[float, float]]:
+        """Least squares fit of `seconds = overhead + slope * work`, None if the samples are not usable"""
+
+        if len(work) < self.min_samples or np.ptp(work) <= 0:
+            return None
+
+        slope, overhead = np.polyfit(work, seconds, 1)
+        if slope <= 0 or overhead < 0:
+            # degenerate history, fit through the origin instead
+            slope, overhead = np.dot(work, seconds) / np.dot(work, work), 0.0
+            if slope <= 0:
+                return None
+
+        return (float(overhead), float(slope))
+
+    def estimate(self, tasks: List[Task]) -> np.ndarray:
+        """Predict the seconds each task takes when run in order, checkpoint switches included"""
+
+        self.refresh()
+        cost_model.refresh()
+
+        loaded, _ = get_loaded_model()
+        default = (cost_model.overhead, cost_model.seconds_per_work)
+        with self.__lock:
+            coefficients = dict(self.__coefficients)
+            switch_seconds = float(self.__load_seconds.mean()) if len(self.__load_seconds) > 0 else 0.0
+
+        n = len(tasks)
+        work = np.empty(n)
+        overhead = np.empty(n)
+        slope = np.empty(n)
+        switches = np.zeros(n, dtype=bool)
+        current = loaded
+        for i, task in enumerate(tasks):
+            checkpoint, _ = get_task_model(task)
+            work[i] = get_task_work(json.loads(task.params), task.type == "img2img")
+            overhead[i], slope[i] = coefficients.get(checkpoint or current, coefficients.get(None, default))
+            if checkpoint is not None and checkpoint != current:
+                switches[i] = True
+                current = checkpoint
+
+        return overhead + slope * work + switches * switch_seconds
+
+    def schedule(self) -> Dict[str, Eta]:
+        """Get the estimated (start, finish) of the running task and the first `max_tasks` pending ones"""
+
+        with self.__lock:
+            if time.monotonic() - self.__scheduled_at < self.schedule_ttl:
+                return self.__schedule
+
+        try:
+            schedule = self.__build_schedule(datetime.now(timezone.utc))
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to estimate the queue ETA: {e}")
+            schedule = {}
+
+        with self.__lock:
+            self.__schedule = schedule
+            self.__scheduled_at = time.monotonic()
+
+        return schedule
+
+    def get(self, task_id: str) -> Optional[Eta]:
+        return self.schedule().get(task_id, None)
+
+    def __build_schedule(self, now: datetime) -> Dict[str, Eta]:
+        schedule: Dict[str, Eta] = {}
+
+        remaining = 0.0
+        running = task_manager.get_task(progress.current_task) if progress.current_task else None
+        if running is not None and running.started_at is not None:
+            elapsed = (now - running.started_at).total_seconds()
+            remaining = self.__get_remaining_seconds(running, elapsed)
+            schedule[running.id] = (running.started_at, now + timedelta(seconds=remaining))
+
+        pending = [t for t in task_manager.get_pending_tasks(limit=self.max_tasks) if t.id != progress.current_task]
+        if len(pending) == 0:
+            return schedule
+
+        durations = self.estimate(pending)
+        if self.slots == 1:
+            finish = remaining + np.cumsum(durations)
+            start = finish - durations
+        else:
+            # each task starts on the first free slot
+            free_at = [remaining] + [0.0] * (self.slots - 1)
+            start = np.empty(len(pending))
+            for i, duration in enumerate(durations):
+                start[i] = heapq.heappop(free_at)
+                heapq.heappush(free_at, start[i] + duration)
+            finish = start + durations
+
+        for task, task_start, task_finish in zip(pending, start.tolist(), finish.tolist()):
+            schedule[task.id] = (now + timedelta(seconds=task_start), now + timedelta(seconds=task_finish))
+
+        return schedule
+
+    def __get_remaining_seconds(self, task: Task, elapsed: float) -> float:
+        # extrapolate from the sampling progress once it is meaningful
+        state = shared.state
+        if state.job_count > 0 and state.sampling_steps > 0:
+            done = (state.job_no + state.sampling_step / state.sampling_steps) / state.job_count
+            if done >= 0.1:
+                return max(0.0, elapsed / done - elapsed)
+
+        return max(0.0, float(self.estimate([task])[0]) - elapsed)
+
+
+eta_predictor = EtaPredictor()
@@ -0,0 +1,106 @@
+import abc
+import json
+import time
+import random
+from typing import Any, Callable, Dict, List, Union
+
+from modules import shared
+
+from .db import Task
+from .metrics import metrics
+
+executor_in_process = "In-process"
+executor_fake = "Fake (CPU load test)"
+
+executor_choices = [executor_in_process, executor_fake]
+
+
+class TaskExecutor(abc.ABC):
+    """Runs the generation of claimed tasks.
+
+    The runner's dispatch loop claims up to `slots` tasks at once and calls
+    `execute` for each of them from its own thread. `execute` returns the
+    generation info JSON string on success, or an Exception.
+    """
+
+    name: str = None
+
+    @property
+    def slots(self) -> int:
+        return 1
+
+    @abc.abstractmethod
+    def execute(self, task: Task, task_args: Any, overrides: Dict = None) -> Union[str, Exception, None]:
+        pass
+
+
+class InProcessExecutor(TaskExecutor):
+    """Generate in the webui process, under the webui queue lock"""
+
+    name = executor_in_process
+
+    def __init__(self, execute_task: Callable[[str, bool, Any, Dict], Union[str, Exception, None]]):
+        self.__execute_task = execute_task
+
+    def execute(self, task: Task, task_args: Any, overrides: Dict = None):
+        return self.__execute_task(task.id, task.type == "img2img", task_args, overrides)
+
+
+class FakeExecutor(TaskExecutor):
+    """Pretend to generate by sleeping in proportion to the task size.
+
+    Useful to load-test scheduling and throughput without a GPU: no image is
+    produced, but the task goes through the whole claim, dispatch and finalize
+    path and gets a generation info shaped like a real one.
+    """
+
+    name = executor_fake
+
+    def __init__(self, slots: int = 1, megapixel_steps_per_second: float = 100.0):
+        self.__slots = max(1, int(slots))
+        self.megapixel_steps_per_second = megapixel_steps_per_second
+
+    @property
+    def slots(self) -> int:
+        return self.__slots
+
+    def execute(self, task: Task, task_args: Any, overrides: Dict = None):
+        args: Dict = task_args.named_args.copy()
+        args.update(overrides or {})
+
+        batch_size = int(args.get("batch_size", None) or 1)
+        n_iter = int(args.get("n_iter", None) or 1)
+        steps = int(args.get("steps", None) or 20)
+        megapixels = int(args.get("width", None) or 512) * int(args.get("height", None) or 512) / 1e6
+
+        duration = megapixels * steps * batch_size * n_iter / self.megapixel_steps_per_second
+        time.sleep(duration * random.uniform(0.9, 1.1))
+        metrics.incr("executor.fake_seconds", duration)
+
+        count = batch_size * n_iter
+        prompts: List[str] = args["prompt"] if isinstance(args.get("prompt"), list) else [args.get("prompt", "")] * count
+        seeds: List[int] = args["seed"] if isinstance(args.get("seed"), list) else [args.get("seed", -1)] * count
+
+        return json.dumps(
+            {
+                "prompt": prompts[0],
+                "all_prompts": prompts,
+                "seed": seeds[0],
+                "all_seeds": seeds,
+                "infotexts": [f"{p}\nSteps: {steps}, Seed: {s}, Fake executor" for p, s in zip(prompts, seeds)],
+                "index_of_first_image": 0,
+                "batch_size": batch_size,
+            }
+        )
+
+
+def create_executor(execute_task: Callable) -> TaskExecutor:
+    executor = getattr(shared.opts, "queue_executor", executor_in_process)
+
+    if executor == executor_fake:
+        return FakeExecutor(
+            slots=getattr(shared.opts, "queue_executor_slots", 1),
+            megapixel_steps_per_second=getattr(shared.opts, "queue_fake_executor_speed", 100),
+        )
+
+    return InProcessExecutor(execute_task)
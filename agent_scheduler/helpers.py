@@ -7,7 +7,8 @@ import logging
 import platform
 import requests
 import traceback
-from typing import Callable, List, NoReturn
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, NoReturn, Optional, Union
 
 import gradio as gr
 from gradio.blocks import Block, BlockContext
@@ -192,6 +193,27 @@ def request_with_retry(
         return False
 
 
+def get_expires_at(
+    expires_at: Union[datetime, str, int, float, None] = None,
+    ttl_seconds: Union[int, float, None] = None,
+) -> Optional[datetime]:
+    """Resolve a task deadline from an absolute time (datetime, ISO string or epoch seconds) and/or a TTL"""
+
+    if isinstance(expires_at, (int, float)):
+        expires_at = datetime.fromtimestamp(expires_at, timezone.utc)
+    elif isinstance(expires_at, str):
+        expires_at = datetime.fromisoformat(expires_at.replace("Z", "+00:00"))
+
+    if expires_at is not None and expires_at.tzinfo is None:
+        expires_at = expires_at.replace(tzinfo=timezone.utc)
+
+    if ttl_seconds is not None:
+        ttl_expires_at = datetime.now(timezone.utc) + timedelta(seconds=ttl_seconds)
+        expires_at = min(expires_at, ttl_expires_at) if expires_at else ttl_expires_at
+
+    return expires_at
+
+
 def _exit(status: int) -> NoReturn:
     try:
         atexit._run_exitfuncs()
@@ -0,0 +1,116 @@
+import time
+import threading
+import traceback
+from datetime import timedelta
+from typing import Callable, List, Optional, Set
+
+from modules import shared
+
+from .db import Task, TaskStatus, task_manager
+from .metrics import metrics
+from .helpers import log
+
+
+class LeaseKeeper:
+    """Hold the leases of the tasks this worker runs, and reap expired ones.
+
+    A task is marked as running in the database with a lease before it runs.
+    A heartbeat thread renews the leases of the tasks this worker holds, until
+    they are finalized. When a worker dies, its leases expire and the reaper,
+    which runs on every worker, returns the tasks to pending, or fails them
+    once they used up their attempts.
+    """
+
+    def __init__(self, reap_interval: float = 30):
+        self.reap_interval = reap_interval
+
+        self.__lock = threading.Lock()
+        self.__held: Set[str] = set()
+        self.__reaped_at = 0.0
+        self.__thread: threading.Thread = None
+        self.__on_requeued: Optional[Callable[[], None]] = None
+
+    @property
+    def lease(self) -> timedelta:
+        return timedelta(seconds=int(getattr(shared.opts, "queue_lease_seconds", 60)))
+
+    @property
+    def max_attempts(self) -> int:
+        return int(getattr(shared.opts, "queue_lease_max_attempts", 3))
+
+    def start(self, on_requeued: Callable[[], None] = None):
+        """Start the heartbeat, `on_requeued` is called when reaped tasks are back to pending"""
+
+        with self.__lock:
+            self.__on_requeued = on_requeued
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+
+            self.__thread = threading.Thread(target=self.__run, name="agent-scheduler-lease-heartbeat")
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def claim(self, tasks: List[Task]) -> List[Task]:
+        """Claim pending tasks to run, returns the claimed ones in the same order"""
+
+        attempts = task_manager.claim_tasks([t.id for t in tasks], self.lease)
+        with self.__lock:
+            self.__held.update(attempts.keys())
+
+        claimed = []
+        for t in tasks:
+            if t.id in attempts:
+                t.status = TaskStatus.RUNNING
+                t.attempts = attempts[t.id]
+                claimed.append(t)
+            else:
+                log.info(f"[AgentScheduler] Task {t.id} is no longer pending, skipping it")
+                metrics.incr("leases.lost_claims")
+
+        return claimed
+
+    def release(self, ids: List[str]):
+        """Stop renewing the leases of finalized tasks"""
+
+        with self.__lock:
+            self.__held.difference_update(ids)
+
+    def reap(self, force: bool = False):
+        with self.__lock:
+            if not force and time.monotonic() - self.__reaped_at < self.reap_interval:
+                return
+            self.__reaped_at = time.monotonic()
+            on_requeued = self.__on_requeued
+
+        try:
+            requeued, failed = task_manager.reap_expired_leases(self.max_attempts)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to reap expired task leases: {e}")
+            return
+
+        if failed > 0:
+            log.warning(f"[AgentScheduler] Failed {failed} tasks abandoned too many times by crashed workers")
+            metrics.incr("leases.failed", failed)
+        if requeued > 0:
+            log.info(f"[AgentScheduler] Requeued {requeued} tasks abandoned by crashed workers")
+            metrics.incr("leases.requeued", requeued)
+            if on_requeued is not None:
+                on_requeued()
+
+    def __run(self):
+        while True:
+            time.sleep(self.lease.total_seconds() / 4)
+
+            with self.__lock:
+                held = list(self.__held)
+            try:
+                if len(held) > 0:
+                    task_manager.renew_leases(held, self.lease)
+                    metrics.incr("leases.renewals")
+                self.reap()
+            except Exception as e:
+                log.error(f"[AgentScheduler] Failed to renew task leases: {e}")
+                log.debug(traceback.format_exc())
+
+
+lease_keeper = LeaseKeeper()
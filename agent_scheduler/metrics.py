@@ -0,0 +1,35 @@
+import threading
+from collections import defaultdict
+from typing import Dict, Union
+
+
+class Metrics:
+    """Thread-safe in-process counters and gauges, exposed on /agent-scheduler/v1/metrics"""
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__counters: Dict[str, Union[int, float]] = defaultdict(int)
+        self.__gauges: Dict[str, Union[int, float]] = {}
+
+    def incr(self, name: str, value: Union[int, float] = 1):
+        with self.__lock:
+            self.__counters[name] += value
+
+    def set(self, name: str, value: Union[int, float]):
+        with self.__lock:
+            self.__gauges[name] = value
+
+    def get(self, name: str, default: Union[int, float] = 0):
+        with self.__lock:
+            if name in self.__gauges:
+                return self.__gauges[name]
+            return self.__counters.get(name, default)
+
+    def snapshot(self) -> Dict[str, Union[int, float]]:
+        with self.__lock:
+            data = dict(self.__counters)
+            data.update(self.__gauges)
+            return dict(sorted(data.items()))
+
+
+metrics = Metrics()
@@ -0,0 +1,135 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Set
+
+from modules import shared, sd_models
+
+from .db import TaskStatus, task_manager
+from .metrics import metrics
+from .helpers import log
+from .scheduling import get_task_model, get_loaded_model
+
+
+class CheckpointCache:
+    """LRU cache of checkpoint state dicts warmed in CPU RAM ahead of time.
+
+    The runner calls `lookahead` when a task starts; a background thread inspects
+    the upcoming pending tasks and reads the state dict of every other checkpoint
+    they need into RAM while the GPU is busy. When a task starts, `activate` hands
+    the cached state dict to webui's own checkpoint cache so the model swap skips
+    the disk read.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries: "OrderedDict[str, Dict]" = OrderedDict()
+        self.__loading: Set[str] = set()
+        self.__executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="agent-scheduler-checkpoint-cache")
+
+    @property
+    def max_bytes(self) -> int:
+        return int(getattr(shared.opts, "queue_checkpoint_cache_gb", 0) * 1024**3)
+
+    def lookahead(self, running_id: str = None, limit: int = None):
+        if self.max_bytes <= 0:
+            self.clear()
+            return
+
+        limit = limit or int(getattr(shared.opts, "queue_checkpoint_lookahead", 5))
+        self.__executor.submit(self.__lookahead, running_id, limit)
+
+    def activate(self, checkpoint: Optional[str]):
+        """Move the cached state dict for `checkpoint` into webui's checkpoint cache"""
+
+        if self.max_bytes <= 0 or checkpoint is None or checkpoint == get_loaded_model()[0]:
+            return
+
+        with self.__lock:
+            entry = self.__entries.pop(checkpoint, None)
+
+        if entry is None:
+            metrics.incr("checkpoint_cache.misses")
+            return
+
+        metrics.incr("checkpoint_cache.hits")
+        sd_models.checkpoints_loaded[entry["info"]] = entry["state_dict"]
+        sd_models.checkpoints_loaded.move_to_end(entry["info"])
+        self.__update_gauges()
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+        self.__update_gauges()
+
+    def __lookahead(self, running_id: Optional[str], limit: int):
+        try:
+            tasks = task_manager.get_tasks(status=TaskStatus.PENDING, limit=limit + 1)
+            checkpoints: List[str] = []
+            for task in tasks:
+                if task.id == running_id:
+                    continue
+
+                checkpoint, _ = get_task_model(task)
+                if checkpoint is not None and checkpoint not in checkpoints:
+                    checkpoints.append(checkpoint)
+
+            # checkpoints needed sooner are preloaded first and never evicted for later ones
+            checkpoints = checkpoints[:limit]
+            for i, checkpoint in enumerate(checkpoints):
+                if not self.__preload(checkpoint, keep=set(checkpoints[:i])):
+                    break
+        except Exception as e:
+            log.error(f"[AgentScheduler] Failed to preload checkpoints: {e}")
+
+    def __preload(self, checkpoint: str, keep: Set[str]) -> bool:
+        """Load a checkpoint into the cache, returns False if it does not fit"""
+
+        if checkpoint == get_loaded_model()[0]:
+            return True
+
+        checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint)
+        if checkpoint_info is None or checkpoint_info in sd_models.checkpoints_loaded:
+            return True
+
+        # the file size is a close estimate of the state dict size
+        size = os.path.getsize(checkpoint_info.filename)
+        with self.__lock:
+            if checkpoint in self.__entries:
+                self.__entries.move_to_end(checkpoint)
+                return True
+            if checkpoint in self.__loading:
+                return True
+
+            evictable = [k for k in self.__entries.keys() if k not in keep]
+            used = sum(e["size"] for e in self.__entries.values())
+            while used + size > self.max_bytes and len(evictable) > 0:
+                used -= self.__entries.pop(evictable.pop(0))["size"]
+                metrics.incr("checkpoint_cache.evictions")
+
+            if used + size > self.max_bytes:
+                return False
+
+            self.__loading.add(checkpoint)
+
+        try:
+            log.info(f"[AgentScheduler] Preloading checkpoint {checkpoint} into RAM")
+            state_dict = sd_models.read_state_dict(checkpoint_info.filename, map_location="cpu")
+            with self.__lock:
+                self.__entries[checkpoint] = {"info": checkpoint_info, "state_dict": state_dict, "size": size}
+
+            metrics.incr("checkpoint_cache.preloads")
+            return True
+        finally:
+            with self.__lock:
+                self.__loading.discard(checkpoint)
+            self.__update_gauges()
+
+    def __update_gauges(self):
+        with self.__lock:
+            metrics.set("checkpoint_cache.entries", len(self.__entries))
+            metrics.set("checkpoint_cache.bytes", sum(e["size"] for e in self.__entries.values()))
+
+
+checkpoint_cache = CheckpointCache()
@@ -62,6 +62,41 @@ class TaskModel(BaseModel):
         description="The time when the task finished",
         default=None,
     )
+    expires_at: Optional[datetime] = Field(
+        title="Task Expires At",
+        description="The time after which the task is dropped if it has not started",
+        default=None,
+    )
+    result_key: Optional[str] = Field(
+        title="Task Result Key",
+        description="Hash of the resolved parameters of a deterministic task, used by the result cache",
+        default=None,
+    )
+    tenant: Optional[str] = Field(
+        title="Task Tenant",
+        description="Who submitted the task, eg: api:<user>, mq:<queue> or ui:<user>. Used for fair queuing",
+        default=None,
+    )
+    attempts: Optional[int] = Field(
+        title="Task Attempts",
+        description="How many times the task started running, including runs lost to a worker crash",
+        default=0,
+    )
+    estimated_start_at: Optional[datetime] = Field(
+        title="Task Estimated Start At",
+        description="When the task is expected to start, based on the generation time of previous tasks",
+        default=None,
+    )
+    estimated_finish_at: Optional[datetime] = Field(
+        title="Task Estimated Finish At",
+        description="When the task is expected to finish, based on the generation time of previous tasks",
+        default=None,
+    )
+    timings: Optional[Dict[str, float]] = Field(
+        title="Task Timings",
+        description="Seconds spent in each phase of the task: deserialize, model_load, generation, image_saving, finalize, callbacks",
+        default=None,
+    )
 
 
 class Txt2ImgApiTaskArgs(StableDiffusionTxt2ImgProcessingAPI):
@@ -81,6 +116,21 @@ class Txt2ImgApiTaskArgs(StableDiffusionTxt2ImgProcessingAPI):
         title="Callback URL",
         description="The callback URL to send the result to.",
     )
+    expires_at: Optional[datetime] = Field(
+        None,
+        title="Expires At",
+        description="The task is dropped if it has not started by this time.",
+    )
+    ttl_seconds: Optional[int] = Field(
+        None,
+        title="Time To Live",
+        description="The task is dropped if it has not started this many seconds after being queued.",
+    )
+    urgent: Optional[bool] = Field(
+        False,
+        title="Urgent",
+        description="Run the task next, preempting the running task if queue preemption is enabled.",
+    )
 
     class Config(StableDiffusionTxt2ImgProcessingAPI.__config__):
         @staticmethod
@@ -107,6 +157,21 @@ class Img2ImgApiTaskArgs(StableDiffusionImg2ImgProcessingAPI):
         title="Callback URL",
         description="The callback URL to send the result to.",
     )
+    expires_at: Optional[datetime] = Field(
+        None,
+        title="Expires At",
+        description="The task is dropped if it has not started by this time.",
+    )
+    ttl_seconds: Optional[int] = Field(
+        None,
+        title="Time To Live",
+        description="The task is dropped if it has not started this many seconds after being queued.",
+    )
+    urgent: Optional[bool] = Field(
+        False,
+        title="Urgent",
+        description="Run the task next, preempting the running task if queue preemption is enabled.",
+    )
 
     class Config(StableDiffusionImg2ImgProcessingAPI.__config__):
         @staticmethod
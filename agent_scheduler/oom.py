@@ -0,0 +1,62 @@
+import json
+from typing import Dict, Optional
+
+from modules import shared
+
+from .db import Task
+
+oom_policy_adaptive = "Retry with smaller batches"
+oom_policy_pause = "Pause queue"
+
+oom_policy_choices = [oom_policy_adaptive, oom_policy_pause]
+
+# added to the priority of tasks routed to the large queue, so they run after all the others
+large_queue_priority_offset = 10**13
+
+
+def is_oom_adaptive() -> bool:
+    return getattr(shared.opts, "queue_oom_policy", oom_policy_adaptive) == oom_policy_adaptive
+
+
+def get_oom_retries(task: Task) -> int:
+    return json.loads(task.params).get("oom_retries", 0)
+
+
+def is_large_task(task: Task) -> bool:
+    return json.loads(task.params).get("large_queue", False)
+
+
+def get_oom_retry_params(task: Task, batched: bool = False) -> Optional[Dict]:
+    """Return the params of a smaller retry of a task that ran out of memory,
+    or None if it can not be reduced any further.
+
+    A task merged into a batch of other tasks is first retried alone. Then its
+    `batch_size` is split into more iterations, keeping the same number of
+    images. At batch size 1, the task is routed to the large queue for a last
+    attempt once every other task has run.
+    """
+
+    params: Dict = json.loads(task.params)
+    args: Dict = params.get("args", {})
+    batch_size = int(args.get("batch_size", None) or 1)
+    n_iter = int(args.get("n_iter", None) or 1)
+
+    if batched:
+        pass
+    elif batch_size > 1:
+        # largest divisor so the number of images is unchanged
+        reduced = next(d for d in range(batch_size // 2, 0, -1) if batch_size % d == 0)
+        args["batch_size"] = reduced
+        args["n_iter"] = n_iter * batch_size // reduced
+    elif not params.get("large_queue", False):
+        params["large_queue"] = True
+    else:
+        return None
+
+    params["oom_retries"] = params.get("oom_retries", 0) + 1
+    return params
+
+
+def get_oom_failure_message(task: Task) -> str:
+    retries = get_oom_retries(task)
+    return f"CUDA out of memory at batch size 1, after {retries} smaller retries"
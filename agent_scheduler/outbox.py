@@ -0,0 +1,193 @@
+import os
+import time
+import random
+import threading
+import traceback
+from pathlib import Path
+from contextlib import ExitStack
+from collections import defaultdict
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from modules import shared
+
+from .db import Callback, CallbackStatus, CallbackManager, callback_manager
+from .metrics import metrics
+from .helpers import log
+
+
+class PermanentCallbackError(Exception):
+    """A delivery failure that retrying will not fix"""
+
+
+class CallbackDispatcher:
+    """Deliver the task callbacks stored in the outbox table.
+
+    Callbacks are written to the outbox when a task finishes, so they survive
+    restarts and never block the runner. A poller thread claims due callbacks
+    (with a lease, so a crashed delivery is retried later) and hands them to a
+    pool of workers sharing keep-alive HTTP connections. At most `per_host`
+    deliveries run at once for the same host. Failed deliveries are retried
+    with exponential backoff and jitter, up to `max_attempts` times.
+    """
+
+    def __init__(
+        self,
+        manager: CallbackManager,
+        workers: int = 4,
+        timeout: float = 30,
+        base_delay: float = 2,
+        max_delay: float = 600,
+        poll_interval: float = 1,
+        lease: timedelta = timedelta(minutes=5),
+    ):
+        self.manager = manager
+        self.workers = workers
+        self.timeout = timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.poll_interval = poll_interval
+        self.lease = lease
+
+        self.__lock = threading.Lock()
+        self.__wake = threading.Event()
+        self.__inflight: Dict[str, int] = defaultdict(int)
+        self.__thread: threading.Thread = None
+        self.__executor: ThreadPoolExecutor = None
+        self.__session: requests.Session = None
+
+    @property
+    def per_host(self) -> int:
+        return int(getattr(shared.opts, "queue_callback_per_host", 2))
+
+    @property
+    def max_attempts(self) -> int:
+        return int(getattr(shared.opts, "queue_callback_max_attempts", 8))
+
+    def start(self):
+        with self.__lock:
+            if self.__thread is not None and self.__thread.is_alive():
+                return
+
+            self.workers = int(getattr(shared.opts, "queue_callback_workers", self.workers))
+            self.__session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=self.workers)
+            self.__session.mount("http://", adapter)
+            self.__session.mount("https://", adapter)
+            self.__executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="agent-scheduler-callback")
+
+            self.__thread = threading.Thread(target=self.__run, name="agent-scheduler-callback-poller")
+            self.__thread.daemon = True
+            self.__thread.start()
+
+    def enqueue(self, task_id: str, url: str, status: str, images: List[str]):
+        """Persist a callback of a finished task, it is delivered in the background"""
+
+        payload = {"data": {"task_id": task_id, "status": status}, "files": images}
+        self.manager.add_callback(task_id, url, payload)
+        metrics.incr("callbacks.enqueued")
+
+        self.start()
+        self.__wake.set()
+
+    def __run(self):
+        while True:
+            self.__wake.wait(timeout=self.poll_interval)
+            self.__wake.clear()
+
+            try:
+                self.__dispatch()
+            except Exception as e:
+                log.error(f"[AgentScheduler] Failed to dispatch callbacks: {e}")
+                log.debug(traceback.format_exc())
+
+    def __dispatch(self):
+        with self.__lock:
+            free = self.workers - sum(self.__inflight.values())
+        if free <= 0:
+            return
+
+        for callback in self.manager.claim_callbacks(limit=free, lease=self.lease):
+            host = urlparse(callback.url).netloc
+            with self.__lock:
+                busy = self.__inflight[host] >= self.per_host
+                if not busy:
+                    self.__inflight[host] += 1
+
+            if busy:
+                # the host has enough deliveries running, try again shortly without counting an attempt
+                metrics.incr("callbacks.deferred")
+                self.manager.update_callback(
+                    callback.id,
+                    CallbackStatus.PENDING,
+                    next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=self.poll_interval),
+                    last_error=callback.last_error,
+                )
+                continue
+
+            metrics.set("callbacks.inflight", sum(self.__inflight.values()))
+            self.__executor.submit(self.__deliver, callback, host)
+
+    def __deliver(self, callback: Callback, host: str):
+        attempts = callback.attempts + 1
+        start = time.perf_counter()
+        try:
+            self.__post(callback)
+            self.manager.update_callback(callback.id, CallbackStatus.DELIVERED, attempts=attempts)
+            metrics.incr("callbacks.delivered")
+            metrics.incr("callbacks.delivery_seconds", time.perf_counter() - start)
+        except Exception as e:
+            permanent = isinstance(e, (PermanentCallbackError, FileNotFoundError))
+            if permanent or attempts >= self.max_attempts:
+                log.error(f"[AgentScheduler] Callback of task {callback.task_id} failed after {attempts} attempts: {e}")
+                self.manager.update_callback(callback.id, CallbackStatus.FAILED, attempts=attempts, last_error=str(e))
+                metrics.incr("callbacks.failed")
+            else:
+                # exponential backoff with equal jitter
+                delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1))
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                log.warning(f"[AgentScheduler] Callback of task {callback.task_id} failed, retrying in {delay:.0f}s: {e}")
+                self.manager.update_callback(
+                    callback.id,
+                    CallbackStatus.PENDING,
+                    attempts=attempts,
+                    next_attempt_at=datetime.now(timezone.utc) + timedelta(seconds=delay),
+                    last_error=str(e),
+                )
+                metrics.incr("callbacks.retries")
+        finally:
+            with self.__lock:
+                self.__inflight[host] -= 1
+                metrics.set("callbacks.inflight", sum(self.__inflight.values()))
+            self.__wake.set()
+
+    def __post(self, callback: Callback):
+        with ExitStack() as stack:
+            files = []
+            for img in callback.payload.get("files", []):
+                img_path = Path(img)
+                content_type = f"image/{img_path.suffix.lower()[1:]}"
+                file = stack.enter_context(open(os.path.abspath(img), "rb"))
+                files.append(("files", (img_path.name, file, content_type)))
+
+            res = self.__session.post(
+                callback.url,
+                timeout=self.timeout,
+                data=callback.payload.get("data", {}),
+                files=files,
+            )
+
+        if res.status_code >= 400:
+            message = f"HTTP {res.status_code}: {res.text[:200]}"
+            # other client errors will not succeed on retry
+            if res.status_code < 500 and res.status_code not in (408, 429):
+                raise PermanentCallbackError(message)
+            raise Exception(message)
+
+
+callback_dispatcher = CallbackDispatcher(callback_manager)
@@ -0,0 +1,107 @@
+import time
+import threading
+import traceback
+from collections import deque
+from typing import Callable, Deque, Optional, Tuple
+
+from .metrics import metrics
+from .helpers import log
+from .timing import TaskTimer, start_timer, stop_timer
+
+
+class PostProcessor:
+    """Bounded pool of worker threads that finalize generated tasks.
+
+    The runner submits the finalization of a task (database update, result
+    building and task_finished callbacks) and moves on to the next generation.
+    At most `max_pending` jobs wait or run at once: when the workers fall behind,
+    `submit` blocks the runner until a slot frees up. With 0 workers, jobs run
+    inline on the caller's thread.
+    """
+
+    def __init__(self, workers: int = 2, max_pending: int = 4):
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self.__cond = threading.Condition()
+        self.__jobs: Deque[Tuple[Callable[[], None], Optional[TaskTimer]]] = deque()
+        self.__pending = 0
+        self.__threads = 0
+
+    def configure(self, workers: int = None, max_pending: int = None):
+        with self.__cond:
+            if workers is not None:
+                self.workers = max(0, int(workers))
+            if max_pending is not None:
+                self.max_pending = max(1, int(max_pending))
+            self.__cond.notify_all()
+
+    def submit(self, fn: Callable[[], None], timer: TaskTimer = None):
+        """Run `fn` on a worker thread, with `timer` as the current task timer"""
+
+        if self.workers <= 0:
+            self.__run_job(fn, timer)
+            return
+
+        with self.__cond:
+            start = time.perf_counter()
+            while self.__pending >= self.max_pending:
+                self.__cond.wait()
+
+            blocked = time.perf_counter() - start
+            if self.__pending > 0 and blocked > 0.001:
+                metrics.incr("postprocess.backpressure")
+                metrics.incr("postprocess.blocked_seconds", blocked)
+
+            self.__jobs.append((fn, timer))
+            self.__pending += 1
+            metrics.set("postprocess.pending", self.__pending)
+
+            if self.__threads < self.workers:
+                self.__threads += 1
+                thread = threading.Thread(target=self.__run, name=f"agent-scheduler-postprocess-{self.__threads}")
+                thread.daemon = True
+                thread.start()
+
+            self.__cond.notify_all()
+
+    def join(self, timeout: float = None) -> bool:
+        """Wait until every submitted job is done, returns False on timeout"""
+
+        with self.__cond:
+            return self.__cond.wait_for(lambda: self.__pending == 0, timeout=timeout)
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while len(self.__jobs) == 0 and self.__threads <= self.workers:
+                    self.__cond.wait()
+
+                # the pool was shrunk
+                if len(self.__jobs) == 0:
+                    self.__threads -= 1
+                    return
+
+                fn, timer = self.__jobs.popleft()
+
+            try:
+                self.__run_job(fn, timer)
+            finally:
+                with self.__cond:
+                    self.__pending -= 1
+                    metrics.set("postprocess.pending", self.__pending)
+                    self.__cond.notify_all()
+
+    def __run_job(self, fn: Callable[[], None], timer: Optional[TaskTimer]):
+        start_timer(timer)
+        try:
+            fn()
+            metrics.incr("postprocess.processed")
+        except Exception as e:
+            log.error(f"[AgentScheduler] Failed to finalize task: {e}")
+            log.debug(traceback.format_exc())
+        finally:
+            stop_timer()
+
+
+post_processor = PostProcessor()
@@ -0,0 +1,101 @@
+import threading
+from collections import deque
+from typing import Any, Callable, Deque, Optional, Set, Tuple
+
+from .db import Task
+from .helpers import log
+
+
+class TaskPrefetcher:
+    """Claim and deserialize upcoming tasks on a background thread.
+
+    While the current task is generating, the prefetch thread selects up to `depth`
+    pending tasks (excluding the running one and the ones already prefetched) and
+    runs `parse_task` on them, so the runner can start the next task right away.
+    Claims only live in memory: prefetched tasks stay pending in the database.
+    """
+
+    def __init__(
+        self,
+        select_task: Callable[[Set[str]], Optional[Task]],
+        parse_task: Callable[[Task], Any],
+        depth: int = 1,
+    ):
+        self.depth = max(1, int(depth))
+        self.__select_task = select_task
+        self.__parse_task = parse_task
+
+        self.__ready: Deque[Tuple[Task, Any]] = deque()
+        self.__claimed: Set[str] = set()
+        self.__running_id: Optional[str] = None
+        self.__cond = threading.Condition()
+        self.__fetching = False
+        self.__exhausted = True
+        self.__stopped = False
+
+        self.__thread = threading.Thread(target=self.__run, name="agent-scheduler-prefetch")
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def prefetch(self, running_id: str = None):
+        """Start prefetching tasks that come after `running_id`"""
+
+        with self.__cond:
+            if running_id is not None:
+                self.__running_id = running_id
+            self.__exhausted = False
+            self.__cond.notify_all()
+
+    def next(self) -> Optional[Tuple[Task, Any]]:
+        """Pop the next prefetched task and its parsed args, waits for an in-progress fetch"""
+
+        with self.__cond:
+            while len(self.__ready) == 0 and self.__fetching:
+                self.__cond.wait()
+
+            if len(self.__ready) == 0:
+                return None
+
+            task, parsed = self.__ready.popleft()
+            self.__claimed.discard(task.id)
+            self.__cond.notify_all()
+            return (task, parsed)
+
+    def stop(self):
+        with self.__cond:
+            self.__stopped = True
+            self.__ready.clear()
+            self.__claimed.clear()
+            self.__cond.notify_all()
+
+    def __run(self):
+        while True:
+            with self.__cond:
+                while not self.__stopped and (self.__exhausted or len(self.__ready) >= self.depth):
+                    self.__cond.wait()
+
+                if self.__stopped:
+                    return
+
+                self.__fetching = True
+                exclude = set(self.__claimed)
+                if self.__running_id is not None:
+                    exclude.add(self.__running_id)
+
+            task, parsed = None, None
+            try:
+                task = self.__select_task(exclude)
+                if task is not None:
+                    parsed = self.__parse_task(task)
+            except Exception as e:
+                # leave parsing to the runner so the failure is reported on the task
+                log.error(f"[AgentScheduler] Failed to prefetch task: {e}")
+
+            with self.__cond:
+                self.__fetching = False
+                if task is None:
+                    self.__exhausted = True
+                elif not self.__stopped:
+                    self.__ready.append((task, parsed))
+                    self.__claimed.add(task.id)
+                self.__cond.notify_all()
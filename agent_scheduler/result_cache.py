@@ -0,0 +1,131 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Optional
+
+from modules import shared
+
+from .db import Task, task_manager
+from .metrics import metrics
+from .helpers import log
+from .scheduling import get_task_model, get_loaded_model
+
+# args that do not change the generated images
+result_key_ignored_args = ("id_task", "request", "save_images", "send_images")
+
+
+def is_deterministic(args: Dict) -> bool:
+    """Whether the task always generates the same images, ie: it has a fixed seed"""
+
+    seed = args.get("seed", -1)
+    if seed is None or seed == "" or int(seed) == -1:
+        return False
+
+    subseed = args.get("subseed", -1)
+    subseed_strength = float(args.get("subseed_strength", None) or 0)
+    if subseed_strength > 0 and (subseed is None or subseed == "" or int(subseed) == -1):
+        return False
+
+    return True
+
+
+def get_result_key(task: Task) -> Optional[str]:
+    """Hash the fully resolved parameters of a deterministic task, None if the task is not deterministic"""
+
+    params: Dict = json.loads(task.params)
+    args: Dict = params.get("args", {})
+    try:
+        if not is_deterministic(args):
+            return None
+    except (TypeError, ValueError):
+        return None
+
+    # tasks without a checkpoint or vae use the loaded one
+    checkpoint, vae = get_task_model(task)
+    loaded_checkpoint, loaded_vae = get_loaded_model()
+
+    canonical = {
+        "type": task.type,
+        "is_ui": params.get("is_ui", True),
+        "checkpoint": checkpoint or loaded_checkpoint,
+        "vae": vae or loaded_vae,
+        "args": {k: v for k, v in args.items() if k not in result_key_ignored_args},
+        "script_args": params.get("script_args", None),
+    }
+    key = hashlib.sha256(json.dumps(canonical, sort_keys=True, default=str).encode())
+    key.update(task.script_params or b"")
+    key.update(task.image_params or b"")
+
+    return key.hexdigest()
+
+
+class ResultCache:
+    """Reuse the result of a previous done task with the same result key.
+
+    Entries are the done tasks themselves: a task keeps its `result_key` until
+    it is evicted, either because it is older than `max_age_hours`, beyond the
+    `max_entries` most recent ones, or because its images were deleted.
+    """
+
+    def __init__(self, evict_interval: float = 60):
+        self.evict_interval = evict_interval
+        self.__lock = threading.Lock()
+        self.__evicted_at = 0.0
+
+    @property
+    def enabled(self) -> bool:
+        return getattr(shared.opts, "queue_result_cache", False)
+
+    @property
+    def max_entries(self) -> int:
+        return int(getattr(shared.opts, "queue_result_cache_max_entries", 1000))
+
+    @property
+    def max_age(self) -> timedelta:
+        return timedelta(hours=getattr(shared.opts, "queue_result_cache_max_age_hours", 24))
+
+    def lookup(self, key: str) -> Optional[Dict]:
+        """Return the cached result (images and geninfo) for `key`, if any"""
+
+        self.evict()
+
+        cached = task_manager.get_cached_result(key, since=datetime.now(timezone.utc) - self.max_age)
+        if cached is not None:
+            result: Dict = json.loads(cached.result)
+            if all(os.path.isfile(path) for path in result.get("images", [])):
+                self.__record(hit=True)
+                return result
+
+            log.info(f"[AgentScheduler] Cached result of task {cached.id} has missing images, evicting it")
+            task_manager.clear_result_key(key)
+            metrics.incr("result_cache.evictions")
+
+        self.__record(hit=False)
+        return None
+
+    def evict(self, force: bool = False):
+        with self.__lock:
+            if not force and time.monotonic() - self.__evicted_at < self.evict_interval:
+                return
+            self.__evicted_at = time.monotonic()
+
+        try:
+            evicted_rows = task_manager.evict_result_keys(
+                before=datetime.now(timezone.utc) - self.max_age,
+                max_entries=self.max_entries,
+            )
+            metrics.incr("result_cache.evictions", evicted_rows)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to evict the result cache: {e}")
+
+    def __record(self, hit: bool):
+        metrics.incr("result_cache.hits" if hit else "result_cache.misses")
+        hits = metrics.get("result_cache.hits")
+        total = hits + metrics.get("result_cache.misses")
+        metrics.set("result_cache.hit_rate", round(hits / total, 4))
+
+
+result_cache = ResultCache()
@@ -0,0 +1,316 @@
+import json
+import threading
+from collections import defaultdict
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from modules import shared, sd_models
+
+from .db import Task, default_tenant
+from .metrics import metrics
+from .cost import cost_model
+from .helpers import log, get_dict_attribute
+
+policy_fifo = "FIFO"
+policy_affinity = "Checkpoint affinity"
+policy_sjf = "Shortest job first"
+
+scheduling_policy_choices = [policy_fifo, policy_affinity, policy_sjf]
+
+
+def get_task_model(task: Task) -> Tuple[Optional[str], Optional[str]]:
+    """Return the (checkpoint title, vae) requested by a task, None means any"""
+
+    params: Dict = json.loads(task.params)
+    checkpoint = params.get("checkpoint", None)
+    vae = params.get("vae", None)
+    if not params.get("is_ui", True):
+        args = params.get("args", {})
+        checkpoint = checkpoint or get_dict_attribute(args, "override_settings.sd_model_checkpoint", None)
+        vae = vae or get_dict_attribute(args, "override_settings.sd_vae", None)
+
+    if checkpoint is not None and checkpoint != "System":
+        checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint)
+        checkpoint = checkpoint_info.title if checkpoint_info else checkpoint
+    else:
+        checkpoint = None
+
+    return (checkpoint, vae)
+
+
+def get_loaded_model() -> Tuple[Optional[str], Optional[str]]:
+    checkpoint_info = getattr(shared.sd_model, "sd_checkpoint_info", None)
+    checkpoint = checkpoint_info.title if checkpoint_info else None
+    vae = getattr(shared.opts, "sd_vae", None)
+
+    return (checkpoint, vae)
+
+
+def is_model_loaded(model: Tuple[Optional[str], Optional[str]], loaded: Tuple[Optional[str], Optional[str]]):
+    checkpoint, vae = model
+    loaded_checkpoint, loaded_vae = loaded
+
+    if checkpoint is not None and checkpoint != loaded_checkpoint:
+        return False
+
+    if vae is not None and vae != loaded_vae:
+        return False
+
+    return True
+
+
+class SchedulingPolicy:
+    """Pick the next task to run from the head of the pending queue (ordered by priority)"""
+
+    name = policy_fifo
+
+    @property
+    def window(self) -> int:
+        """How many pending tasks from the head of the queue the policy looks at"""
+
+        return 1
+
+    def select(self, tasks: List[Task]) -> Optional[Task]:
+        return tasks[0] if len(tasks) > 0 else None
+
+
+class CheckpointAffinityPolicy(SchedulingPolicy):
+    """Prefer pending tasks that use the currently loaded checkpoint and VAE.
+
+    Only the first `window` tasks are considered, and once a task of the window
+    has waited more than `max_wait_seconds` the longest waiting one is picked
+    regardless of affinity.
+    """
+
+    name = policy_affinity
+
+    def __init__(self, window: int = 20, max_wait_seconds: float = 600):
+        self.__window = max(1, int(window))
+        self.max_wait_seconds = max_wait_seconds
+
+    @property
+    def window(self) -> int:
+        return self.__window
+
+    def select(self, tasks: List[Task]) -> Optional[Task]:
+        if len(tasks) == 0:
+            return None
+
+        head = tasks[0]
+        now = datetime.now(timezone.utc)
+        overdue = [t for t in tasks if t.created_at and (now - t.created_at).total_seconds() > self.max_wait_seconds]
+        if len(overdue) > 0:
+            return min(overdue, key=lambda t: t.created_at)
+
+        loaded = get_loaded_model()
+        if loaded[0] is None:
+            return head
+
+        try:
+            head_model = get_task_model(head)
+            if is_model_loaded(head_model, loaded):
+                return head
+
+            task = next((t for t in tasks[1:] if is_model_loaded(get_task_model(t), loaded)), None)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to resolve task checkpoint, fallback to FIFO: {e}")
+            return head
+
+        if task is None:
+            return head
+
+        log.debug(f"[AgentScheduler] Run task {task.id} before {head.id} to keep checkpoint {loaded[0]} loaded")
+        # the head may only differ by VAE, which is no checkpoint swap
+        if head_model[0] is not None and head_model[0] != loaded[0]:
+            metrics.incr("scheduler.model_swaps_avoided")
+        return task
+
+
+class ShortestJobFirstPolicy(SchedulingPolicy):
+    """Run the pending task with the shortest expected generation time first.
+
+    Only the first `window` tasks are considered. To avoid starving large tasks,
+    every minute a task waits takes `aging` seconds off its expected cost.
+    """
+
+    name = policy_sjf
+
+    def __init__(
+        self,
+        window: int = 50,
+        aging: float = 6,
+        estimate: Callable[[Task], float] = None,
+        clock: Callable[[], datetime] = None,
+    ):
+        self.__window = max(1, int(window))
+        self.aging = aging
+        self.__estimate = estimate or cost_model.estimate
+        self.__clock = clock or (lambda: datetime.now(timezone.utc))
+
+    @property
+    def window(self) -> int:
+        return self.__window
+
+    def select(self, tasks: List[Task]) -> Optional[Task]:
+        if len(tasks) == 0:
+            return None
+
+        now = self.__clock()
+
+        def score(task: Task):
+            waited = (now - task.created_at).total_seconds() if task.created_at else 0
+            return self.__estimate(task) - self.aging * waited / 60
+
+        try:
+            task = min(tasks, key=score)
+        except Exception as e:
+            log.warning(f"[AgentScheduler] Failed to estimate task cost, fallback to FIFO: {e}")
+            return tasks[0]
+
+        if task is not tasks[0]:
+            metrics.incr("scheduler.sjf_reordered")
+        return task
+
+
+def parse_tenant_weights(value: str) -> Dict[str, float]:
+    """Parse weights like `api:alice=3, mq:images=2`, unlisted tenants have a weight of 1"""
+
+    weights = {}
+    for item in (value or "").split(","):
+        tenant, _, weight = item.strip().rpartition("=")
+        if tenant == "":
+            continue
+        try:
+            weights[tenant.strip()] = max(0.01, float(weight))
+        except ValueError:
+            log.warning(f"[AgentScheduler] Invalid tenant weight: {item}")
+
+    return weights
+
+
+class FairShareQueue:
+    """Weighted fair queuing across tenants.
+
+    Each tenant has a virtual pass that grows by 1 / weight every time one of its
+    tasks runs; the backlogged tenant with the lowest pass goes next. A tenant
+    that was idle restarts from the lowest pass of the backlogged tenants, so it
+    can not bank credit while it has nothing queued.
+
+    Tasks are charged as soon as they are selected (or prefetched), so several
+    selections in a row rotate between tenants. The charge is kept when the
+    task starts, and refunded if it is released without running.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__passes: Dict[str, float] = {}
+        self.__reserved: Dict[str, Tuple[str, float]] = {}
+        self.__served: Dict[str, int] = defaultdict(int)
+        self.__depths: Dict[str, int] = {}
+        self.__virtual_time = 0.0
+
+    @property
+    def weights(self) -> Dict[str, float]:
+        return parse_tenant_weights(getattr(shared.opts, "queue_tenant_weights", ""))
+
+    def order_tenants(self, depths: Dict[str, int]) -> List[str]:
+        """Order the tenants with pending tasks by their turn to run"""
+
+        with self.__lock:
+            self.__depths = depths
+            active = [t for t, count in depths.items() if count > 0]
+            for tenant in active:
+                self.__passes[tenant] = max(self.__passes.get(tenant, self.__virtual_time), self.__virtual_time)
+
+            if len(active) > 0:
+                self.__virtual_time = min(self.__passes[t] for t in active)
+
+        for tenant, count in depths.items():
+            metrics.set(f"tenants.{tenant}.pending", count)
+
+        return sorted(active, key=lambda t: (self.__passes[t], t))
+
+    def reserve(self, task: Task):
+        """Charge the tenant of a selected task, before it starts"""
+
+        tenant = task.tenant or default_tenant
+        charge = 1.0 / self.weights.get(tenant, 1.0)
+
+        with self.__lock:
+            if task.id in self.__reserved:
+                return
+            self.__reserved[task.id] = (tenant, charge)
+            self.__passes[tenant] = self.__passes.get(tenant, self.__virtual_time) + charge
+
+    def release(self, task_id: str):
+        """Refund the charge of a selected task that will not run"""
+
+        with self.__lock:
+            self.__refund(task_id)
+
+    def release_all(self):
+        with self.__lock:
+            for task_id in list(self.__reserved.keys()):
+                self.__refund(task_id)
+
+    def __refund(self, task_id: str):
+        tenant, charge = self.__reserved.pop(task_id, (None, 0.0))
+        if tenant is not None and tenant in self.__passes:
+            self.__passes[tenant] -= charge
+
+    def served(self, tenant: Optional[str], task_id: str = None):
+        tenant = tenant or default_tenant
+        weight = self.weights.get(tenant, 1.0)
+
+        with self.__lock:
+            # a reserved task was charged when it was selected
+            if self.__reserved.pop(task_id, None) is None:
+                self.__passes[tenant] = self.__passes.get(tenant, self.__virtual_time) + 1.0 / weight
+            self.__served[tenant] += 1
+            total = sum(self.__served.values())
+            shares = {t: count / total for t, count in self.__served.items()}
+
+        metrics.incr(f"tenants.{tenant}.served")
+        for t, share in shares.items():
+            metrics.set(f"tenants.{t}.served_share", round(share, 4))
+
+    def snapshot(self, depths: Dict[str, int] = None) -> Dict[str, Dict]:
+        weights = self.weights
+        with self.__lock:
+            depths = depths if depths is not None else self.__depths
+            total = sum(self.__served.values()) or 1
+            tenants = set(depths.keys()) | set(self.__served.keys())
+            return {
+                t: {
+                    "weight": weights.get(t, 1.0),
+                    "pending": depths.get(t, 0),
+                    "served": self.__served.get(t, 0),
+                    "served_share": round(self.__served.get(t, 0) / total, 4),
+                }
+                for t in sorted(tenants)
+            }
+
+
+fair_queue = FairShareQueue()
+
+
+def is_fair_share_enabled() -> bool:
+    return getattr(shared.opts, "queue_fair_share", False)
+
+
+def get_scheduling_policy() -> SchedulingPolicy:
+    policy = getattr(shared.opts, "queue_scheduling_policy", policy_fifo)
+
+    if policy == policy_affinity:
+        return CheckpointAffinityPolicy(
+            window=getattr(shared.opts, "queue_affinity_window", 20),
+            max_wait_seconds=getattr(shared.opts, "queue_affinity_max_wait_minutes", 10) * 60,
+        )
+
+    if policy == policy_sjf:
+        return ShortestJobFirstPolicy(
+            window=getattr(shared.opts, "queue_sjf_window", 50),
+            aging=getattr(shared.opts, "queue_sjf_aging", 6),
+        )
+
+    return SchedulingPolicy()
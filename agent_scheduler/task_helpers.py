@@ -1,12 +1,14 @@
 import io
+import os
 import zlib
 import base64
-import pickle
 import inspect
+import threading
 import requests
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
-from typing import Union, List, Dict
+from typing import Any, Callable, Union, List, Dict, NamedTuple, Optional, Tuple
 from enum import Enum
 from PIL import Image, ImageOps, ImageChops, ImageEnhance, ImageFilter, PngImagePlugin
 from numpy import ndarray
@@ -21,6 +23,17 @@ from modules.api.models import (
 )
 
 from .helpers import log, get_dict_attribute
+from .codec import (
+    pack_script_args,
+    unpack_script_args,
+    pack_image_params,
+    unpack_image_params,
+    decompress_into,
+    writable_bytes,
+)
+
+# image modes stored losslessly as PNG, other images are stored as raw pixels
+png_image_modes = ("1", "L", "LA", "P", "RGB", "RGBA")
 
 img2img_image_args_by_mode: Dict[int, List[List[str]]] = {
     0: [["init_img"]],
@@ -31,32 +44,213 @@ img2img_image_args_by_mode: Dict[int, List[List[str]]] = {
 }
 
 
-def get_script_by_name(script_name: str, is_img2img: bool = False, is_always_on: bool = False) -> scripts.Script:
-    script_runner = scripts.scripts_img2img if is_img2img else scripts.scripts_txt2img
-    available_scripts = script_runner.alwayson_scripts if is_always_on else script_runner.selectable_scripts
+class ArgPlan(NamedTuple):
+    """How a positional argument list maps to named arguments"""
+
+    arg_names: List[str]
+    varargs: Optional[str] = None
+
+
+class ArgPlanCache:
+    """Argument mapping plans of the generation functions and scripts, and scripts by title.
+
+    Inspecting signatures and scanning the script runners for every task is
+    wasted work, so both are computed once and kept until the UI reloads,
+    which reloads the scripts. Script lookups are also rebuilt when the
+    script runner changes.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__plans: Dict[Tuple[Callable, int], ArgPlan] = {}
+        self.__scripts: Dict[Tuple[bool, bool], Tuple[Any, int, Dict[str, scripts.Script], Dict[str, scripts.Script]]] = {}
+
+    def clear(self):
+        with self.__lock:
+            self.__plans.clear()
+            self.__scripts.clear()
+
+    def get_plan(self, fn: Callable, skip: int = 0) -> ArgPlan:
+        """Get the argument names of `fn`, without the first `skip` ones"""
+
+        key = (fn, skip)
+        plan = self.__plans.get(key, None)
+        if plan is None:
+            inspection = inspect.getfullargspec(fn)
+            plan = ArgPlan(inspection.args[skip:], inspection.varargs)
+            with self.__lock:
+                self.__plans[key] = plan
 
-    return next(
-        (s for s in available_scripts if s.title().lower() == script_name.lower()),
-        None,
+        return plan
+
+    def get_scripts(self, is_img2img: bool, is_always_on: bool, first: bool = False) -> Dict[str, scripts.Script]:
+        """Get the scripts of a script runner by lowercase title.
+
+        When titles collide, the last script wins, or the first one if `first` is set.
+        """
+
+        script_runner = scripts.scripts_img2img if is_img2img else scripts.scripts_txt2img
+        available_scripts = script_runner.alwayson_scripts if is_always_on else script_runner.selectable_scripts
+
+        key = (is_img2img, is_always_on)
+        cached = self.__scripts.get(key, None)
+        if cached is None or cached[0] is not script_runner or cached[1] != len(available_scripts):
+            by_title = {s.title().lower(): s for s in available_scripts}
+            first_by_title = {s.title().lower(): s for s in reversed(available_scripts)}
+            cached = (script_runner, len(available_scripts), by_title, first_by_title)
+            with self.__lock:
+                self.__scripts[key] = cached
+
+        return cached[3] if first else cached[2]
+
+
+arg_plans = ArgPlanCache()
+
+
+def get_ui_task_fn(is_img2img: bool) -> Callable:
+    return (
+        getattr(img2img, "img2img_create_processing", img2img.img2img)
+        if is_img2img
+        else getattr(txt2img, "txt2img_create_processing", txt2img.txt2img)
     )
 
 
-def load_image_from_url(url: str):
+def get_script_fn(script: scripts.Script) -> Callable:
+    return script.process if script.alwayson else script.run
+
+
+def get_script_by_name(script_name: str, is_img2img: bool = False, is_always_on: bool = False) -> scripts.Script:
+    return arg_plans.get_scripts(is_img2img, is_always_on, first=True).get(script_name.lower(), None)
+
+
+class ImageEncodePool:
+    """Encode image args on a bounded thread pool, keeping their order.
+
+    Downloads and PIL decoding / encoding release the GIL, so the images
+    of an img2img request are encoded in parallel. Single images and a
+    pool of 1 worker are encoded on the calling thread.
+    """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__executor: ThreadPoolExecutor = None
+        self.__executor_workers = 0
+
+    @property
+    def workers(self) -> int:
+        return int(getattr(shared.opts, "queue_image_encode_workers", 4))
+
+    def map(self, fn: Callable[[Any], Any], items: List) -> List:
+        workers = self.workers
+        if workers <= 1 or len(items) <= 1:
+            return [fn(item) for item in items]
+
+        with self.__lock:
+            if self.__executor is None or self.__executor_workers != workers:
+                if self.__executor is not None:
+                    self.__executor.shutdown(wait=False)
+                self.__executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="agent-scheduler-image-encode")
+                self.__executor_workers = workers
+            executor = self.__executor
+
+        return list(executor.map(fn, items))
+
+
+image_encode_pool = ImageEncodePool()
+
+
+def load_image_bytes_from_url(url: str) -> Optional[bytes]:
     try:
         response = requests.get(url)
-        buffer = io.BytesIO(response.content)
-        return Image.open(buffer)
+        response.raise_for_status()
+        return response.content
     except Exception as e:
         log.error(f"[AgentScheduler] Error downloading image from url: {e}")
         return None
 
 
+def load_image_from_url(url: str):
+    data = load_image_bytes_from_url(url)
+    if data is None:
+        return None
+
+    try:
+        return Image.open(io.BytesIO(data))
+    except Exception as e:
+        log.error(f"[AgentScheduler] Error opening image downloaded from url: {e}")
+        return None
+
+
+def sniff_image_format(data: bytes) -> Optional[str]:
+    """Get the format of complete PNG, JPEG or WebP image bytes from their structure, without decoding them"""
+
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        # IHDR must come first and IEND last
+        if data[12:16] == b"IHDR" and data[-8:-4] == b"IEND":
+            return "png"
+    elif data[:3] == b"\xff\xd8\xff":
+        # end of image marker, some encoders pad after it
+        if data.rstrip(b"\x00")[-2:] == b"\xff\xd9":
+            return "jpeg"
+    elif data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        # the RIFF size covers the rest of the file
+        if int.from_bytes(data[4:8], "little") + 8 <= len(data):
+            return "webp"
+
+    return None
+
+
+def encode_image_bytes_to_base64(data: bytes) -> Optional[str]:
+    """Pass already encoded PNG, JPEG or WebP bytes through as a data URL, returns None for other bytes"""
+
+    format = sniff_image_format(data)
+    if format is None:
+        return None
+
+    return f"data:image/{format};base64," + base64.b64encode(data).decode("utf-8")
+
+
+def encode_image_file_to_base64(path: str):
+    with open(path, "rb") as f:
+        data = f.read()
+
+    encoded = encode_image_bytes_to_base64(data)
+    if encoded is not None:
+        return encoded
+
+    return encode_image_to_base64(Image.open(io.BytesIO(data)))
+
+
 def encode_image_to_base64(image):
+    """Encode an image arg to a data URL.
+
+    PNG, JPEG and WebP bytes, downloaded or given, are passed through as
+    they are. Other images are encoded as PNG, with their generation info.
+    Strings that are not URLs (data URLs, base64) are returned unchanged.
+    """
+
     if isinstance(image, np.ndarray):
         image = Image.fromarray(image.astype("uint8"))
+    elif isinstance(image, (bytes, bytearray)):
+        encoded = encode_image_bytes_to_base64(image)
+        if encoded is not None:
+            return encoded
+        image = Image.open(io.BytesIO(image))
     elif isinstance(image, str):
         if image.startswith("http://") or image.startswith("https://"):
-            image = load_image_from_url(image)
+            data = load_image_bytes_from_url(image)
+            if data is None:
+                return None
+
+            encoded = encode_image_bytes_to_base64(data)
+            if encoded is not None:
+                return encoded
+
+            try:
+                image = Image.open(io.BytesIO(data))
+            except Exception as e:
+                log.error(f"[AgentScheduler] Error opening image downloaded from url: {e}")
+                return None
 
     if not isinstance(image, Image.Image):
         return image
@@ -75,7 +269,56 @@ def encode_image_to_base64(image):
         return "data:image/png;base64," + base64.b64encode(bytes_data).decode("utf-8")
 
 
-def serialize_image(image):
+def encode_image_arg(image: Image.Image) -> bytes:
+    with io.BytesIO() as output:
+        # fast compression, see benchmarks/image_args_codec.py
+        image.save(output, format="PNG", compress_level=1)
+        return output.getvalue()
+
+
+def decode_image_arg(data: bytes, mode: str) -> Image.Image:
+    image = Image.open(io.BytesIO(data))
+    image.load()
+    return image if image.mode == mode else image.convert(mode)
+
+
+def serialize_image_ref(image, images: List[bytes]) -> Optional[Dict]:
+    """Encode an 8-bit image as PNG appended to `images`, returns the reference to store instead.
+
+    Returns None if the image can not be stored losslessly as PNG.
+    """
+
+    if isinstance(image, np.ndarray):
+        shape = list(image.shape)
+        channels = shape[2] if image.ndim == 3 else 1
+        if image.dtype != np.uint8 or image.ndim not in (2, 3) or channels not in (1, 3, 4):
+            return None
+
+        mode = {1: "L", 3: "RGB", 4: "RGBA"}[channels]
+        images.append(encode_image_arg(Image.fromarray(image.reshape(shape[:2]) if channels == 1 else image)))
+        return {"ref": len(images) - 1, "format": "png", "cls": "ndarray", "mode": mode, "shape": shape, "dtype": "uint8"}
+    elif isinstance(image, Image.Image):
+        if image.mode not in png_image_modes:
+            return None
+
+        images.append(encode_image_arg(image))
+        return {"ref": len(images) - 1, "format": "png", "cls": "Image", "mode": image.mode, "size": image.size}
+
+    return None
+
+
+def serialize_image(image, images: List[bytes] = None):
+    """Serialize an image arg to JSON.
+
+    If `images` is given, images that can be are encoded as PNG into it
+    and referenced. Otherwise the raw pixels are compressed in the JSON.
+    """
+
+    if images is not None:
+        ref = serialize_image_ref(image, images)
+        if ref is not None:
+            return ref
+
     if isinstance(image, np.ndarray):
         shape = image.shape
         dtype = image.dtype
@@ -106,10 +349,15 @@ def serialize_image(image):
         return image
 
 
-def deserialize_image(image_str):
-    if isinstance(image_str, dict) and image_str.get("cls", None):
+def deserialize_image(image_str, images: List[bytes] = None):
+    if isinstance(image_str, dict) and image_str.get("ref", None) is not None:
+        image = decode_image_arg(images[image_str["ref"]], image_str["mode"])
+        if image_str["cls"] == "ndarray":
+            return np.array(image).reshape(image_str["shape"])
+        return image
+    elif isinstance(image_str, dict) and image_str.get("cls", None):
         cls = image_str["cls"]
-        data = zlib.decompress(base64.b64decode(image_str["data"]))
+        data = base64.b64decode(image_str["data"])
 
         if cls == "ndarray":
             # warn if required fields are missing
@@ -117,24 +365,28 @@ def deserialize_image(image_str):
                 log.warning(f"Missing dtype for ndarray")
             shape = tuple(image_str["shape"])
             dtype = np.dtype(image_str.get("dtype", "uint8"))
-            image = np.frombuffer(data, dtype=dtype)
-            return image.reshape(shape)
+            # decompress straight into the writable array, downstream code needs no copy
+            image = np.empty(shape, dtype=dtype)
+            decompress_into(data, writable_bytes(image))
+            return image
         elif cls == "Tensor":
             if image_str.get("device", None) is None:
                 log.warning(f"Missing device for Tensor")
             shape = tuple(image_str["shape"])
             dtype = np.dtype(image_str.get("dtype", "uint8"))
-            image_np = np.frombuffer(data, dtype=dtype)
-            return torch.from_numpy(image_np.reshape(shape)).to(device=image_str.get("device", "cpu"))
+            image_np = np.empty(shape, dtype=dtype)
+            decompress_into(data, writable_bytes(image_np))
+            return torch.from_numpy(image_np).to(device=image_str.get("device", "cpu"))
         else:
             size = tuple(image_str["size"])
             mode = image_str["mode"]
-            return Image.frombytes(mode, size, data)
+            # maps the pixels without a copy for most modes, PIL copies them before a write
+            return Image.frombuffer(mode, size, zlib.decompress(data), "raw", mode, 0, 1)
     else:
         return image_str
 
 
-def serialize_img2img_image_args(args: Dict):
+def serialize_img2img_image_args(args: Dict, images: List[bytes] = None):
     for mode, image_args in img2img_image_args_by_mode.items():
         for keys in image_args:
             if mode != args["mode"]:
@@ -142,15 +394,15 @@ def serialize_img2img_image_args(args: Dict):
                 args[keys[0]] = None
             elif len(keys) == 1:
                 image = args.get(keys[0], None)
-                args[keys[0]] = serialize_image(image)
+                args[keys[0]] = serialize_image(image, images)
             else:
                 value = args.get(keys[0], {})
                 image = value.get(keys[1], None)
-                value[keys[1]] = serialize_image(image)
+                value[keys[1]] = serialize_image(image, images)
                 args[keys[0]] = value
 
 
-def deserialize_img2img_image_args(args: Dict):
+def deserialize_img2img_image_args(args: Dict, images: List[bytes] = None):
     for mode, image_args in img2img_image_args_by_mode.items():
         if mode != args["mode"]:
             continue
@@ -158,11 +410,11 @@ def deserialize_img2img_image_args(args: Dict):
         for keys in image_args:
             if len(keys) == 1:
                 image = args.get(keys[0], None)
-                args[keys[0]] = deserialize_image(image)
+                args[keys[0]] = deserialize_image(image, images)
             else:
                 value = args.get(keys[0], {})
                 image = value.get(keys[1], None)
-                value[keys[1]] = deserialize_image(image)
+                value[keys[1]] = deserialize_image(image, images)
                 args[keys[0]] = value
 
 
@@ -192,12 +444,20 @@ def serialize_script_args(script_args: List):
         if type(a).__name__ == "UiControlNetUnit":
             script_args[i] = serialize_controlnet_args(a)
 
-    return zlib.compress(pickle.dumps(script_args))
+    return pack_script_args(script_args)
+
+
+def serialize_image_params(images: List[bytes]) -> Optional[bytes]:
+    return pack_image_params(images) if len(images) > 0 else None
+
+
+def deserialize_image_params(image_params: Optional[bytes]) -> List[bytes]:
+    return unpack_image_params(image_params)
 
 
 def deserialize_script_args(script_args: Union[bytes, List], UiControlNetUnit = None):
     if type(script_args) is bytes:
-        script_args = pickle.loads(zlib.decompress(script_args))
+        script_args = unpack_script_args(script_args)
 
     for i, a in enumerate(script_args):
         if isinstance(a, dict) and a.get("is_cnet", False):
@@ -239,12 +499,7 @@ def map_controlnet_args_to_api_task_args(args: Dict):
 
 
 def map_ui_task_args_list_to_named_args(args: List, is_img2img: bool):
-    fn = (
-        getattr(img2img, "img2img_create_processing", img2img.img2img)
-        if is_img2img
-        else getattr(txt2img, "txt2img_create_processing", txt2img.txt2img)
-    )
-    arg_names = inspect.getfullargspec(fn).args
+    arg_names = arg_plans.get_plan(get_ui_task_fn(is_img2img)).arg_names
 
     # SD WebUI 1.5.0 has new request arg
     if "request" in arg_names:
@@ -276,12 +531,7 @@ def map_ui_task_args_list_to_named_args(args: List, is_img2img: bool):
 
 
 def map_named_args_to_ui_task_args_list(named_args: Dict, script_args: List, is_img2img: bool):
-    fn = (
-        getattr(img2img, "img2img_create_processing", img2img.img2img)
-        if is_img2img
-        else getattr(txt2img, "txt2img_create_processing", txt2img.txt2img)
-    )
-    arg_names = inspect.getfullargspec(fn).args
+    arg_names = arg_plans.get_plan(get_ui_task_fn(is_img2img)).arg_names
 
     sampler_name = named_args.get("sampler_name", None)
     if sampler_name is not None:
@@ -304,12 +554,11 @@ def map_script_args_list_to_named(script: scripts.Script, args: List):
 
         return args
 
-    fn = script.process if script.alwayson else script.run
-    inspection = inspect.getfullargspec(fn)
-    arg_names = inspection.args[2:]
+    # skip self and p
+    arg_names, varargs = arg_plans.get_plan(get_script_fn(script), skip=2)
     named_script_args = dict(zip(arg_names, args[: len(arg_names)]))
-    if inspection.varargs is not None:
-        named_script_args[inspection.varargs] = args[len(arg_names) :]
+    if varargs is not None:
+        named_script_args[varargs] = args[len(arg_names) :]
 
     return named_script_args
 
@@ -318,12 +567,10 @@ def map_named_script_args_to_list(script: scripts.Script, named_args: Union[dict
     script_name = script.title().lower()
 
     if isinstance(named_args, dict):
-        fn = script.process if script.alwayson else script.run
-        inspection = inspect.getfullargspec(fn)
-        arg_names = inspection.args[2:]
+        arg_names, varargs = arg_plans.get_plan(get_script_fn(script), skip=2)
         args = [named_args.get(name, None) for name in arg_names]
-        if inspection.varargs is not None:
-            args.extend(named_args.get(inspection.varargs, []))
+        if varargs is not None:
+            args.extend(named_args.get(varargs, []))
 
         return args
 
@@ -454,8 +701,7 @@ def serialize_api_task_args(
     alwayson_scripts = get_dict_attribute(params, "alwayson_scripts", {})
     assert type(alwayson_scripts) is dict
 
-    script_runner = scripts.scripts_img2img if is_img2img else scripts.scripts_txt2img
-    allowed_alwayson_scripts = {s.title().lower(): s for s in script_runner.alwayson_scripts}
+    allowed_alwayson_scripts = arg_plans.get_scripts(is_img2img, is_always_on=True)
 
     valid_alwayson_scripts = {}
     for script_name, script_args in alwayson_scripts.items():
@@ -499,10 +745,9 @@ def serialize_api_task_args(
         if len(init_images) == 0:
             raise Exception("At least one init image is required")
 
-        for i, image in enumerate(init_images):
-            init_images[i] = encode_image_to_base64(image)
-
-        args.mask = encode_image_to_base64(args.mask)
+        encoded_images = image_encode_pool.map(encode_image_to_base64, [*init_images, args.mask])
+        init_images[:] = encoded_images[:-1]
+        args.mask = encoded_images[-1]
         if len(init_images) > 1:
             args.batch_size = len(init_images)
 
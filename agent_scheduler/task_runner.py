@@ -9,11 +9,10 @@ import gradio as gr
 
 from datetime import datetime, timezone
 from pydantic import BaseModel
-from typing import Any, Callable, Union, Optional, List, Dict
+from typing import Any, Callable, Union, Optional, List, Dict, Set, Tuple
 from fastapi import FastAPI
-from PIL import Image
 
-from modules import progress, shared, script_callbacks
+from modules import progress, shared, script_callbacks, sd_models, devices
 from modules.call_queue import queue_lock, wrap_gradio_call
 from modules.txt2img import txt2img
 from modules.img2img import img2img
@@ -24,8 +23,26 @@ from modules.api.models import (
 )
 
 from pika.adapters.blocking_connection import BlockingChannel
-from .db import TaskStatus, Task, task_manager
+from .db import TaskStatus, Task, task_manager, task_buffer
 from .mq import MQ_CHANNEL
+from .scheduling import get_scheduling_policy, get_task_model, get_loaded_model, fair_queue, is_fair_share_enabled
+from .model_cache import checkpoint_cache
+from .result_cache import result_cache, get_result_key
+from .metrics import metrics
+from .batching import get_batch_key, get_batch_overrides, split_batch_geninfo, split_batch_images
+from .prefetch import TaskPrefetcher
+from .postprocess import post_processor
+from .lease import lease_keeper
+from .executors import TaskExecutor, create_executor
+from .eta import eta_predictor
+from .oom import (
+    large_queue_priority_offset,
+    is_oom_adaptive,
+    is_large_task,
+    get_oom_retry_params,
+    get_oom_failure_message,
+)
+from .timing import TaskTimer, start_timer, current_timer, stop_timer
 from .helpers import (
     log,
     detect_control_net,
@@ -36,11 +53,14 @@ from .helpers import (
     _exit,
 )
 from .task_helpers import (
-    encode_image_to_base64,
+    arg_plans,
+    encode_image_file_to_base64,
     serialize_img2img_image_args,
     deserialize_img2img_image_args,
     serialize_script_args,
     deserialize_script_args,
+    serialize_image_params,
+    deserialize_image_params,
     serialize_api_task_args,
     map_ui_task_args_list_to_named_args,
     map_named_args_to_ui_task_args_list,
@@ -66,6 +86,17 @@ class ParsedTaskArgs(BaseModel):
     vae: Optional[str] = None
 
 
+class TaskRun:
+    """State of a task generating on an executor slot"""
+
+    def __init__(self, task: Task, urgent: bool = False):
+        self.task = task
+        self.urgent = urgent
+        self.interrupted = False
+        self.preempted: Optional[Dict[str, Any]] = None
+        self.saved_images_path: List[str] = []
+
+
 class TaskRunner:
     instance = None
 
@@ -74,9 +105,23 @@ class TaskRunner:
 
         self.__total_pending_tasks: int = 0
         self.__current_thread: threading.Thread = None
+        self.__prefetcher: TaskPrefetcher = None
+        self.__prefetched_args: Dict[str, ParsedTaskArgs] = {}
+        self.__executor: TaskExecutor = None
+        # ids of tasks being executed, excluded when selecting the next task
+        self.__claimed_ids: Set[str] = set()
+        self.__claim_lock = threading.Lock()
+        # ids of pending tasks to run before any other, see run_urgent
+        self.__urgent_ids: Set[str] = set()
+        # tasks generating on the executor slots, by id, and the one of the current thread
+        self.__runs: Dict[str, TaskRun] = {}
+        self.__local = threading.local()
+        # image saving is forced while any task generates
+        self.__samples_save: Optional[bool] = None
+        self.__samples_save_users = 0
         self.__api = Api(FastAPI(), queue_lock)
 
-        self.__saved_images_path: List[str] = []
+        script_callbacks.on_before_image_saved(self.__on_before_image_saved)
         script_callbacks.on_image_saved(self.__on_image_saved)
 
         self.script_callbacks = {
@@ -88,12 +133,13 @@ class TaskRunner:
 
         # Mark this to True when reload UI
         self.dispose = False
-        self.interrupted = None
 
         if TaskRunner.instance is not None:
             raise Exception("TaskRunner instance already exists")
         TaskRunner.instance = self
 
+        lease_keeper.start(on_requeued=self.execute_pending_tasks_threading)
+
     @property
     def current_task_id(self) -> Union[str, None]:
         return progress.current_task
@@ -106,6 +152,25 @@ class TaskRunner:
     def paused(self) -> bool:
         return getattr(shared.opts, "queue_paused", False)
 
+    @property
+    def preemption(self) -> bool:
+        return getattr(shared.opts, "queue_preemption", False)
+
+    @property
+    def coalescing(self) -> bool:
+        return getattr(shared.opts, "queue_coalesce_identical_tasks", False)
+
+    @property
+    def executor(self) -> TaskExecutor:
+        if self.__executor is None:
+            self.__create_executor()
+        return self.__executor
+
+    def __create_executor(self):
+        self.__executor = create_executor(self.__execute_task)
+        # queue ETAs are estimated for the slots of the executor in use, not the setting
+        eta_predictor.slots = self.__executor.slots
+
     def __serialize_ui_task_args(
         self,
         is_img2img: bool,
@@ -118,9 +183,10 @@ class TaskRunner:
             list(args), is_img2img
         )
 
-        # loop through named_args and serialize images
+        # loop through named_args and serialize images, encoded apart from the params
+        images: List[bytes] = []
         if is_img2img:
-            serialize_img2img_image_args(named_args)
+            serialize_img2img_image_args(named_args, images)
 
         if "request" in named_args:
             named_args["request"] = {"username": request.username}
@@ -135,8 +201,9 @@ class TaskRunner:
             }
         )
         script_params = serialize_script_args(script_args)
+        image_params = serialize_image_params(images)
 
-        return (params, script_params)
+        return (params, script_params, image_params)
 
     def __serialize_api_task_args(
         self,
@@ -171,6 +238,7 @@ class TaskRunner:
         script_args: List,
         checkpoint: str = None,
         vae: str = None,
+        image_params: bytes = None,
     ):
         """
         Deserialize UI task arguments
@@ -198,7 +266,7 @@ class TaskRunner:
 
         # loop through image_args and deserialize images
         if is_img2img:
-            deserialize_img2img_image_args(named_args)
+            deserialize_img2img_image_args(named_args, deserialize_image_params(image_params))
 
         # loop through script_args and deserialize images
         script_args = deserialize_script_args(script_args, self.UiControlNetUnit)
@@ -228,13 +296,12 @@ class TaskRunner:
             override["sd_vae"] = vae
             named_args["override_settings"] = override
 
-        # load images from disk
+        # load images from disk, encoded images are passed through as they are
         if is_img2img:
             init_images = named_args.get("init_images")
             for i, img in enumerate(init_images):
                 if isinstance(img, str) and os.path.isfile(img):
-                    image = Image.open(img)
-                    init_images[i] = encode_image_to_base64(image)
+                    init_images[i] = encode_image_file_to_base64(img)
 
         # force image saving
         named_args.update({"save_images": True, "send_images": False})
@@ -254,7 +321,12 @@ class TaskRunner:
 
         if is_ui and deserialization:
             named_args, script_args = self.__deserialize_ui_task_args(
-                is_img2img, named_args, script_args, checkpoint=checkpoint, vae=vae
+                is_img2img,
+                named_args,
+                script_args,
+                checkpoint=checkpoint,
+                vae=vae,
+                image_params=task.image_params,
             )
         elif deserialization:
             named_args, script_args = self.__deserialize_api_task_args(
@@ -285,7 +357,7 @@ class TaskRunner:
 
         vae = getattr(shared.opts, "sd_vae", "Automatic")
 
-        (params, script_args) = self.__serialize_ui_task_args(
+        (params, script_args, image_params) = self.__serialize_ui_task_args(
             is_img2img, *args, checkpoint=checkpoint, vae=vae, request=request
         )
 
@@ -296,12 +368,16 @@ class TaskRunner:
             type=task_type,
             params=params,
             script_params=script_args,
+            image_params=image_params,
+            tenant=f"ui:{request.username}" if getattr(request, "username", None) else "ui",
         )
-        task_manager.add_task(task)
+        self.__add_task(task)
 
         self.__run_callbacks(
             "task_registered", task_id, is_img2img=is_img2img, is_ui=True, args=params
         )
+        if self.__prefetcher is not None:
+            self.__prefetcher.prefetch()
         self.__total_pending_tasks += 1
 
         return task
@@ -316,6 +392,8 @@ class TaskRunner:
         vae: str = None,
         ack_tag: str = None,
         channel: BlockingChannel = None,
+        tenant: str = None,
+        expires_at: datetime = None,
     ):
         progress.add_task_to_queue(task_id)
 
@@ -331,10 +409,12 @@ class TaskRunner:
             params=params,
             script_params=script_params,
             ack_tag=ack_tag,
+            tenant=tenant,
+            expires_at=expires_at,
         )
         try:
 
-            res = task_manager.add_task(task)
+            res = self.__add_task(task)
             if res is True:
                 self.__run_callbacks(
                     "task_registered",
@@ -344,6 +424,8 @@ class TaskRunner:
                     args=params,
                 )
                 self.__total_pending_tasks += 1
+                if self.__prefetcher is not None:
+                    self.__prefetcher.prefetch()
                 self.__execute_api_task(task_id, False)
                 return Task
             else:
@@ -353,108 +435,618 @@ class TaskRunner:
         finally:
             return None
 
+    def __add_task(self, task: Task) -> bool:
+        if not getattr(shared.opts, "queue_group_commit", False):
+            return task_manager.add_task(task)
+
+        task_buffer.configure(
+            flush_interval=getattr(shared.opts, "queue_group_commit_interval_ms", 5) / 1000,
+            max_batch=getattr(shared.opts, "queue_group_commit_max_batch", 100),
+        )
+        return task_buffer.add_task(task)
+
+    def run_urgent(self, task_id: str) -> bool:
+        """Run a pending task before any other.
+
+        If preemption is enabled, the running task is interrupted at the next
+        sampling step and requeued, unless it is urgent itself, has run for less
+        than the min runtime or was already preempted too many times.
+        Returns True if the running task was preempted.
+        """
+
+        task_manager.prioritize_task(task_id, 0)
+        with self.__claim_lock:
+            self.__urgent_ids.add(task_id)
+        metrics.incr("preemption.requested")
+
+        with self.__claim_lock:
+            runs = list(self.__runs.values())
+        if not self.preemption or len(runs) != 1 or self.executor.slots > 1:
+            return False
+
+        run = runs[0]
+        running = run.task
+        if running.id == task_id:
+            return False
+
+        min_runtime = getattr(shared.opts, "queue_preemption_min_runtime_seconds", 10)
+        max_preemptions = getattr(shared.opts, "queue_preemption_max_per_task", 2)
+        runtime = (datetime.now(timezone.utc) - running.started_at).total_seconds()
+        preemptions = json.loads(running.params).get("preemptions", 0)
+        if run.urgent or runtime < min_runtime or preemptions >= max_preemptions:
+            log.info(f"[AgentScheduler] Task {task_id} will run after task {running.id}, which can not be preempted")
+            metrics.incr("preemption.skipped")
+            return False
+
+        log.info(f"[AgentScheduler] Preempting task {running.id} to run urgent task {task_id}")
+        run.preempted = {
+            "task_id": running.id,
+            "progress": {
+                "job_no": shared.state.job_no,
+                "job_count": shared.state.job_count,
+                "sampling_step": shared.state.sampling_step,
+                "sampling_steps": shared.state.sampling_steps,
+                "runtime_seconds": round(runtime, 2),
+            },
+        }
+        shared.state.interrupt()
+        return True
+
     def execute_task(self, task: Task, get_next_task: Callable[[], Task]):
         while True:
             if self.dispose:
                 break
 
             if progress.current_task is None:
-                task_id = task.id
-                is_img2img = task.type == "img2img"
-                log.info(f"[AgentScheduler] Executing task {task_id}")
-                task.started_at = datetime.now(timezone.utc)
+                self.__run_task(task)
+            else:
+                time.sleep(2)
+                continue
+
+            task = get_next_task()
+            if not task:
+                # finalizing the last tasks may requeue them, eg: OOM retries
+                post_processor.join()
+                task = get_next_task()
+
+            if not task:
+                self.__stop_prefetching()
+                if not self.paused:
+                    time.sleep(1)
+                    self.__on_completed()
+                break
+
+        self.__stop_prefetching()
+
+    def __run_task(self, task: Task):
+        task_id = task.id
+        is_img2img = task.type == "img2img"
+        log.info(f"[AgentScheduler] Executing task {task_id}")
+        task.started_at = datetime.now(timezone.utc)
+
+        with self.__claim_lock:
+            urgent = task_id in self.__urgent_ids
+            self.__urgent_ids.discard(task_id)
 
+        timer = start_timer()
+        task_args = self.__prefetched_args.pop(task_id, None)
+        if task_args is None:
+            with timer.phase("deserialize"):
                 task_args = self.parse_task_args(task)
-                task_meta = {
-                    "is_img2img": is_img2img,
-                    "is_ui": task_args.is_ui,
-                    "task": task,
-                }
 
-                self.interrupted = None
-                self.__saved_images_path = []
-                self.__run_callbacks("task_started", task_id, **task_meta)
+        if self.__prefetcher is not None:
+            self.__prefetcher.prefetch(running_id=task_id)
+
+        if result_cache.enabled and self.__finish_from_cache(task, task_args):
+            fair_queue.release(task_id)
+            stop_timer()
+            return
+
+        if is_large_task(task):
+            log.info(f"[AgentScheduler] Task {task_id} is from the large queue, freeing memory first")
+            devices.torch_gc()
+
+        checkpoint_cache.activate(get_task_model(task)[0])
+        checkpoint_cache.lookahead(running_id=task_id)
 
-                # enable image saving
-                samples_save = shared.opts.samples_save
+        key = get_result_key(task) if self.coalescing else None
+        duplicates: List[Task] = []
+        with self.__claim_lock:
+            # claim duplicates first, so they are not generated again as part of the batch
+            if key is not None:
+                duplicates = self.__get_duplicates(task, key)
+                self.__claimed_ids.update(t.id for t in duplicates)
+
+            batch = self.__get_batch(task, task_args)
+            self.__claimed_ids.update(t.id for t in batch)
+
+        claimed_ids = [t.id for t in batch + duplicates]
+
+        def release_claims():
+            lease_keeper.release(claimed_ids)
+            with self.__claim_lock:
+                self.__claimed_ids.difference_update(claimed_ids)
+
+        # mark the tasks as running, with a lease kept alive until they are finalized.
+        # the leader is claimed first, so batch members are only claimed once it is held
+        try:
+            claimed = lease_keeper.claim([task])
+        except Exception:
+            fair_queue.release(task_id)
+            release_claims()
+            stop_timer()
+            raise
+
+        if task.status == TaskStatus.RUNNING and len(batch) > 1:
+            try:
+                claimed += lease_keeper.claim(batch[1:])
+            except Exception as e:
+                log.warning(f"[AgentScheduler] Failed to claim the batch of task {task_id}, running it alone: {e}")
+
+        if task.status != TaskStatus.RUNNING:
+            fair_queue.release(task_id)
+            release_claims()
+            stop_timer()
+            return
+        batch = claimed
+
+        for t in batch:
+            fair_queue.served(t.tenant, t.id)
+
+        for t in duplicates:
+            log.info(f"[AgentScheduler] Task {t.id} is identical to task {task_id}, attaching it")
+            t.started_at = task.started_at
+            self.__run_callbacks("task_started", t.id, **self.__get_task_meta(t, self.parse_task_args(t, False)))
+
+        try:
+            finalize, res = self.__execute_batch(task, task_args, batch, urgent=urgent)
+        except Exception:
+            release_claims()
+            stop_timer()
+            raise
+
+        def post_process():
+            # claims are kept until the tasks are finalized, so they are not picked again meanwhile
+            try:
+                finalize()
+                if key is not None:
+                    self.__finish_duplicates(task, key, duplicates)
+            finally:
+                release_claims()
+
+        if isinstance(res, OutOfMemoryError):
+            # pause the queue or requeue a smaller retry before the next task starts, it would run out of memory too
+            post_process()
+            stop_timer()
+            return
+
+        # the next task can start generating while this one is finalized
+        post_processor.configure(
+            workers=getattr(shared.opts, "queue_postprocess_workers", 2),
+            max_pending=getattr(shared.opts, "queue_postprocess_max_pending", 4),
+        )
+        post_processor.submit(post_process, timer=current_timer())
+        stop_timer()
+
+    def __finish_duplicates(self, task: Task, key: str, duplicates: List[Task]):
+        """Complete the tasks attached to `task` with its result"""
+
+        leader = task_manager.get_task(task.id)
+        if leader is None or leader.status != TaskStatus.DONE:
+            if len(duplicates) > 0:
+                log.info(f"[AgentScheduler] Task {task.id} did not succeed, attached tasks will run on their own")
+            return
+
+        # also attach the duplicates registered while the leader was running
+        with self.__claim_lock:
+            late_duplicates = self.__get_duplicates(task, key)
+            self.__claimed_ids.update(t.id for t in late_duplicates)
+        duplicates.extend(late_duplicates)
+
+        # attached tasks did not generate anything, they get their own timings
+        stop_timer()
+        result: Dict = json.loads(leader.result)
+        for t in duplicates:
+            current = task_manager.get_task(t.id)
+            if current is None or current.status != TaskStatus.PENDING:
+                continue
+
+            current_args = self.parse_task_args(current, False)
+            if t in late_duplicates:
+                self.__run_callbacks("task_started", t.id, **self.__get_task_meta(current, current_args))
+
+            current.started_at = t.started_at or task.started_at
+            self.__finish_task(
+                current,
+                current_args,
+                json.dumps(result["geninfo"]),
+                result["images"],
+            )
+            metrics.incr("coalescing.attached")
+
+    def __finish_from_cache(self, task: Task, task_args: ParsedTaskArgs) -> bool:
+        """Complete the task with the result of a previous identical task, returns False on cache miss"""
+
+        key = get_result_key(task)
+        if key is None:
+            return False
+
+        result = result_cache.lookup(key)
+        if result is None:
+            # stored with the result, so the next identical task can reuse it
+            task.result_key = key
+            return False
+
+        log.info(f"[AgentScheduler] Task {task.id} reuses the cached result of an identical task")
+        self.__run_callbacks("task_started", task.id, **self.__get_task_meta(task, task_args))
+        self.__finish_task(task, task_args, json.dumps(result["geninfo"]), result["images"])
+        return True
+
+    def __execute_batch(
+        self, task: Task, task_args: ParsedTaskArgs, batch: List[Task], urgent: bool = False
+    ) -> Tuple[Callable[[], None], Union[str, Exception, None]]:
+        """Generate the batch, returns the function that finalizes its tasks and the generation result"""
+        task_id = task.id
+
+        # each slot has its own run, so concurrent tasks do not mix their state
+        run = TaskRun(task, urgent=urgent)
+        with self.__claim_lock:
+            self.__runs[task_id] = run
+        self.__local.run = run
+        for t in batch:
+            t.started_at = task.started_at
+            self.__run_callbacks("task_started", t.id, **self.__get_task_meta(t, task_args))
+
+        self.__enable_image_saving()
+
+        overrides = None
+        if len(batch) > 1:
+            log.info(f"[AgentScheduler] Batching tasks {', '.join(t.id for t in batch)}")
+            metrics.incr("batching.batches")
+            metrics.incr("batching.batched_tasks", len(batch))
+            overrides = get_batch_overrides(batch)
+
+        timer = current_timer()
+        metrics.incr("executor.busy_slots")
+        start = time.perf_counter()
+        try:
+            res = self.executor.execute(task, task_args, overrides)
+        finally:
+            metrics.incr("executor.busy_slots", -1)
+            # model loading and image saving happen inside the executor, but are reported apart
+            elapsed = time.perf_counter() - start
+            timer.add("generation", elapsed - timer.get("model_load") - timer.get("image_saving"))
+
+            self.__restore_image_saving()
+            with self.__claim_lock:
+                self.__runs.pop(task_id, None)
+            self.__local.run = None
+
+        interrupted = run.interrupted
+        preempted = run.preempted
+        saved_images_path = run.saved_images_path
+
+        def finalize():
+            if preempted is not None:
+                # the requeued run saves its own images
+                self.__delete_saved_images(saved_images_path)
+                for t in batch:
+                    self.__requeue_preempted_task(t, preempted["progress"])
+            elif len(batch) > 1 and res and not isinstance(res, Exception) and not interrupted:
+                images = [path for path in saved_images_path if not self.__is_grid_image(path)]
+                split_images = split_batch_images(images, len(batch))
+                if split_images is None:
+                    # never hand out images that may belong to another task
+                    log.warning(
+                        f"[AgentScheduler] Batch of task {task_id} saved {len(images)} images for "
+                        f"{len(batch)} tasks, running its tasks one by one"
+                    )
+                    metrics.incr("batching.split_failures")
+                    self.__delete_saved_images(saved_images_path)
+                    for t in batch:
+                        self.__requeue_unbatched_task(t)
+                    return
+
+                geninfos = split_batch_geninfo(json.loads(res), len(batch))
+                for i, t in enumerate(batch):
+                    self.__finish_task(t, task_args, json.dumps(geninfos[i]), split_images[i])
+            else:
+                for t in batch:
+                    self.__finish_task(
+                        t,
+                        task_args,
+                        res,
+                        saved_images_path.copy(),
+                        interrupted=interrupted,
+                        batched=len(batch) > 1,
+                    )
+
+        return (finalize, res)
+
+    def __enable_image_saving(self):
+        with self.__claim_lock:
+            if self.__samples_save_users == 0:
+                self.__samples_save = shared.opts.samples_save
                 shared.opts.samples_save = True
+            self.__samples_save_users += 1
 
-                res = self.__execute_task(task_id, is_img2img, task_args)
+    def __restore_image_saving(self):
+        with self.__claim_lock:
+            self.__samples_save_users -= 1
+            if self.__samples_save_users == 0:
+                shared.opts.samples_save = self.__samples_save
 
-                # disable image saving
-                shared.opts.samples_save = samples_save
+    def interrupt_task(self, task_id: str) -> bool:
+        """Mark a generating task as interrupted, returns False if it is not generating"""
 
-                if not res or isinstance(res, Exception):
-                    if isinstance(res, OutOfMemoryError):
-                        log.error(
-                            f"[AgentScheduler] Task {task_id} failed: CUDA OOM. Queue will be paused."
-                        )
-                        shared.opts.queue_paused = True
-                    else:
-                        log.error(f"[AgentScheduler] Task {task_id} failed: {res}")
-                        log.debug(traceback.format_exc())
-
-                    if getattr(
-                        shared.opts, "queue_automatic_requeue_failed_task", False
-                    ):
-                        log.info(f"[AgentScheduler] Requeue task {task_id}")
-                        task.status = TaskStatus.PENDING
-                        task.priority = int(
-                            datetime.now(timezone.utc).timestamp() * 1000
-                        )
-                        task_manager.update_task(task)
-                    else:
-                        task.status = TaskStatus.FAILED
-                        task.result = str(res) if res else None
-                        task_manager.update_task(task)
-                        self.__run_callbacks(
-                            "task_finished",
-                            task_id,
-                            status=TaskStatus.FAILED,
-                            **task_meta,
-                        )
-                else:
-                    is_interrupted = self.interrupted == task_id
-                    if is_interrupted:
-                        log.info(f"\n[AgentScheduler] Task {task.id} interrupted")
-                        task.status = TaskStatus.INTERRUPTED
-                        task_manager.update_task(task)
-                        self.__run_callbacks(
-                            "task_finished",
-                            task_id,
-                            status=TaskStatus.INTERRUPTED,
-                            **task_meta,
-                        )
-                    else:
-                        geninfo = json.loads(res)
-                        result = {
-                            "images": self.__saved_images_path.copy(),
-                            "geninfo": geninfo,
-                        }
-
-                        task.status = TaskStatus.DONE
-                        task.finished_at = datetime.now(timezone.utc)
-                        task.result = json.dumps(result)
-                        task_manager.update_task(task)
-                        self.__run_callbacks(
-                            "task_finished",
-                            task_id,
-                            status=TaskStatus.DONE,
-                            result=result,
-                            **task_meta,
-                        )
-
-                self.__saved_images_path = []
+        with self.__claim_lock:
+            run = self.__runs.get(task_id, None)
+        if run is None:
+            return False
+
+        run.interrupted = True
+        return True
+
+    def __finish_task(
+        self,
+        task: Task,
+        task_args: ParsedTaskArgs,
+        res: Union[str, Exception, None],
+        images: List[str],
+        interrupted: bool = False,
+        batched: bool = False,
+    ):
+        task_id = task.id
+        task_meta = self.__get_task_meta(task, task_args)
+
+        # each task of a batch gets its own finalize and callbacks timings
+        timer = TaskTimer()
+        timer.phases.update((current_timer() or timer).phases)
+        task.timings = timer.to_dict()
+
+        # only done tasks are result cache entries
+        if not res or isinstance(res, Exception) or interrupted:
+            task.result_key = None
+
+        adaptive_oom = isinstance(res, OutOfMemoryError) and is_oom_adaptive()
+        if adaptive_oom:
+            devices.torch_gc()
+            if self.__retry_out_of_memory_task(task, timer, batched=batched):
+                task_manager.set_task_timings(task_id, timer.to_dict())
+                return
+
+            metrics.incr("oom.failures")
+            res = OutOfMemoryError(get_oom_failure_message(task))
+
+        if not res or isinstance(res, Exception):
+            if adaptive_oom:
+                log.error(f"[AgentScheduler] Task {task_id} failed: {res}")
+            elif isinstance(res, OutOfMemoryError):
+                log.error(
+                    f"[AgentScheduler] Task {task_id} failed: CUDA OOM. Queue will be paused."
+                )
+                shared.opts.queue_paused = True
             else:
-                time.sleep(2)
-                continue
+                log.error(f"[AgentScheduler] Task {task_id} failed: {res}")
+                log.debug(traceback.format_exc())
+
+            # requeueing a task that still runs out of memory would loop forever
+            if not adaptive_oom and getattr(
+                shared.opts, "queue_automatic_requeue_failed_task", False
+            ):
+                log.info(f"[AgentScheduler] Requeue task {task_id}")
+                task.status = TaskStatus.PENDING
+                task.priority = int(
+                    datetime.now(timezone.utc).timestamp() * 1000
+                )
+                with timer.phase("finalize"):
+                    task_manager.update_task(task)
+            else:
+                task.status = TaskStatus.FAILED
+                task.result = str(res) if res else None
+                with timer.phase("finalize"):
+                    task_manager.update_task(task)
+                with timer.phase("callbacks"):
+                    self.__run_callbacks(
+                        "task_finished",
+                        task_id,
+                        status=TaskStatus.FAILED,
+                        **task_meta,
+                    )
+        else:
+            if interrupted:
+                log.info(f"\n[AgentScheduler] Task {task.id} interrupted")
+                task.status = TaskStatus.INTERRUPTED
+                with timer.phase("finalize"):
+                    task_manager.update_task(task)
+                with timer.phase("callbacks"):
+                    self.__run_callbacks(
+                        "task_finished",
+                        task_id,
+                        status=TaskStatus.INTERRUPTED,
+                        **task_meta,
+                    )
+            else:
+                geninfo = json.loads(res)
+                result = {
+                    "images": images,
+                    "geninfo": geninfo,
+                }
 
-            task = get_next_task()
-            if not task:
-                if not self.paused:
-                    time.sleep(1)
-                    self.__on_completed()
+                task.status = TaskStatus.DONE
+                task.finished_at = datetime.now(timezone.utc)
+                task.result = json.dumps(result)
+                with timer.phase("finalize"):
+                    task_manager.update_task(task)
+                with timer.phase("callbacks"):
+                    self.__run_callbacks(
+                        "task_finished",
+                        task_id,
+                        status=TaskStatus.DONE,
+                        result=result,
+                        **task_meta,
+                    )
+
+        task_manager.set_task_timings(task_id, timer.to_dict())
+
+    def __delete_saved_images(self, saved_images_path: List[str]):
+        """Delete the images of a run that is requeued, with their info text files"""
+
+        for path in saved_images_path:
+            paths = [path]
+            if getattr(shared.opts, "save_txt", False):
+                paths.append(os.path.splitext(path)[0] + ".txt")
+            for p in paths:
+                try:
+                    if os.path.exists(p):
+                        os.remove(p)
+                except OSError as e:
+                    log.warning(f"[AgentScheduler] Failed to delete image {p} of a requeued task: {e}")
+
+    def __requeue_preempted_task(self, task: Task, progress: Dict[str, Any]):
+        params: Dict = json.loads(task.params)
+        params["preemptions"] = params.get("preemptions", 0) + 1
+        params["preempted_progress"] = progress
+
+        task.params = json.dumps(params)
+        task.status = TaskStatus.PENDING
+        task.result_key = None
+        task_manager.update_task(task)
+
+        log.info(f"[AgentScheduler] Task {task.id} was preempted at step {progress['sampling_step']}, requeued")
+        metrics.incr("preemption.preempted")
+
+    def __requeue_unbatched_task(self, task: Task):
+        params: Dict = json.loads(task.params)
+        params["unbatched"] = True
+
+        task.params = json.dumps(params)
+        task.status = TaskStatus.PENDING
+        task.result_key = None
+        task_manager.update_task(task)
+
+    def __retry_out_of_memory_task(self, task: Task, timer: TaskTimer, batched: bool = False) -> bool:
+        """Requeue a smaller version of a task that ran out of memory, returns False if it can not be reduced"""
+
+        params = get_oom_retry_params(task, batched=batched)
+        if params is None:
+            return False
+
+        args: Dict = params.get("args", {})
+        if params.get("large_queue", False) and not is_large_task(task):
+            log.warning(f"[AgentScheduler] Task {task.id} ran out of memory at batch size 1, moving it to the large queue")
+            task.priority += large_queue_priority_offset
+            metrics.incr("oom.large_queue")
+        else:
+            log.warning(
+                f"[AgentScheduler] Task {task.id} ran out of memory, retrying with "
+                f"batch size {args.get('batch_size', 1)} and {args.get('n_iter', 1)} iterations"
+            )
+            metrics.incr("oom.retries")
+
+        task.params = json.dumps(params)
+        task.status = TaskStatus.PENDING
+        with timer.phase("finalize"):
+            task_manager.update_task(task)
+        return True
+
+    def __get_task_meta(self, task: Task, task_args: ParsedTaskArgs):
+        return {
+            "is_img2img": task.type == "img2img",
+            "is_ui": task_args.is_ui,
+            "task": task,
+        }
+
+    def __get_batch(self, task: Task, task_args: ParsedTaskArgs) -> List[Task]:
+        """Find pending tasks that can be generated in the same batch as `task`"""
+
+        max_size = int(getattr(shared.opts, "queue_batch_max_size", 1))
+        if max_size <= 1 or task_args.is_ui:
+            return [task]
+
+        key = get_batch_key(task)
+        if key is None:
+            return [task]
+
+        batch = [task]
+        pending_tasks = task_manager.get_tasks(status=TaskStatus.PENDING, limit=max_size * 10)
+        for t in pending_tasks:
+            if len(batch) >= max_size:
                 break
+            if t.id == task.id or t.id in self.__claimed_ids or t.is_expired():
+                continue
+            if get_batch_key(t) == key:
+                batch.append(t)
+
+        return batch
+
+    def __get_duplicates(self, task: Task, key: str) -> List[Task]:
+        """Find unclaimed pending tasks with the same result key as `task`"""
+
+        window = int(getattr(shared.opts, "queue_coalesce_window", 100))
+        pending_tasks = task_manager.get_tasks(status=TaskStatus.PENDING, limit=window)
+
+        duplicates = []
+        for t in pending_tasks:
+            if t.id == task.id or t.id in self.__claimed_ids or t.is_expired():
+                continue
+            if get_result_key(t) == key:
+                duplicates.append(t)
+
+        return duplicates
+
+    def __is_grid_image(self, path: str):
+        outpath_grids = shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids
+        return path.startswith(outpath_grids)
+
+    def dispatch_tasks(self, task: Task):
+        """Claim pending tasks and run them concurrently on the executor slots"""
+
+        slots = threading.Semaphore(self.executor.slots)
+        slot_threads: List[threading.Thread] = []
+
+        def run(task: Task):
+            try:
+                self.__run_task(task)
+            except Exception as e:
+                log.error(f"[AgentScheduler] Task {task.id} crashed: {e}")
+                log.debug(traceback.format_exc())
+            finally:
+                with self.__claim_lock:
+                    self.__claimed_ids.discard(task.id)
+                slots.release()
+
+        while not self.dispose:
+            if task is None:
+                slot_threads = [t for t in slot_threads if t.is_alive()]
+                if len(slot_threads) > 0:
+                    # wait for a running task to finish before looking for more work
+                    slot_threads[0].join(timeout=1)
+                elif post_processor.join(timeout=0):
+                    break
+                else:
+                    # finalizing the last tasks may requeue them, eg: OOM retries
+                    post_processor.join()
+            else:
+                slots.acquire()
+                thread = threading.Thread(target=run, args=(task,))
+                thread.daemon = True
+                thread.start()
+                slot_threads.append(thread)
+
+            task = self.__get_pending_task()
+            if task is not None:
+                with self.__claim_lock:
+                    # it might have been claimed by a batch in the meantime
+                    if task.id in self.__claimed_ids:
+                        fair_queue.release(task.id)
+                        task = None
+                    else:
+                        self.__claimed_ids.add(task.id)
+
+        if not self.dispose and not self.paused:
+            time.sleep(1)
+            self.__on_completed()
 
     def execute_pending_tasks_threading(self):
         if self.paused:
@@ -467,18 +1059,41 @@ class TaskRunner:
 
         pending_task = self.__get_pending_task()
         if pending_task:
+            self.__create_executor()
+            if self.__executor.slots > 1:
+                log.info(f"[AgentScheduler] Dispatching tasks to {self.__executor.slots} {self.__executor.name} slots")
+                self.__current_thread = threading.Thread(
+                    target=self.dispatch_tasks,
+                    args=(pending_task,),
+                )
+                self.__current_thread.daemon = True
+                self.__current_thread.start()
+                return
+
+            get_next_task = self.__get_pending_task
+            prefetch_depth = int(getattr(shared.opts, "queue_prefetch_depth", 0))
+            if prefetch_depth > 0:
+                self.__prefetcher = TaskPrefetcher(
+                    self.__select_pending_task,
+                    self.parse_task_args,
+                    depth=prefetch_depth,
+                )
+                get_next_task = self.__get_prefetched_task
+
             # Start the infinite loop in a separate thread
             self.__current_thread = threading.Thread(
                 target=self.execute_task,
                 args=(
                     pending_task,
-                    self.__get_pending_task,
+                    get_next_task,
                 ),
             )
             self.__current_thread.daemon = True
             self.__current_thread.start()
 
-    def __execute_task(self, task_id: str, is_img2img: bool, task_args: ParsedTaskArgs):
+    def __execute_task(self, task_id: str, is_img2img: bool, task_args: ParsedTaskArgs, overrides: Dict = None):
+        self.__load_checkpoint(task_args.checkpoint)
+
         if task_args.is_ui:
             ui_args = map_named_args_to_ui_task_args_list(
                 task_args.named_args, task_args.script_args, is_img2img
@@ -489,10 +1104,24 @@ class TaskRunner:
             return self.__execute_api_task(
                 task_id,
                 is_img2img,
+                overrides=overrides,
                 script_args=task_args.script_args,
                 **task_args.named_args,
             )
 
+    def __load_checkpoint(self, checkpoint: Optional[str]):
+        """Switch to the task checkpoint before generating, so the swap is timed apart"""
+
+        if checkpoint is None or checkpoint == "System":
+            return
+
+        checkpoint_info = sd_models.get_closet_checkpoint_match(checkpoint)
+        if checkpoint_info is None or checkpoint_info.title == get_loaded_model()[0]:
+            return
+
+        with queue_lock, (current_timer() or TaskTimer()).phase("model_load"):
+            sd_models.reload_model_weights(info=checkpoint_info)
+
     def __execute_ui_task(self, task_id: str, is_img2img: bool, *args):
         func = wrap_gradio_call(img2img if is_img2img else txt2img, add_stats=True)
 
@@ -522,17 +1151,24 @@ class TaskRunner:
 
             return res
 
-    def __execute_api_task(self, task_id: str, is_img2img: bool, **kwargs):
+    def __execute_api_task(self, task_id: str, is_img2img: bool, overrides: Dict = None, **kwargs):
         progress.start_task(task_id)
 
         res = None
         try:
+            req = (
+                StableDiffusionImg2ImgProcessingAPI(**kwargs)
+                if is_img2img
+                else StableDiffusionTxt2ImgProcessingAPI(**kwargs)
+            )
+            # overrides bypass validation, eg: a list of prompts for batched tasks
+            for k, v in (overrides or {}).items():
+                setattr(req, k, v)
+
             result = (
-                self.__api.img2imgapi(StableDiffusionImg2ImgProcessingAPI(**kwargs))
+                self.__api.img2imgapi(req)
                 if is_img2img
-                else self.__api.text2imgapi(
-                    StableDiffusionTxt2ImgProcessingAPI(**kwargs)
-                )
+                else self.__api.text2imgapi(req)
             )
             res = result.info
         except Exception as e:
@@ -566,6 +1202,13 @@ class TaskRunner:
         #     if deleted_rows > 0:
         #         log.debug(f"[AgentScheduler] Deleted {deleted_rows} tasks older than {retention_days} days")
 
+        lease_keeper.reap()
+
+        expired_rows = task_manager.expire_tasks()
+        if expired_rows > 0:
+            log.info(f"[AgentScheduler] Dropped {expired_rows} tasks past their deadline")
+            metrics.incr("tasks.expired", expired_rows)
+
         self.__total_pending_tasks = task_manager.count_tasks(status="pending")
 
         # get more task if needed
@@ -573,22 +1216,99 @@ class TaskRunner:
             log.info(
                 f"[AgentScheduler] Total pending tasks: {self.__total_pending_tasks}"
             )
-            pending_tasks = task_manager.get_tasks(status="pending", limit=1)
-            if len(pending_tasks) > 0:
-                return pending_tasks[0]
+            return self.__select_pending_task()
         else:
             log.info("[AgentScheduler] Task queue is empty")
             self.__run_callbacks("task_cleared")
 
+    def __select_pending_task(self, exclude: Set[str] = None) -> Optional[Task]:
+        with self.__claim_lock:
+            exclude = (exclude or set()) | self.__claimed_ids
+            urgent_ids = [id for id in self.__urgent_ids if id not in exclude]
+
+        # urgent tasks bypass the scheduling policy
+        for id in urgent_ids:
+            task = task_manager.get_task(id)
+            if task is not None and task.status == TaskStatus.PENDING and not task.is_expired():
+                return task
+            with self.__claim_lock:
+                self.__urgent_ids.discard(id)
+
+        policy = get_scheduling_policy()
+        fair_share = is_fair_share_enabled()
+        tenants = [None]
+        if fair_share:
+            # fallback to any tenant, the pending tasks of the first ones might all be claimed
+            tenants = fair_queue.order_tenants(task_manager.count_tasks_by_tenant()) + [None]
+
+        for tenant in tenants:
+            pending_tasks = task_manager.get_tasks(status="pending", tenant=tenant, limit=policy.window + len(exclude))
+            # tasks may expire between two sweeps
+            pending_tasks = [t for t in pending_tasks if t.id not in exclude and not t.is_expired()][: policy.window]
+            if len(pending_tasks) > 0:
+                task = policy.select(pending_tasks)
+                # charged now, so prefetching the next tasks moves on to the next tenants
+                if fair_share and task is not None:
+                    fair_queue.reserve(task)
+                return task
+
+        return None
+
+    def __get_prefetched_task(self):
+        if self.dispose or self.paused or self.__prefetcher is None or len(self.__urgent_ids) > 0:
+            return self.__get_pending_task()
+
+        while True:
+            prefetched = self.__prefetcher.next()
+            if prefetched is None:
+                return self.__get_pending_task()
+
+            task, task_args = prefetched
+            # the task might have been edited, deleted or started elsewhere after being prefetched
+            current = task_manager.get_task(task.id)
+            if current is None or current.status != TaskStatus.PENDING or current.is_expired():
+                fair_queue.release(task.id)
+                continue
+
+            if task_args is not None and current.updated_at == task.updated_at:
+                self.__prefetched_args[task.id] = task_args
+
+            return current
+
+    def __stop_prefetching(self):
+        if self.__prefetcher is not None:
+            self.__prefetcher.stop()
+            self.__prefetcher = None
+            # the prefetched tasks that were dropped will not run
+            fair_queue.release_all()
+        self.__prefetched_args.clear()
+
+    def __on_before_image_saved(self, data: script_callbacks.ImageSaveParams):
+        timer = current_timer()
+        if timer is not None:
+            timer.mark("image_saving")
+
     def __on_image_saved(self, data: script_callbacks.ImageSaveParams):
         if self.current_task_id is None:
             return
 
-        outpath_grids = shared.opts.outdir_grids or shared.opts.outdir_txt2img_grids
-        if data.filename.startswith(outpath_grids):
-            self.__saved_images_path.insert(0, data.filename)
+        timer = current_timer()
+        if timer is not None:
+            timer.end("image_saving")
+
+        run: Optional[TaskRun] = getattr(self.__local, "run", None)
+        if run is None:
+            with self.__claim_lock:
+                runs = list(self.__runs.values())
+            if len(runs) != 1:
+                log.warning(f"[AgentScheduler] Image {data.filename} was saved outside of a task")
+                return
+            run = runs[0]
+
+        if self.__is_grid_image(data.filename):
+            run.saved_images_path.insert(0, data.filename)
         else:
-            self.__saved_images_path.append(data.filename)
+            run.saved_images_path.append(data.filename)
 
     def __on_completed(self):
         action = getattr(shared.opts, "queue_completion_action", "Do nothing")
@@ -694,6 +1414,8 @@ def get_instance(block) -> TaskRunner:
         else:
 
             def on_before_reload():
+                # scripts are reloaded, their mapping plans are stale
+                arg_plans.clear()
                 # Tell old instance to stop
                 TaskRunner.instance.dispose = True
                 # force recreate the instance
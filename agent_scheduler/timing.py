@@ -0,0 +1,94 @@
+import time
+import threading
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+_local = threading.local()
+
+# phases recorded for each task, in execution order
+task_phases = [
+    "deserialize",
+    "model_load",
+    "generation",
+    "image_saving",
+    "finalize",
+    "callbacks",
+]
+
+
+class TaskTimer:
+    """Accumulate wall-clock seconds spent in each phase of a task"""
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+        self.__marks: Dict[str, float] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name: str, seconds: float):
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def mark(self, name: str):
+        """Start a phase whose end is reported from another callback, see `end`"""
+
+        self.__marks[name] = time.perf_counter()
+
+    def end(self, name: str):
+        start = self.__marks.pop(name, None)
+        if start is not None:
+            self.add(name, time.perf_counter() - start)
+
+    def get(self, name: str) -> float:
+        return self.phases.get(name, 0.0)
+
+    def to_dict(self) -> Dict[str, float]:
+        return {k: round(v, 4) for k, v in self.phases.items()}
+
+
+def start_timer(timer: TaskTimer = None) -> TaskTimer:
+    """Set the timer of the task running on the current thread, a new one by default"""
+
+    _local.timer = timer or TaskTimer()
+    return _local.timer
+
+
+def current_timer() -> Optional[TaskTimer]:
+    """The timer of the task running on the current thread, if any"""
+
+    return getattr(_local, "timer", None)
+
+
+def stop_timer():
+    _local.timer = None
+
+
+def aggregate_timings(timings: List[Dict[str, float]]) -> Dict[str, Dict[str, float]]:
+    """Compute count, mean, p50, p95 and share of total time for each phase"""
+
+    values: Dict[str, List[float]] = {}
+    for t in timings:
+        for phase, seconds in t.items():
+            values.setdefault(phase, []).append(seconds)
+
+    total = sum(sum(v) for v in values.values()) or 1.0
+    stats = {}
+    for phase in task_phases + sorted(set(values.keys()) - set(task_phases)):
+        v = sorted(values.get(phase, []))
+        if len(v) == 0:
+            continue
+
+        stats[phase] = {
+            "count": len(v),
+            "mean": round(sum(v) / len(v), 4),
+            "p50": round(v[int(0.5 * (len(v) - 1))], 4),
+            "p95": round(v[int(0.95 * (len(v) - 1))], 4),
+            "share": round(sum(v) / total, 4),
+        }
+
+    return stats
@@ -0,0 +1,157 @@
+"""
+Measure the peak RSS of deserializing large img2img inputs, before and after decoding
+straight into preallocated buffers.
+
+Each case is decoded in a fresh process, which reports how much its peak RSS grew
+over the RSS it had with the serialized data loaded:
+
+- script params: ControlNet units with large input images and masks, in the version 1
+  format (whole payload decompressed, then each array copied out of it) and the
+  current one (each array decompressed into its own buffer)
+- inline image: a large init image stored in the params JSON, decompressed to a new
+  bytes object and viewed read-only (before), or decompressed into a writable array
+
+Unix only, as it reads the peak RSS from /proc or with `resource`:
+
+    python extensions/agent-scheduler/benchmarks/deserialize_peak_rss.py --size 2048 --units 4
+"""
+
+import os
+import sys
+import zlib
+import base64
+import struct
+import resource
+import argparse
+import tempfile
+import subprocess
+from typing import Dict, List
+
+import msgpack
+import numpy as np
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_scheduler.codec import (  # noqa: E402
+    script_params_magic,
+    ext_ndarray,
+    pack_script_args,
+    unpack_script_args,
+    decompress_into,
+    writable_bytes,
+)
+
+
+def make_script_args(size: int, units: int, rng: np.random.Generator) -> List:
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    image = np.stack([np.add.outer(gradient, gradient) / 2] * 3, axis=-1).astype(np.uint8)
+    args = [0, False, "", 7.5]
+    for i in range(units):
+        image = np.roll(image, 1, axis=0)
+        mask = (rng.random((size, size)) > 0.99).astype(np.uint8) * 255
+        args.append({"is_cnet": True, "enabled": True, "image": {"image": image.copy(), "mask": mask}})
+    return args
+
+
+def pack_script_args_v1(script_args: List) -> bytes:
+    """The version 1 format, arrays inline in their extensions"""
+
+    def pack_ext(obj):
+        if isinstance(obj, np.ndarray):
+            header = msgpack.packb([obj.dtype.str, list(obj.shape)], use_bin_type=True)
+            return msgpack.ExtType(ext_ndarray, struct.pack("<I", len(header)) + header + obj.tobytes())
+        raise TypeError(type(obj).__name__)
+
+    payload = msgpack.packb(script_args, default=pack_ext, use_bin_type=True)
+    return script_params_magic + bytes([1]) + zlib.compress(payload)
+
+
+def make_inline_image(size: int) -> bytes:
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    image = np.stack([np.add.outer(gradient, gradient) / 2] * 4, axis=-1).astype(np.uint8)
+    return base64.b64encode(zlib.compress(image.tobytes()))
+
+
+def decode_inline_image_before(data: bytes, size: int) -> np.ndarray:
+    return np.frombuffer(zlib.decompress(base64.b64decode(data)), dtype=np.uint8).reshape((size, size, 4))
+
+
+def decode_inline_image_after(data: bytes, size: int) -> np.ndarray:
+    image = np.empty((size, size, 4), dtype=np.uint8)
+    decompress_into(base64.b64decode(data), writable_bytes(image))
+    return image
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss of a child starts at the RSS of the parent it was forked from on Linux
+    if os.path.exists("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+
+    # bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_case(case: str, path: str, size: int):
+    with open(path, "rb") as f:
+        data = f.read()
+    baseline = peak_rss_bytes()
+
+    if case.startswith("script params"):
+        decoded = unpack_script_args(data)
+        writable = decoded[-1]["image"]["image"].flags.writeable
+    elif case == "inline image (before)":
+        decoded = decode_inline_image_before(data, size)
+        writable = decoded.flags.writeable
+    else:
+        decoded = decode_inline_image_after(data, size)
+        writable = decoded.flags.writeable
+
+    print(f"{peak_rss_bytes() - baseline} {int(writable)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="width and height of the images")
+    parser.add_argument("--units", type=int, default=4, help="ControlNet units")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--case", help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.case is not None:
+        return run_case(args.case, args.path, args.size)
+
+    script_args = make_script_args(args.size, args.units, np.random.default_rng(args.seed))
+    raw_bytes = sum(v.nbytes for a in script_args if isinstance(a, dict) for v in a["image"].values())
+    inline_image = make_inline_image(args.size)
+    cases: Dict[str, bytes] = {
+        "script params v1": pack_script_args_v1(script_args),
+        "script params (current)": pack_script_args(script_args),
+        "inline image (before)": inline_image,
+        "inline image (after)": inline_image,
+    }
+    del script_args
+
+    print(f"script params pixels {raw_bytes / 1e6:.1f} MB, inline image pixels {args.size * args.size * 4 / 1e6:.1f} MB")
+    with tempfile.TemporaryDirectory() as tmp:
+        for case, data in cases.items():
+            path = os.path.join(tmp, "data")
+            with open(path, "wb") as f:
+                f.write(data)
+
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--case", case, "--path", path, "--size", str(args.size)],
+                check=True,
+                capture_output=True,
+                text=True,
+            ).stdout.split()
+            peak, writable = int(output[0]), output[1] == "1"
+            print(f"{case:>24}: peak RSS +{peak / 1e6:8.1f} MB  {'writable' if writable else 'read-only'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Benchmark task enqueue throughput: one commit per task vs the group-commit buffer.
+
+Run from the webui root so that `modules` can be imported, with DATABASE_URL and
+DATABASE_SCHEMA pointing at a scratch database:
+
+    python extensions/agent-scheduler/benchmarks/enqueue_throughput.py --tasks 2000 --threads 32
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from uuid import uuid4
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_scheduler.db import Task, TaskStatus, TaskManager, TaskWriteBuffer  # noqa: E402
+
+
+def make_task(prefix: str) -> Task:
+    params = {"args": {"prompt": "benchmark", "steps": 20}, "is_ui": False, "is_img2img": False}
+    return Task(
+        id=f"{prefix}-{uuid4()}",
+        type="txt2img",
+        params=json.dumps(params),
+        script_params=b"",
+    )
+
+
+def run(name: str, add_task, tasks: int, threads: int):
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(lambda _: add_task(make_task(name)), range(tasks)))
+    elapsed = time.perf_counter() - start
+
+    failed = len([r for r in results if not r])
+    print(f"{name:>14}: {tasks} tasks in {elapsed:.2f}s, {tasks / elapsed:,.0f} tasks/s ({failed} failed)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--interval-ms", type=float, default=5)
+    parser.add_argument("--max-batch", type=int, default=100)
+    args = parser.parse_args()
+
+    manager = TaskManager()
+    buffer = TaskWriteBuffer(manager, flush_interval=args.interval_ms / 1000, max_batch=args.max_batch)
+
+    try:
+        run("bench-single", manager.add_task, args.tasks, args.threads)
+        run("bench-group", buffer.add_task, args.tasks, args.threads)
+    finally:
+        for task in manager.get_tasks(status=TaskStatus.PENDING):
+            if task.id.startswith("bench-"):
+                manager.delete_task(task.id)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""
+Compare the storage formats of UI image args: zlib compressed raw pixels in the params
+JSON (legacy) vs encoded images stored in the image params column.
+
+Encodes and decodes a synthetic sketch (flat colors and strokes) and a synthetic photo
+(smooth gradients with sensor noise). No GPU or database is used:
+
+    python extensions/agent-scheduler/benchmarks/image_args_codec.py --size 2048
+"""
+
+import io
+import zlib
+import time
+import base64
+import argparse
+from typing import Callable, Dict
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+
+def make_sketch(size: int, rng: np.random.Generator) -> Image.Image:
+    image = Image.new("RGBA", (size, size), (0, 0, 0, 0))
+    draw = ImageDraw.Draw(image)
+    for _ in range(200):
+        points = [tuple(p) for p in rng.integers(0, size, (8, 2)).tolist()]
+        color = tuple(rng.integers(0, 256, 3).tolist()) + (255,)
+        draw.line(points, fill=color, width=int(rng.integers(2, 24)))
+    return image
+
+
+def make_photo(size: int, rng: np.random.Generator) -> Image.Image:
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    image = np.stack(
+        [np.add.outer(gradient, gradient) / 2, np.add.outer(gradient, gradient[::-1]) / 2, np.tile(gradient, (size, 1))],
+        axis=-1,
+    )
+    image += rng.normal(0, 4, image.shape)
+    return Image.fromarray(np.clip(image, 0, 255).astype(np.uint8))
+
+
+def legacy_encode(image: Image.Image) -> bytes:
+    return base64.b64encode(zlib.compress(image.tobytes())).decode("utf-8").encode()
+
+
+def legacy_decode(data: bytes, image: Image.Image) -> Image.Image:
+    return Image.frombytes(image.mode, image.size, zlib.decompress(base64.b64decode(data)))
+
+
+def encoder(format: str, **options) -> Callable[[Image.Image], bytes]:
+    def encode(image: Image.Image) -> bytes:
+        with io.BytesIO() as output:
+            image.save(output, format=format, **options)
+            return output.getvalue()
+
+    return encode
+
+
+def decode(data: bytes, image: Image.Image) -> Image.Image:
+    decoded = Image.open(io.BytesIO(data))
+    decoded.load()
+    return decoded
+
+
+def measure(fn: Callable, *args, repeat: int) -> float:
+    fn(*args)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(*args)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=2048, help="width and height of the images")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    images: Dict[str, Image.Image] = {
+        "sketch": make_sketch(args.size, rng),
+        "photo": make_photo(args.size, rng),
+    }
+    formats = [
+        ("zlib json (legacy)", legacy_encode, legacy_decode),
+        ("png level 1", encoder("PNG", compress_level=1), decode),
+        ("png level 6", encoder("PNG", compress_level=6), decode),
+        ("webp lossless m0", encoder("WEBP", lossless=True, method=0), decode),
+        ("webp lossless m4", encoder("WEBP", lossless=True, method=4), decode),
+    ]
+    for image_name, image in images.items():
+        print(f"{image_name} {image.mode} {image.size[0]}x{image.size[1]}")
+        for name, encode, decode_fn in formats:
+            data = encode(image)
+            encode_time = measure(encode, image, repeat=args.repeat)
+            decode_time = measure(decode_fn, data, image, repeat=args.repeat)
+            lossless = np.array_equal(np.array(decode_fn(data, image)), np.array(image))
+            print(
+                f"{name:>20}: {len(data) / 1e6:8.2f} MB  encode {encode_time * 1e3:8.1f} ms  "
+                f"decode {decode_time * 1e3:8.1f} ms  {'lossless' if lossless else 'LOSSY'}"
+            )
+
+
+if __name__ == "__main__":
+    main()
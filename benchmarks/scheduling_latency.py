@@ -0,0 +1,119 @@
+"""
+Compare task latency (submission to completion) of the FIFO and shortest-job-first policies.
+
+Replays a synthetic mix of small and large txt2img tasks through each policy on a
+simulated single GPU, whose generation time follows the task cost model. No GPU or
+database is used. Run from the webui root so that `modules` can be imported:
+
+    python extensions/agent-scheduler/benchmarks/scheduling_latency.py --tasks 2000 --load 0.9
+"""
+
+import os
+import sys
+import json
+import random
+import argparse
+from datetime import datetime, timedelta, timezone
+from typing import List
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_scheduler.db import Task  # noqa: E402
+from agent_scheduler.cost import CostModel, get_task_work  # noqa: E402
+from agent_scheduler.scheduling import SchedulingPolicy, ShortestJobFirstPolicy  # noqa: E402
+
+# (weight, args) of the simulated workload
+workload = [
+    (6, {"width": 512, "height": 512, "steps": 4}),
+    (3, {"width": 768, "height": 768, "steps": 25}),
+    (1, {"width": 1024, "height": 1024, "steps": 50, "batch_size": 4}),
+    (0.5, {"width": 1024, "height": 1024, "steps": 50, "batch_size": 8, "enable_hr": True, "hr_scale": 1.5}),
+]
+
+
+def make_tasks(count: int, model: CostModel, load: float, rng: random.Random) -> List[Task]:
+    weights = [w for w, _ in workload]
+    args = [rng.choices(workload, weights)[0][1] for _ in range(count)]
+    mean_seconds = sum(model.overhead + model.seconds_per_work * get_task_work({"args": a}) for a in args) / count
+
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    arrival = 0.0
+    tasks = []
+    for i, a in enumerate(args):
+        arrival += rng.expovariate(load / mean_seconds)
+        created_at = start + timedelta(seconds=arrival)
+        tasks.append(
+            Task(
+                id=f"bench-{i}",
+                type="txt2img",
+                params=json.dumps({"args": a, "is_ui": False}),
+                script_params=b"",
+                priority=i,
+                created_at=created_at,
+            )
+        )
+
+    return tasks
+
+
+def simulate(tasks: List[Task], policy_factory, model: CostModel, noise: float, rng: random.Random) -> List[float]:
+    now = tasks[0].created_at
+    clock = lambda: now  # noqa: E731
+    policy: SchedulingPolicy = policy_factory(clock)
+
+    pending: List[Task] = []
+    upcoming = list(tasks)
+    latencies = []
+    while len(upcoming) > 0 or len(pending) > 0:
+        while len(upcoming) > 0 and upcoming[0].created_at <= now:
+            pending.append(upcoming.pop(0))
+
+        if len(pending) == 0:
+            now = upcoming[0].created_at
+            continue
+
+        task = policy.select(pending[: policy.window])
+        pending.remove(task)
+
+        seconds = model.estimate(task) * rng.uniform(1 - noise, 1 + noise)
+        now += timedelta(seconds=seconds)
+        latencies.append((now - task.created_at).total_seconds())
+
+    return latencies
+
+
+def report(name: str, latencies: List[float]):
+    latencies = sorted(latencies)
+    n = len(latencies)
+    print(
+        f"{name:>20}: mean {sum(latencies) / n:8.1f}s  p50 {latencies[n // 2]:8.1f}s  "
+        f"p95 {latencies[int(0.95 * (n - 1))]:8.1f}s  max {latencies[-1]:8.1f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tasks", type=int, default=2000)
+    parser.add_argument("--load", type=float, default=0.9, help="GPU utilization of the arrival rate")
+    parser.add_argument("--window", type=int, default=50)
+    parser.add_argument("--aging", type=float, default=6)
+    parser.add_argument("--noise", type=float, default=0.2, help="relative error of the cost model")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model = CostModel(refresh_interval=float("inf"))
+    tasks = make_tasks(args.tasks, model, args.load, random.Random(args.seed))
+
+    policies = {
+        "FIFO": lambda clock: SchedulingPolicy(),
+        "Shortest job first": lambda clock: ShortestJobFirstPolicy(
+            window=args.window, aging=args.aging, estimate=model.estimate, clock=clock
+        ),
+    }
+    for name, factory in policies.items():
+        report(name, simulate(tasks, factory, model, args.noise, random.Random(args.seed)))
+
+
+if __name__ == "__main__":
+    main()
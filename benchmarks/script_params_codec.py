@@ -0,0 +1,107 @@
+"""
+Compare the script params formats: zlib compressed pickle (legacy) vs zlib compressed msgpack.
+
+Encodes and decodes synthetic script args of UI tasks: plain values, ControlNet units
+with input images and masks, and a large sketch. No GPU or database is used. Run from
+the webui root so that `modules` can be imported:
+
+    python extensions/agent-scheduler/benchmarks/script_params_codec.py --size 1024 --units 3
+"""
+
+import io
+import os
+import sys
+import zlib
+import time
+import pickle
+import argparse
+from typing import Callable, List
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.getcwd())
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from agent_scheduler.codec import pack_script_args, unpack_script_args, LegacyScriptArgsUnpickler  # noqa: E402
+
+
+def make_script_args(size: int, units: int, rng: np.random.Generator) -> List:
+    # smooth images compress like real inputs, noise would be the worst case
+    gradient = np.linspace(0, 255, size, dtype=np.float32)
+    image = np.stack([np.add.outer(gradient, gradient) / 2] * 3, axis=-1).astype(np.uint8)
+    mask = (rng.random((size, size)) > 0.99).astype(np.uint8) * 255
+
+    args = [0, False, "", 7.5, None, ("tuple", 1)]
+    for i in range(units):
+        # each unit has its own input, shared arrays would be deduplicated by pickle
+        image = np.roll(image, 1, axis=0)
+        args.append(
+            {
+                "is_cnet": True,
+                "enabled": True,
+                "module": "canny",
+                "model": f"control_v11p_sd15_canny [{i}]",
+                "weight": 1.0,
+                "image": {"image": image, "mask": mask},
+                "resize_mode": "Crop and Resize",
+                "threshold_a": 100,
+                "threshold_b": 200,
+                "guidance_start": 0.0,
+                "guidance_end": 1.0,
+            }
+        )
+    args.append(Image.fromarray(image).convert("RGBA"))
+    args.extend([0.5] * 200)
+
+    return args
+
+
+def legacy_pack(args: List) -> bytes:
+    return zlib.compress(pickle.dumps(args))
+
+
+def legacy_unpack(data: bytes) -> List:
+    return pickle.loads(zlib.decompress(data))
+
+
+def restricted_legacy_unpack(data: bytes) -> List:
+    return LegacyScriptArgsUnpickler(io.BytesIO(zlib.decompress(data))).load()
+
+
+def measure(fn: Callable, arg, repeat: int) -> float:
+    fn(arg)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(arg)
+    return (time.perf_counter() - start) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--size", type=int, default=1024, help="width and height of the images")
+    parser.add_argument("--units", type=int, default=3, help="ControlNet units")
+    parser.add_argument("--repeat", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    script_args = make_script_args(args.size, args.units, np.random.default_rng(args.seed))
+    legacy = legacy_pack(script_args)
+    current = pack_script_args(script_args)
+
+    formats = [
+        ("pickle (legacy)", legacy_pack, legacy_unpack, legacy),
+        ("pickle (restricted)", legacy_pack, restricted_legacy_unpack, legacy),
+        ("msgpack", pack_script_args, unpack_script_args, current),
+    ]
+    for name, pack, unpack, data in formats:
+        encode = measure(pack, script_args, args.repeat)
+        decode = measure(unpack, data, args.repeat)
+        print(
+            f"{name:>20}: {len(data) / 1e6:8.2f} MB  encode {encode * 1e3:8.1f} ms  "
+            f"decode {decode * 1e3:8.1f} ms  ({len(data) / 1e6 / decode:8.1f} MB/s)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -8,3 +8,6 @@ if not launch.is_installed("psycopg2-binary"):
 
 if not launch.is_installed("pika"):
     launch.run_pip("install pika", "requirement for task-scheduler")
+
+if not launch.is_installed("msgpack"):
+    launch.run_pip("install msgpack", "requirement for task-scheduler")
@@ -28,8 +28,14 @@ from agent_scheduler.helpers import (
     compare_components_with_ids,
     get_components_by_ids,
     is_macos,
+    get_expires_at,
 )
-from agent_scheduler.db import init as init_db, task_manager, TaskStatus
+from agent_scheduler.db import init as init_db, task_manager, callback_manager, TaskStatus, tenant_max_length
+from agent_scheduler.scheduling import policy_fifo, scheduling_policy_choices
+from agent_scheduler.executors import executor_in_process, executor_choices
+from agent_scheduler.oom import oom_policy_adaptive, oom_policy_choices
+from agent_scheduler.admission import admission_controller
+from agent_scheduler.cost import get_task_work
 from agent_scheduler.api import regsiter_apis
 
 is_sdnext = parser.description == "SD.Next"
@@ -454,6 +460,10 @@ def remove_old_tasks():
                 f"[AgentScheduler] Deleted {deleted_rows} tasks older than {retention_days} days"
             )
 
+        callback_manager.delete_callbacks(
+            before=datetime.now() - timedelta(days=retention_days)
+        )
+
 
 def on_ui_tab(**_kwargs):
     grid_page_size = getattr(shared.opts, "queue_grid_page_size", 0)
@@ -781,6 +791,198 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        "queue_result_cache",
+        shared.OptionInfo(
+            False,
+            "Reuse the result of a previous task with the same parameters and a fixed seed",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_result_cache_max_entries",
+        shared.OptionInfo(
+            1000,
+            "Result cache: max cached results",
+            gr.Slider,
+            {"minimum": 10, "maximum": 100000, "step": 10},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_result_cache_max_age_hours",
+        shared.OptionInfo(
+            24,
+            "Result cache: max age of cached results (hours)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 720, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_coalesce_identical_tasks",
+        shared.OptionInfo(
+            False,
+            "Generate identical pending tasks with a fixed seed only once, and share the result",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_coalesce_window",
+        shared.OptionInfo(
+            100,
+            "Coalescing: max pending tasks to look ahead for identical tasks",
+            gr.Slider,
+            {"minimum": 1, "maximum": 1000, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_postprocess_workers",
+        shared.OptionInfo(
+            2,
+            "Post-processing workers finalizing tasks while the next one generates (0 to finalize inline)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 8, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_postprocess_max_pending",
+        shared.OptionInfo(
+            4,
+            "Post-processing: max tasks waiting to be finalized before generation waits",
+            gr.Slider,
+            {"minimum": 1, "maximum": 64, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_callback_workers",
+        shared.OptionInfo(
+            4,
+            "Callback delivery workers (requires restart)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_callback_per_host",
+        shared.OptionInfo(
+            2,
+            "Callback delivery: max concurrent deliveries to the same host",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_callback_max_attempts",
+        shared.OptionInfo(
+            8,
+            "Callback delivery: max attempts before giving up",
+            gr.Slider,
+            {"minimum": 1, "maximum": 20, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_max_pending_tasks",
+        shared.OptionInfo(
+            0,
+            "Admission control: max pending tasks, new API and MQ tasks wait beyond it (0 for unlimited)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 100000, "step": 100},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_max_pending_tasks_per_tenant",
+        shared.OptionInfo(
+            0,
+            "Admission control: max pending tasks of a tenant (0 for unlimited)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 10000, "step": 10},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_max_pending_payload_mb",
+        shared.OptionInfo(
+            0,
+            "Admission control: max size of the pending task payloads (MB, 0 for unlimited)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 10240, "step": 64},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_lease_seconds",
+        shared.OptionInfo(
+            60,
+            "Running tasks of a worker that stopped responding for this long are requeued (seconds)",
+            gr.Slider,
+            {"minimum": 15, "maximum": 600, "step": 5},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_lease_max_attempts",
+        shared.OptionInfo(
+            3,
+            "Max attempts of a task abandoned by crashed workers before it is marked as failed",
+            gr.Slider,
+            {"minimum": 1, "maximum": 10, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_preemption",
+        shared.OptionInfo(
+            False,
+            "Interrupt the running task to run an urgent task, the interrupted task is requeued",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_preemption_min_runtime_seconds",
+        shared.OptionInfo(
+            10,
+            "Preemption: min runtime of a task before it can be preempted (seconds)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 600, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_preemption_max_per_task",
+        shared.OptionInfo(
+            2,
+            "Preemption: max times the same task can be preempted",
+            gr.Slider,
+            {"minimum": 1, "maximum": 10, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_oom_policy",
+        shared.OptionInfo(
+            oom_policy_adaptive,
+            "When a task runs out of GPU memory",
+            gr.Radio,
+            lambda: {
+                "choices": oom_policy_choices,
+            },
+            section=section,
+        ),
+    )
     shared.opts.add_option(
         "queue_grid_page_size",
         shared.OptionInfo(
@@ -876,6 +1078,190 @@ def on_ui_settings():
             section=section,
         ),
     )
+    shared.opts.add_option(
+        "queue_scheduling_policy",
+        shared.OptionInfo(
+            policy_fifo,
+            "Task scheduling policy",
+            gr.Radio,
+            lambda: {
+                "choices": scheduling_policy_choices,
+            },
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_sjf_window",
+        shared.OptionInfo(
+            50,
+            "Shortest job first: max pending tasks to look ahead",
+            gr.Slider,
+            {"minimum": 1, "maximum": 500, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_sjf_aging",
+        shared.OptionInfo(
+            6,
+            "Shortest job first: seconds of expected cost forgiven per minute of waiting",
+            gr.Slider,
+            {"minimum": 0, "maximum": 120, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_fair_share",
+        shared.OptionInfo(
+            False,
+            "Fair queuing: take turns between tenants (API users, MQ queues, UI users)",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_tenant_weights",
+        shared.OptionInfo(
+            "",
+            "Fair queuing: tenant weights, eg: api:alice=3, mq:images=2, ui=1 (default 1)",
+            gr.Textbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_affinity_window",
+        shared.OptionInfo(
+            20,
+            "Checkpoint affinity: max pending tasks to look ahead",
+            gr.Slider,
+            {"minimum": 1, "maximum": 200, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_affinity_max_wait_minutes",
+        shared.OptionInfo(
+            10,
+            "Checkpoint affinity: run the oldest task anyway after waiting (minutes)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 240, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_prefetch_depth",
+        shared.OptionInfo(
+            0,
+            "Number of upcoming tasks to prepare while the current one is generating (0 to disable)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 8, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_checkpoint_cache_gb",
+        shared.OptionInfo(
+            0,
+            "RAM cache size for preloading checkpoints of upcoming tasks (GB, 0 to disable)",
+            gr.Slider,
+            {"minimum": 0, "maximum": 128, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_checkpoint_lookahead",
+        shared.OptionInfo(
+            5,
+            "Number of upcoming tasks to inspect for checkpoint preloading",
+            gr.Slider,
+            {"minimum": 1, "maximum": 50, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_batch_max_size",
+        shared.OptionInfo(
+            1,
+            "Max compatible txt2img API tasks to generate in one batch (1 to disable)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_executor",
+        shared.OptionInfo(
+            executor_in_process,
+            "Task executor (the fake executor generates nothing, for load tests only)",
+            gr.Radio,
+            lambda: {
+                "choices": executor_choices,
+            },
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_executor_slots",
+        shared.OptionInfo(
+            1,
+            "Number of concurrent executor slots (in-process executor always uses 1)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 32, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_fake_executor_speed",
+        shared.OptionInfo(
+            100,
+            "Fake executor speed (megapixel steps per second)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 1000, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_group_commit",
+        shared.OptionInfo(
+            False,
+            "Group-commit task registrations (batch inserts of enqueue bursts)",
+            gr.Checkbox,
+            {},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_group_commit_interval_ms",
+        shared.OptionInfo(
+            5,
+            "Group-commit flush interval (ms)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 100, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_group_commit_max_batch",
+        shared.OptionInfo(
+            100,
+            "Group-commit max rows per transaction",
+            gr.Slider,
+            {"minimum": 1, "maximum": 1000, "step": 1},
+            section=section,
+        ),
+    )
+    shared.opts.add_option(
+        "queue_image_encode_workers",
+        shared.OptionInfo(
+            4,
+            "Threads encoding the init images of img2img API tasks at enqueue (1 to encode serially)",
+            gr.Slider,
+            {"minimum": 1, "maximum": 16, "step": 1},
+            section=section,
+        ),
+    )
 
 
 def on_app_started(block: gr.Blocks, app):
@@ -904,16 +1290,37 @@ def on_app_started(block: gr.Blocks, app):
         task_id = args.get("taskId", "invalid")
         checkpoint = args.pop("checkpoint", None)
         vae = args.pop("vae", None)
-
-        task_runner.register_api_task(
-            task_id,
-            api_task_id=None,
-            is_img2img=False,
-            args=args,
-            checkpoint=checkpoint,
-            vae=vae,
-            ack_tag=method.delivery_tag,
+        # pop both spellings, so none of them is left in the generation args
+        expires_at, expires_at_snake = args.pop("expiresAt", None), args.pop("expires_at", None)
+        ttl_seconds, ttl_seconds_snake = args.pop("ttlSeconds", None), args.pop("ttl_seconds", None)
+        expires_at = get_expires_at(
+            expires_at if expires_at is not None else expires_at_snake,
+            ttl_seconds if ttl_seconds is not None else ttl_seconds_snake,
         )
+        tenant = f"mq:{method.routing_key}"[:tenant_max_length]
+
+        # while the queue is full, stop consuming so that messages stay in RabbitMQ
+        retry_after = admission_controller.admit(tenant, len(body), get_task_work({"args": args}))
+        while retry_after is not None:
+            print(f" [x] Queue is full, pausing consumption for {retry_after:.0f}s")
+            ch.connection.sleep(retry_after)
+            retry_after = admission_controller.admit(tenant, len(body), get_task_work({"args": args}))
+
+        try:
+            task_runner.register_api_task(
+                task_id,
+                api_task_id=None,
+                is_img2img=False,
+                args=args,
+                checkpoint=checkpoint,
+                vae=vae,
+                ack_tag=method.delivery_tag,
+                tenant=tenant,
+                expires_at=expires_at,
+            )
+        except Exception:
+            admission_controller.release(tenant, len(body))
+            raise
         MQ_CHANNEL.basic_ack(delivery_tag=method.delivery_tag)
 
     queues = ["picxReal_10Lcm", "realvisxlV40_v40LightningBakedvae"]
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the extension is imported as a package from its root, like the webui does
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,51 @@
+import gc
+import dataclasses
+
+import numpy as np
+
+from agent_scheduler.codec import pack_script_args, unpack_script_args
+
+
+@dataclasses.dataclass
+class Unit:
+    enabled: bool
+    image: np.ndarray
+    weight: float = 1.0
+
+
+class TemporaryFileCloser:
+    """Crafted to be stored as tempfile._TemporaryFileCloser, which deletes its file when collected"""
+
+    __module__ = "tempfile"
+    __qualname__ = "_TemporaryFileCloser"
+
+    def __init__(self, name: str):
+        self.file = None
+        self.name = name
+        self.delete = True
+        self.close_called = False
+
+
+def test_plain_objects_are_read_back_as_attribute_dicts():
+    image = np.arange(12, dtype=np.uint8).reshape(2, 2, 3)
+
+    (unit,) = unpack_script_args(pack_script_args([Unit(True, image)]))
+
+    assert type(unit) is dict
+    assert unit["enabled"] is True and unit["weight"] == 1.0
+    assert np.array_equal(unit["image"], image)
+
+
+def test_crafted_object_class_is_not_instantiated(tmp_path):
+    victim = tmp_path / "victim"
+    victim.write_text("keep")
+    data = pack_script_args([TemporaryFileCloser(str(victim))])
+
+    (closer,) = unpack_script_args(data)
+    gc.collect()
+
+    assert type(closer) is dict
+    assert closer["name"] == str(victim)
+    del closer
+    gc.collect()
+    assert victim.read_text() == "keep"
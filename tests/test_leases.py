@@ -0,0 +1,44 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+if not os.getenv("DATABASE_URL"):
+    pytest.skip("DATABASE_URL is not set", allow_module_level=True)
+
+from agent_scheduler.db import init, task_manager, TaskStatus, Task  # noqa: E402
+
+
+@pytest.fixture(scope="module", autouse=True)
+def database():
+    init()
+
+
+@pytest.fixture
+def task():
+    task = Task(id=str(uuid.uuid4()), type="txt2img", params="{}")
+    task_manager.add_task(task)
+    yield task
+    task_manager.delete_task(task.id)
+
+
+def test_requeued_task_survives_one_lease_expiry(task: Task):
+    lease = timedelta(seconds=60)
+    expired_at = datetime.now(timezone.utc) + 2 * lease
+
+    # claimed, then requeued by the runner (eg: out of memory retry)
+    assert task_manager.claim_tasks([task.id], lease) == {task.id: 1}
+    requeued = task_manager.get_task(task.id)
+    requeued.status = TaskStatus.PENDING
+    task_manager.update_task(requeued)
+
+    # claimed again, then its worker crashed
+    assert task_manager.claim_tasks([task.id], lease) == {task.id: 2}
+    task_manager.reap_expired_leases(max_attempts=2, now=expired_at)
+    assert task_manager.get_task(task.id).status == TaskStatus.PENDING
+
+    # abandoned a second time
+    task_manager.claim_tasks([task.id], lease)
+    task_manager.reap_expired_leases(max_attempts=2, now=expired_at)
+    assert task_manager.get_task(task.id).status == TaskStatus.FAILED
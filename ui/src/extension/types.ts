@@ -1,4 +1,4 @@
-export type TaskStatus = 'pending' | 'running' | 'done' | 'failed' | 'interrupted' | 'saved';
+export type TaskStatus = 'pending' | 'running' | 'done' | 'failed' | 'interrupted' | 'expired' | 'saved';
 
 export type Task = {
   id: string;
@@ -9,6 +9,6 @@ module.exports = {
     },
     plugins: [],
     safelist: [
-        { pattern: /task-(pending|running|done|failed|interrupted|saved)/ },
+        { pattern: /task-(pending|running|done|failed|interrupted|expired|saved)/ },
     ],
 }
\ No newline at end of file